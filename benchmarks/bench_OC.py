@@ -0,0 +1,20 @@
+from seismolab.OC import OCFitter
+from seismolab.parallel import set_config
+
+from .common import SIZES, PERIOD, rrlyrae_light_curve
+
+class FitMinima:
+    params = [SIZES[:2], ['model','poly','nonparametric']]
+    param_names = ['npoints','fittype']
+    timeout = 900
+
+    def setup(self, npoints, fittype):
+        set_config(progress=False)
+        t, y, err = rrlyrae_light_curve(npoints, baseline=10.)
+        self.fitter = OCFitter(t, y, err, PERIOD)
+
+    def time_fit_minima(self, npoints, fittype):
+        self.fitter.fit_minima(fittype=fittype, samplings=20)
+
+    def peakmem_fit_minima(self, npoints, fittype):
+        self.fitter.fit_minima(fittype=fittype, samplings=20)
@@ -0,0 +1,53 @@
+from seismolab.fourier import Fourier, MultiHarmonicFitter, MultiFrequencyFitter
+from seismolab.parallel import set_config
+
+from .common import SIZES, multiperiodic_light_curve, rrlyrae_light_curve
+
+class Spectrum:
+    # The DFT matrix is (frequencies x points) large, so stop at 1e4 points
+    params = [SIZES[:2]]
+    param_names = ['npoints']
+    timeout = 300
+
+    def setup(self, npoints):
+        t, y, _ = multiperiodic_light_curve(npoints)
+        self.fourier = Fourier(t, y)
+
+    def time_spectrum(self, npoints):
+        self.fourier.spectrum(maximum_frequency=10, samples_per_peak=5)
+
+    def peakmem_spectrum(self, npoints):
+        self.fourier.spectrum(maximum_frequency=10, samples_per_peak=5)
+
+class FitFreqs:
+    params = [SIZES]
+    param_names = ['npoints']
+    timeout = 600
+
+    def setup(self, npoints):
+        t, y, err = multiperiodic_light_curve(npoints)
+        self.fitter = MultiFrequencyFitter(t, y, err)
+
+    def time_fit_freqs(self, npoints):
+        self.fitter.fit_freqs(maxfreqs=3, maximum_frequency=10)
+
+    def peakmem_fit_freqs(self, npoints):
+        self.fitter.fit_freqs(maxfreqs=3, maximum_frequency=10)
+
+class FitHarmonicsBootstrap:
+    params = [SIZES[:3]]
+    param_names = ['npoints']
+    timeout = 600
+
+    def setup(self, npoints):
+        set_config(progress=False)
+        t, y, err = rrlyrae_light_curve(npoints)
+        self.fitter = MultiHarmonicFitter(t, y, err)
+
+    def time_fit_harmonics(self, npoints):
+        self.fitter.fit_harmonics(maxharmonics=5, maximum_frequency=20,
+                                  error_estimation='bootstrap', ntry=50, seed=1)
+
+    def peakmem_fit_harmonics(self, npoints):
+        self.fitter.fit_harmonics(maxharmonics=5, maximum_frequency=20,
+                                  error_estimation='bootstrap', ntry=50, seed=1)
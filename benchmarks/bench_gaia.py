@@ -0,0 +1,29 @@
+from seismolab.gaia.querytools import get_dist_absmag, get_dist_absmag_edr3
+
+from .common import StubDustModel, gaia_table
+
+class DistanceExtinction:
+    """
+    Distance, extinction and absolute magnitude calculation
+    without network access and without real dust maps.
+    """
+    params = [[10, 100], [2, 3]]
+    param_names = ['nstars','gaiaDR']
+    timeout = 600
+
+    def setup(self, nstars, gaiaDR):
+        self.targets = gaia_table(nstars)
+        self.dustmodel = StubDustModel()
+
+    def _run(self, gaiaDR):
+        for i in range(len(self.targets)):
+            if gaiaDR == 2:
+                get_dist_absmag(i, self.targets, self.dustmodel, 0.)
+            else:
+                get_dist_absmag_edr3(i, self.targets, self.dustmodel, 0., False)
+
+    def time_dist_absmag(self, nstars, gaiaDR):
+        self._run(gaiaDR)
+
+    def peakmem_dist_absmag(self, nstars, gaiaDR):
+        self._run(gaiaDR)
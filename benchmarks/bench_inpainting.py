@@ -0,0 +1,17 @@
+from seismolab.inpainting import kinpainting
+
+from .common import SIZES, multiperiodic_light_curve
+
+class KInpainting:
+    params = [SIZES[:3]]
+    param_names = ['npoints']
+    timeout = 600
+
+    def setup(self, npoints):
+        self.t, self.y, _ = multiperiodic_light_curve(npoints)
+
+    def time_kinpainting(self, npoints):
+        kinpainting(self.t, self.y)
+
+    def peakmem_kinpainting(self, npoints):
+        kinpainting(self.t, self.y)
@@ -0,0 +1,20 @@
+from seismolab.template import TemplateFitter
+from seismolab.parallel import set_config
+
+from .common import SIZES, rrlyrae_light_curve
+
+class Fit:
+    params = [SIZES[:3]]
+    param_names = ['npoints']
+    timeout = 900
+
+    def setup(self, npoints):
+        set_config(progress=False)
+        t, y, err = rrlyrae_light_curve(npoints)
+        self.fitter = TemplateFitter(t, y, err)
+
+    def time_fit(self, npoints):
+        self.fitter.fit(maxharmonics=5, maximum_frequency=20)
+
+    def peakmem_fit(self, npoints):
+        self.fitter.fit(maxharmonics=5, maximum_frequency=20)
@@ -0,0 +1,20 @@
+from seismolab import tfa
+from seismolab.parallel import set_config
+
+from .common import SIZES, multiperiodic_light_curve
+
+class Transforms:
+    params = [SIZES[:2], ['windowed_lomb_scargle','gabor','wavelet','choi_williams']]
+    param_names = ['npoints','transform']
+    timeout = 900
+
+    def setup(self, npoints, transform):
+        set_config(progress=False)
+        self.t, self.y, _ = multiperiodic_light_curve(npoints, gaps=False)
+        self.transform = getattr(tfa, transform)
+
+    def time_transform(self, npoints, transform):
+        self.transform(self.t, self.y, maximum_frequency=10, Ntimes=50)
+
+    def peakmem_transform(self, npoints, transform):
+        self.transform(self.t, self.y, maximum_frequency=10, Ntimes=50)
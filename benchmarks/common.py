@@ -0,0 +1,105 @@
+import numpy as np
+
+# Number of light curve points
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Frequencies (c/d) and amplitudes of the synthetic multiperiodic star
+FREQS = (2.44, 3.67, 5.13)
+AMPS  = (0.1, 0.03, 0.01)
+
+# Period (d) of the synthetic RR Lyrae-like star
+PERIOD = 0.409837
+
+def _time_grid(npoints, baseline, gaps, rng):
+    """
+    Time points with orbital (TESS-like) and random gaps.
+    """
+    # Oversample to have enough points after removing the gaps
+    t = np.linspace(0, baseline, int(npoints*1.5))
+
+    if gaps:
+        # 1 day long gap in the middle of each 13.7 days long orbit
+        keep = np.abs( (t % 13.7) - 6.85 ) > 0.5
+
+        # A few random shorter gaps
+        for start in rng.uniform(0, baseline, size=int(baseline//10)+1):
+            keep &= (t < start) | (t > start+0.3)
+
+        t = t[keep]
+
+    # Thin the grid evenly to the requested size
+    t = t[ np.linspace(0, len(t)-1, npoints).astype(int) ]
+
+    return t
+
+def multiperiodic_light_curve(npoints, baseline=30., gaps=True, noise=0.005, seed=12345):
+    """
+    Light curve of a star pulsating in several independent modes.
+
+    Returns
+    -------
+    time, flux, fluxerror : array
+    """
+    rng = np.random.default_rng(seed)
+
+    t = _time_grid(int(npoints), baseline, gaps, rng) + 1400.
+
+    y = 10. + sum( a*np.sin(2*np.pi*f*t + 0.7*k) for k,(f,a) in enumerate(zip(FREQS,AMPS)) )
+    y += rng.normal(0, noise, t.shape[0])
+
+    return t, y, np.full_like(t, noise)
+
+def rrlyrae_light_curve(npoints, baseline=30., period=PERIOD, nharmonics=3,
+                        modulation=0.05, gaps=True, noise=0.005, seed=12345):
+    """
+    Light curve of a non-sinusoidal, slightly amplitude modulated
+    RR Lyrae-like star with sharp minima.
+
+    Returns
+    -------
+    time, flux, fluxerror : array
+    """
+    rng = np.random.default_rng(seed)
+
+    # Start at the beginning of a cycle
+    t = _time_grid(int(npoints), baseline, gaps, rng) + period*np.ceil(1400./period)
+
+    amp = 1 + modulation*np.sin(2*np.pi*t/(0.5*baseline))
+    y = 10. + amp * sum( 0.3/k * np.sin(2*np.pi*k*t/period + 0.3*k) for k in range(1,nharmonics+1) )
+    y += rng.normal(0, noise, t.shape[0])
+
+    return t, y, np.full_like(t, noise)
+
+class StubDustModel:
+    """
+    Stand-in for an `mwdust` map: E(B-V) grows smoothly with
+    distance (in kpc), independently of the direction.
+    """
+    def __call__(self, l, b, d):
+        return 0.1 * (1 - np.exp(-np.asarray(d,dtype=float)/0.5))
+
+def gaia_table(nstars, seed=12345):
+    """
+    Astropy Table mimicking the output of the Gaia/Simbad queries.
+    """
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+
+    data = {'Source' : np.arange(nstars, dtype=np.int64)+1,
+            'ra'     : rng.uniform(0, 360, nstars),
+            'dec'    : rng.uniform(-90, 90, nstars),
+            'plx'    : rng.uniform(0.2, 5, nstars)}
+    data['sig_plx'] = 0.05*data['plx']
+
+    # Distances in pc
+    dist = 1000/data['plx']
+    data['r_med_geo'] = data['r_med_photogeo'] = dist
+    data['r_hi_geo']  = data['r_hi_photogeo']  = 1.05*dist
+    data['r_lo_geo']  = data['r_lo_photogeo']  = 0.95*dist
+
+    for band in ['gamag','bpmag','rpmag','bmag','vmag','jmag','hmag','kmag']:
+        data[band] = rng.uniform(8, 15, nstars)
+        data['sig_'+band] = np.full(nstars, 0.01)
+
+    return Table(data)
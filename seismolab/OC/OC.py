@@ -1,65 +1,522 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import minimize_scalar
-from matplotlib.backends.backend_pdf import PdfPages
-from joblib import Parallel, delayed
 import warnings
-from tqdm.auto import tqdm
-from multiprocessing import cpu_count
-from statsmodels.nonparametric.kernel_regression import KernelReg
-
-from scipy.stats import binned_statistic
-from scipy.optimize import minimize
 
 from .shift_curves import shift_phase_curves_vertically
+from .smoothing import LocalLinearSmoother
+from ..parallel import parallel_map, run_in_background, get_n_jobs
+from ..profiling import profiled, stage
 
 __all__ = ['OCFitter']
 
-def chi2model(params,x,y,sig,pol):
-    xoffset = params[0]
-    yoffset = params[1]
-    model = pol(x + xoffset) + yoffset
-    chi2 = (np.power(y - model,2) / (sig**2)).sum()
+# Number of resampled light curves generated and fitted at once
+_RESAMPLING_BLOCK = 25
+# Largest number of resampled light curves fitted by a worker in one task
+_RESAMPLING_TASK = 1000
+
+@profiled('OC.resampling')
+def _resampled_minima(blocks, x, y, err, seed, samplings,
+                      fittype, order, bound1, bound2, pol, shift_bound):
+    """
+    Refit minima with generating new observations from noise.
+
+    Only the `blocks` of `_RESAMPLING_BLOCK` resampled light curves are
+    generated and fitted, each from the random numbers of `seed` and its index,
+    so the memory use does not depend on `samplings`, and the results do not
+    depend on how the blocks are distributed among the workers.
+
+    Returns
+    -------
+    t : array
+        The minimum times for `poly` and `nonparametric`,
+        the horizontal shifts of the model for `model`.
+    """
+    from scipy.optimize import minimize_scalar
+
+    t = []
+    for block in np.atleast_1d(blocks):
+        size = min(_RESAMPLING_BLOCK, samplings-block*_RESAMPLING_BLOCK)
+        noise = np.random.RandomState([seed,block]).standard_normal((len(x),size)).T
+        y_resampled = y + noise*err
+
+        if fittype=='poly':
+            t.append(_poly_minima(x, y_resampled, order, bound1, bound2))
+        elif fittype=='model':
+            t.append(_fit_model_shift(x, y_resampled, err, pol, shift_bound)[0])
+        else:
+            t_block = np.empty(size)
+            for k in range(size):
+                p_fit = LocalLinearSmoother(x, y_resampled[k], np.median(np.diff(x)))
+                t_block[k] = minimize_scalar(p_fit, bounds=(bound1, bound2), method='bounded').x
+            t.append(t_block)
 
-    return chi2
+    return np.concatenate(t)
 
-def mintime_parallel(params):
+def _poly_minima(x, y, order, bound1, bound2):
+    """
+    Fit polynomials to many resampled light curves at once
+    and find their minima between `bound1` and `bound2`.
+
+    Parameters
+    ----------
+    x : array
+        Times of the observations.
+    y : array
+        Resampled brightness values, one light curve per row.
+    order : int
+        Order of the polynomials.
+    bound1, bound2 : float
+        Interval to search for the minima.
+
+    Returns
+    -------
+    t : array
+        The location of the minimum of each polynomial.
     """
-    Refit minima with generating new observations from noise
+    y = np.atleast_2d(y)
+    nsamples = y.shape[0]
+
+    # One least squares fit for all light curves
+    with warnings.catch_warnings(record=True):
+        coeffs = np.polyfit(x,y.T,order).T
+
+    # Extrema are the roots of the derivatives, which are the
+    # eigenvalues of their companion matrices
+    dcoeffs = coeffs[:,:-1] * np.arange(order,0,-1)
+    candidates = [np.full((nsamples,1),bound1), np.full((nsamples,1),bound2)]
+    if order > 1:
+        degree = order-1
+        lead = dcoeffs[:,0]
+        good = lead != 0
+
+        companion = np.zeros((nsamples,degree,degree))
+        companion[:,0,:] = -dcoeffs[:,1:] / np.where(good,lead,1)[:,None]
+        companion[:,np.arange(1,degree),np.arange(degree-1)] = 1
+
+        roots = np.linalg.eigvals(companion[good])
+        roots = np.where((np.abs(roots.imag) < 1e-10) &
+                         (bound1 < roots.real) & (roots.real < bound2),
+                         roots.real, np.nan)
+
+        real_roots = np.full((nsamples,degree),np.nan)
+        real_roots[good] = roots
+        candidates.append(real_roots)
+
+    candidates = np.hstack(candidates)
+
+    # Evaluate all polynomials at their candidates by Horner's scheme
+    values = np.zeros_like(candidates)
+    for k in range(order+1):
+        values = values*candidates + coeffs[:,k,None]
+    values[np.isnan(candidates)] = np.inf
+
+    return candidates[np.arange(nsamples),np.argmin(values,axis=1)]
+
+def _fit_model_shift(x, y, err, pol, bound, ngrid=201, niter=10):
+    """
+    Fit the horizontal and vertical shift of the model to one or more
+    light curves, i.e. minimize the chi-square of ``pol(x + xoffset) + yoffset``
+    within ``-bound <= xoffset <= bound``.
+
+    The vertical shift is solved analytically for any horizontal shift.
+    The horizontal shift is found by cross-correlating the light curves
+    with the model on a grid of shifts, then refined by Newton iterations
+    using the derivatives of the model.
+
+    Parameters
+    ----------
+    x : array
+        Times of the observations.
+    y : array
+        Brightness values, or resampled light curves, one per row.
+    err : array
+        Errors of the brightness values.
+    pol : scipy.interpolate.CubicSpline
+        The model, see `OCFitter.get_model`.
+    bound : float
+        Maximum of the absolute horizontal shift.
+    ngrid : int, default: 201
+        Number of trial shifts.
+    niter : int, default: 10
+        Maximum number of Newton iterations.
+
+    Returns
+    -------
+    xoffset, yoffset : float or array
+        The fitted shifts. Arrays if `y` is 2-D.
+    """
+    single = np.ndim(y) == 1
+    y = np.atleast_2d(y)
+    nsamples = y.shape[0]
+
+    w = 1/err**2
+    W = w.sum()
+
+    def yshift(model):
+        return ((y-model)*w).sum(axis=1)/W
+
+    def chi2(model):
+        return (((y-model-yshift(model)[:,None])**2)*w).sum(axis=1)
+
+    # Chi2 of all shifts on the grid for all light curves at once,
+    # where the vertical shifts are profiled out
+    shifts = np.linspace(-bound,bound,ngrid)
+    step = shifts[1]-shifts[0]
+    models = pol(x[None,:] + shifts[:,None])
+
+    yw = y*w
+    chi2grid = (yw*y).sum(axis=1)[:,None] - 2*yw.dot(models.T) + (models**2*w).sum(axis=1)[None,:] \
+                - (yw.sum(axis=1)[:,None] - models.dot(w)[None,:])**2/W
+
+    best = np.argmin(chi2grid,axis=1)
+    s_grid = shifts[best]
+    lower = np.maximum(s_grid-step,-bound)
+    upper = np.minimum(s_grid+step, bound)
+
+    # Newton refinement around the best grid point
+    s = s_grid.copy()
+    for _ in range(niter):
+        u = x[None,:] + s[:,None]
+        model = pol(u)
+        d1 = pol(u,1)
+        d2 = pol(u,2)
+
+        residual = y - model - yshift(model)[:,None]
+        d1c = d1 - (d1*w).sum(axis=1)[:,None]/W
+
+        gradient = -2*(residual*d1*w).sum(axis=1)
+        gauss_newton = 2*(d1c**2*w).sum(axis=1)
+        hessian = gauss_newton - 2*(residual*d2*w).sum(axis=1)
+        hessian = np.where(hessian>0,hessian,gauss_newton)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            delta = np.where(hessian>0,-gradient/hessian,0)
+        s_new = np.clip(s+delta,lower,upper)
+
+        converged = np.all(np.abs(s_new-s) < 1e-10*step)
+        s = s_new
+        if converged:
+            break
+
+    # Keep the grid point if refinement did not improve the fit
+    refined = pol(x[None,:] + s[:,None])
+    worse = chi2(refined) > chi2grid[np.arange(nsamples),best]
+    s[worse] = s_grid[worse]
+
+    xoffset = s
+    yoffset = yshift(pol(x[None,:] + s[:,None]))
+
+    if single:
+        return xoffset[0], yoffset[0]
+    return xoffset, yoffset
+
+def _window(x, start, stop):
+    """
+    Slice of the sorted times `x` within ``start < x <= stop``.
+    """
+    return slice(np.searchsorted(x,start,side='right'),
+                 np.searchsorted(x,stop,side='right'))
+
+def _npoints(window):
+    return window.stop - window.start
+
+def _cycle_numbers(elapsed, period, data_length):
     """
-    fittype = params[-1]
-    if fittype=='model':
-        x,y,err,pol,zero_time,x0,y0 = params[:7]
-        phaseoffset,i,period = params[7:-1]
+    Assign cycle numbers to sorted minima.
+
+    The first minimum of a cycle is accepted if it is within `0.9*period`
+    of the calculated time. Cycle numbers never decrease, and cycles without
+    minima, e.g. in gaps, are skipped. The cycle number of each minimum is
+    the largest of the counter continued from the previous minimum and of
+    the first cycle that is close enough, which is a running maximum.
+
+    Parameters
+    ----------
+    elapsed : array
+        Time of minima since the epoch, sorted.
+    period : float
+        Period.
+    data_length : float
+        If the O-C exceeds it when skipping cycles, the minimum is not converged.
+
+    Returns
+    -------
+    cycles : array
+        Cycle numbers. `NaN` for minima that are not converged or fall
+        in a cycle that already has a minimum.
+    OC : array
+        O-C values. `NaN` where the cycle number is `NaN`.
+    """
+    n = len(elapsed)
+    cycles = np.full(n,np.nan)
+    OC = np.full(n,np.nan)
+
+    # First cycle with O-C not exceeding 0.9 period
+    first = np.ceil((elapsed-0.9*period)/period)
+    first[elapsed-first*period > 0.9*period] += 1
+    first[elapsed-(first-1)*period <= 0.9*period] -= 1
+
+    counter = 0
+    start = 0
+    keep = np.ones(n,dtype=bool)
+    while start < n:
+        k = np.arange(n-start)
+        # Counter at each minimum, if all following minima are accepted
+        assigned = np.maximum.accumulate(np.maximum(first[start:]-k, counter)) + k
+        counter_at = np.r_[counter, assigned[:-1]+1]
+
+        # Minima within a cycle already counted
+        early = np.where(elapsed[start:]-counter_at*period < -0.9*period)[0]
+        stop = n if len(early) == 0 else start+early[0]
+
+        cycles[start:stop] = assigned[:stop-start]
+
+        # Cycles skipped too far from the previous minimum are not converged
+        skipped = assigned[:stop-start] > counter_at[:stop-start]
+        firststep = elapsed[start:stop] - (counter_at[:stop-start]+1)*period
+        final = np.abs(elapsed[start:stop] - assigned[:stop-start]*period)
+        keep[start:stop] = ~(skipped & (np.maximum(firststep,final) > data_length))
+
+        if stop < n:
+            keep[stop] = False
+            counter = counter_at[stop-start]
+        start = stop+1
+
+    cycles[~keep] = np.nan
+    OC[keep] = elapsed[keep] - cycles[keep]*period
+
+    return cycles, OC
+
+@profiled('OC.cycle_fit')
+def _fit_cycle(x, y, err, mean_t, i, event, seed,
+               cadence, pm, zero_time, period, fittype, order, smoothness,
+               pol, phaseoffset, shift_bound, samplings, noise_seed, npools, debug):
+    """
+    Fit one minimum around the expected time `mean_t` of the `i`th cycle,
+    and estimate its error by refitting resampled observations.
+    `event` is the phase of the minimum relative to the epoch,
+    e.g. `0.5` for secondary minima.
+    The data is resampled with the noise of `noise_seed` if it is given,
+    otherwise with new random numbers.
+
+    `x`, `y` and `err` must contain at least the data within
+    `period/2 + 3*pm` around `mean_t`, sorted by time.
+
+    Returns
+    -------
+    result : dict or None
+        The minimum time `t`, its error `err`, the cycle number `i`, the `event`,
+        the slice of the fitted points `um` and the parameters of the fitted function.
+        `None` if the minimum could not be fitted.
+    """
+    from scipy.optimize import minimize_scalar
+
+    if debug:
+        import matplotlib.pyplot as plt
+
+    rng = np.random if seed is None else np.random.RandomState(seed)
+
+    # The model is shifted to the minimum of this event
+    if phaseoffset is not None:
+        phaseoffset = phaseoffset + event*period
+
+    xoffset = yoffset = z = None
+
+    # If duty cycle is lower than 20% do not fit
+    dutycycle = 0.2
+    um = _window(x, mean_t-pm, mean_t+pm)
+    if _npoints(um)<(pm/cadence*dutycycle):
+        return None
+
+    ###################################################
+    # First fit the data around expected minimum time #
+    ###################################################
+    if fittype=='nonparametric':
+        p = LocalLinearSmoother(x[um]-zero_time, y[um], smoothness*np.median(np.diff(x[um])))
+
+        try:
+            result = minimize_scalar(p, bounds=(mean_t-zero_time-pm, mean_t-zero_time+pm), method='bounded')
+        except np.linalg.LinAlgError as w:
+            warnings.warn( \
+                str(w) + "\nSkipping this minimum! Try to use a larger phase interval to avoid problems!")
+            return None
+
+        t_initial = result.x + zero_time
+    elif fittype=='model':
+        y0 = np.mean(y[um]) - np.mean(pol(x[um]-zero_time -(i-1)*period))
+        x0 = 0
+        xoffset,yoffset = _fit_model_shift(x[um]-zero_time -(i-1)*period, y[um], err[um], pol, shift_bound)
+
+        t_initial = zero_time +phaseoffset +(i-1)*period -xoffset
+
+        if debug:
+            plt.title('First fit')
+            plt.plot(x[um],y[um],'.')
+            xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
+            plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period+x0 ) + y0 ,'r',label='Initial')
+            plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period + xoffset) + yoffset,'k',label='Final fit')
+            plt.axvline(t_initial,c='r')
+            plt.xlim(x[um][0],x[um][-1])
+            #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
+            plt.legend()
+            plt.show()
+            plt.close('all')
     else:
-        x,y,order,zero_time = params[:4]
-        bound1, bound2 = params[4:-1]
+        with warnings.catch_warnings(record=True):
+            z = np.polyfit(x[um]-zero_time, y[um], order)
+        p = np.poly1d(z)
+
+        result = minimize_scalar(p, bounds=(mean_t-zero_time-pm, mean_t-zero_time+pm), method='bounded')
+        t_initial = result.x + zero_time
+
+        if debug:
+            plt.title('First fit')
+            plt.plot(x[um],y[um],'.')
+            xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
+            plt.plot(xtobeplotted,p(xtobeplotted-zero_time ) ,'r',label='Polyfit')
+            plt.axvline(t_initial,c='r')
+            plt.xlim(x[um][0],x[um][-1])
+            #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
+            plt.legend()
+            plt.show()
+            plt.close('all')
+
 
+    # Continue if duty cycle is lower than 20%
+    um = _window(x, t_initial-pm, t_initial+pm)
+    um_before = _window(x, t_initial-pm, t_initial)
+    um_after  = _window(x, t_initial, t_initial+pm)
+    if _npoints(um_before)<(pm/cadence*dutycycle) or _npoints(um_after)<(pm/cadence*dutycycle):
+        return None
+
+    ########################################################
+    # Second fit the data again around fitted minimum time #
+    ########################################################
     if fittype=='nonparametric':
-        ksrmv = KernelReg(endog=y, exog=x, var_type='c',
-                          reg_type='ll', bw=np.array([np.median(np.diff(x))]) )
-        p_fit = lambda x : ksrmv.fit(np.atleast_1d(x))[0][0] if isinstance(x,float) else ksrmv.fit(np.atleast_1d(x))[0]
+        p = LocalLinearSmoother(x[um]-zero_time, y[um], smoothness*np.median(np.diff(x[um])))
 
-        result = minimize_scalar(p_fit, bounds=(bound1, bound2), method='bounded')
+        result = minimize_scalar(p, bounds=(t_initial-zero_time-pm, t_initial-zero_time+pm), method='bounded')
         t = result.x + zero_time
     elif fittype=='model':
-        res = minimize(chi2model, (x0,y0), args=(x,y,err,pol) ,
-                       method='Powell',
-                       bounds=((-period*0.1,period*0.1),(-np.inf,np.inf)))
-
-        #yoffset = res.x[1]
-        xoffset = res.x[0]
+        y0 = yoffset
+        x0 = xoffset
+        xoffset,yoffset = _fit_model_shift(x[um]-zero_time-(i-1)*period, y[um], err[um], pol, period*0.1)
 
         t = zero_time +phaseoffset +(i-1)*period -xoffset
+
+        if debug:
+            plt.title('Second fit')
+            plt.plot(x[um],y[um],'.')
+            xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
+            plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period +x0)+y0 ,label='Initial')
+            plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period + xoffset) + yoffset ,label='Final fit')
+            plt.axvline(t,c='r')
+            plt.legend()
+            plt.show()
+            plt.close('all')
     else:
         with warnings.catch_warnings(record=True):
-            y_model = np.polyfit(x,y,order)
-            p_fit = np.poly1d(y_model)
+            z = np.polyfit(x[um]-zero_time, y[um], order)
+        p = np.poly1d(z)
 
-        result = minimize_scalar(p_fit, bounds=(bound1, bound2), method='bounded')
+        result = minimize_scalar(p, bounds=(t_initial-zero_time-pm, t_initial-zero_time+pm), method='bounded')
         t = result.x + zero_time
 
-    return t
+
+        if debug:
+            plt.title('Second fit')
+            plt.plot(x[um],y[um],'.')
+            xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
+            plt.plot(xtobeplotted,p(xtobeplotted-zero_time ) ,'r',label='Polyfit')
+            plt.axvline(t_initial,c='r')
+            plt.xlim(x[um][0],x[um][-1])
+            #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
+            plt.legend()
+            plt.show()
+            plt.close('all')
+
+    #######################
+    # Stopping conditions #
+    #######################
+    # Continue if the number of points is low (duty cycle is lower than 20%)
+    um_before = _window(x, t-pm, t)
+    um_after = _window(x, t, t+pm)
+    if _npoints(um_before)<(pm/cadence*0.2) or _npoints(um_after)<(pm/cadence*0.2) or _npoints(um)<(pm/cadence*0.2):
+        return None
+
+    # Continue if there are too few points
+    if _npoints(um) < 3:
+        return None
+
+    # Continue if fit is not a minimum
+    first_point = y[um][0]
+    last_point = y[um][-1]
+    middle_point = np.min(y[um][1:-1])
+    if not (middle_point<=first_point and middle_point<=last_point):
+        return None
+
+    ###########################################################
+    # Calculate error by sampling from y errors and refitting #
+    ###########################################################
+    OC_err = 0
+    if samplings > 0:
+        if noise_seed is None:
+            noise_seed = rng.randint(2**31)
+
+        # Workers generate and fit the resampled light curves block by block
+        if fittype=='model':
+            xfit = x[um]-zero_time-(i-1)*period
+        else:
+            xfit = x[um]-zero_time
+        # Several blocks per task, but at least one task per worker
+        nblocks = -(-samplings//_RESAMPLING_BLOCK)
+        per_task = max(1, min(nblocks//get_n_jobs(npools), _RESAMPLING_TASK//_RESAMPLING_BLOCK))
+        tasks = [range(start,min(start+per_task,nblocks)) for start in range(0,nblocks,per_task)]
+        t_trace = parallel_map(_resampled_minima, tasks,
+                               args=(xfit, y[um], err[um], noise_seed, samplings,
+                                     fittype, order, t-zero_time-pm, t-zero_time+pm, pol, period*0.1),
+                               n_jobs=npools, progress=False)
+        t_trace = np.concatenate(t_trace)
+
+        if fittype=='model':
+            t_trace = zero_time +phaseoffset +(i-1)*period -t_trace
+        else:
+            t_trace = t_trace + zero_time
+
+        OC_err = np.median(t_trace)-np.percentile(t_trace,15.9)
+
+    return {'i':i, 'event':event, 't':t, 'err':OC_err, 'um':um,
+            'xoffset':xoffset, 'yoffset':yoffset, 'coeffs':z}
+
+def _draw_minimum(fig, page):
+    """
+    Draw the fit of one minimum to a figure.
+    """
+    ax = fig.add_subplot(111)
+    ax.errorbar(page['x'],page['y'],yerr=page['err'],color='k',fmt='.',zorder=0,ecolor='lightgray')
+    ax.plot(page['model_x'],page['model_y'],c='r',zorder=10,label=page['label'])
+    ax.axvline(page['minimum'],zorder=0,label='Observed min')
+    if page['calculated'] is not None:
+        ax.axvline(page['calculated'],c='lightgray',zorder=0,label='Calculated')
+    fig.suptitle(page['title'])
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Brightness')
+    ax.legend()
+
+def _save_minima_pdf(filename, pages):
+    """
+    Save the fits of minima to a multi-page PDF.
+    Does not need a display or pyplot.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    with PdfPages(filename) as pp:
+        for page in pages:
+            fig = Figure()
+            _draw_minimum(fig,page)
+            fig.savefig(pp,format='pdf',dpi=300)
+
+    return filename
 
 class OCFitter:
     def __init__(self,time,flux,fluxerror,period):
@@ -84,11 +541,40 @@ class OCFitter:
         goodpts &= np.isfinite(flux)
         goodpts &= np.isfinite(fluxerror)
 
+        # Keep points sorted by time to select cycles by bisection
+        goodpts = np.where(goodpts)[0]
+        goodpts = goodpts[np.argsort(time[goodpts],kind='stable')]
+
         self.x = time[goodpts]
         self.y = flux[goodpts]
         self.err = fluxerror[goodpts]
 
+    @profiled('OC.model')
     def get_model(self,phase=0,show_plot=False,smoothness=1):
+        """
+        Build the light curve model used by `fittype='model'`
+        from the phase folded, vertically shifted and binned light curve.
+
+        Parameters
+        ----------
+        phase : float, default: 0
+            Location of the minimum. The model is centered on it.
+        show_plot : bool, default: False
+            Plot the model.
+        smoothness : float, default: 1
+            Bandwidth of the kernel regression in the units of the bin width.
+
+        Returns
+        -------
+        pol : scipy.interpolate.CubicSpline
+            The model as a periodic function of time. Its derivatives
+            are given by ``pol(x, 1)`` or ``pol.derivative()``.
+        phase : float
+            The location of the minimum.
+        """
+        from scipy.stats import binned_statistic
+        from scipy.interpolate import CubicSpline
+
         times = self.x.copy()
         zero_time = np.floor(times[0])
         times -= zero_time
@@ -116,12 +602,23 @@ class OCFitter:
         xbinned = xbinned[goodpts]
         ybinned = ybinned[goodpts]
 
-        # Get model fit
-        ksrmv = KernelReg(endog=ybinned, exog=xbinned, var_type='c',
-                          reg_type='ll', bw=smoothness*np.array([np.median(np.diff(xbinned))]) )
-        pol = lambda x : ksrmv.fit(np.atleast_1d(x))[0][0] if isinstance(x,float) else ksrmv.fit(np.atleast_1d(x))[0]
+        # Get model fit, repeating the binned phase curve
+        # to follow it continuously over the neighbouring periods
+        smoother = LocalLinearSmoother(np.r_[xbinned-period,xbinned,xbinned+period],
+                                       np.tile(ybinned,3),
+                                       smoothness*np.median(np.diff(xbinned)))
+
+        # Tabulate model on a dense grid over one period around the minimum,
+        # and interpolate it with a periodic cubic spline, which also
+        # repeats it beyond that period
+        phasegrid = np.linspace(phase-period/2, phase+period/2, 1001)
+        model = smoother(phasegrid)
+        model[-1] = model[0]
+        pol = CubicSpline(phasegrid, model, bc_type='periodic')
 
         if show_plot:
+            import matplotlib.pyplot as plt
+
             phasetoplot = times%period +phase -period/2
             x2plot = np.linspace(phasetoplot.min(),phasetoplot.max(),1000)
 
@@ -151,14 +648,18 @@ class OCFitter:
                     smoothness=1,
 
                     epoch='auto',
+                    phase_offsets=None,
 
-                    npools=-1,
+                    npools=None,
                     samplings=100,
+                    seed=None,
+                    parallel_cycles=False,
 
                     showplot=False,
                     saveplot=False,
                     showfirst=False,
                     filename='',
+                    background_plots=True,
 
                     debug=False):
         """
@@ -189,50 +690,206 @@ class OCFitter:
         epoch : float or 'auto'
             The time stamp of the first minimium.
             If `auto`, then it is inferred automatically by fitting a model.
-        npools : int, default: -1
+        phase_offsets : list of floats, optional
+            Phases of the fitted events relative to the epoch, e.g. ``[0, 0.5]``
+            to fit both primary and secondary minima of eclipsing binaries.
+            All events of a cycle are fitted in the same run.
+            If not given, only the minima at the epoch are fitted.
+        npools : int, default: None
             Number of cores during error estimation.
             If `-1`, then all cores are used.
+            If `None`, the global setting of `seismolab.parallel` is used.
         samplings : int, default: 100000
             Number of resamplings for error estimation.
+        seed : int, optional
+            If given, all minima are resampled with the same standard normal
+            noise generated from this seed and scaled by their errors
+            (common random numbers). The errors are then reproducible,
+            and do not depend on `npools` or `parallel_cycles`.
+        parallel_cycles : bool, default: False
+            If `True`, all cycles are fitted in parallel on `npools` cores,
+            instead of parallelizing the error estimation of each cycle.
+            Much faster for long light curves with many minima.
+            The errors are reproducible by setting `np.random.seed`,
+            but differ from the ones of the default mode.
         showplot : bool, default: False
             Show each fitted minima and other useful plots.
         saveplot : bool, default: True
             Save all plots.
         filename : str, default: ''
             Filename to be used to save plots.
+        background_plots : bool, default: True
+            If `True`, the PDF of the fitted minima is rendered in a background
+            process, and this function returns without waiting for it.
+            The `plot_job` attribute can be used to wait for the PDF, e.g.
+            ``fitter.plot_job.result()``.
         showfirst : bool, default: True
             Show epoch estimation and first cycle fit
             to check parameters of the fitted function.
 
         Returns:
         -------
-        times_of_minimum : array
+        times_of_minimum : array or list of arrays
             The calculated minimum times.
-        error_of_minimum : array
+            If `phase_offsets` is given, one array for each event.
+        error_of_minimum : array or list of arrays
             The error of the minimum times.
         """
 
         if fittype not in ['poly','nonparametric','model']:
             raise NameError('Fittype is not known! Use \'poly\', \'nonparametric\' or \'model\'.')
 
-        if npools == -1:
-            npools = cpu_count()
+        if showplot or showfirst:
+            import matplotlib.pyplot as plt
 
         print('Calculating minima times...')
-        if saveplot: pp = PdfPages(filename+'_minima_fit.pdf')
+
+        ncycles = self._setup_cycle_fit(fittype=fittype, phase_interval=phase_interval,
+                                        order=order, smoothness=smoothness, epoch=epoch,
+                                        npools=npools, samplings=samplings, seed=seed,
+                                        parallel_cycles=parallel_cycles,
+                                        phase_offsets=phase_offsets,
+                                        showplot=showplot, showfirst=showfirst, debug=debug)
+
+        x = self.x
+        y = self.y
+        err = self.err
+        period = self.period
+        zero_time = self._cycle_fit['zero_time']
+        pol = self.template
+
+        # Fit expected minima until the data is over
+        mean_ts, results = self._fit_cycles(np.arange(1,ncycles+1), debug=debug)
+
+        # Keep the fitted minima
+        fitted = [(mean_t,result) for mean_t,result in zip(mean_ts,results) if result is not None]
+        mintimes = [[result['t'],result['err']] for _,result in fitted]
+
+        #################
+        # Plot the fits #
+        #################
+        self.plot_job = None
+        if showplot or saveplot or showfirst:
+
+            with stage('OC.plotting'):
+                pages = []
+                first_epochs = {}
+                for mean_t,result in fitted:
+                    i = result['i']
+                    t = result['t']
+                    event = result['event']
+                    w = self._cycle_window(mean_t)
+                    um = slice(w.start+result['um'].start, w.start+result['um'].stop)
+
+                    if fittype=='model':
+                        xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 ) - zero_time
+                        ytobeplotted = pol(xtobeplotted +result['xoffset'] -(i-1)*period) + result['yoffset']
+                    else:
+                        if fittype=='poly':
+                            p = np.poly1d(result['coeffs'])
+                        else:
+                            p = LocalLinearSmoother(x[um]-zero_time, y[um], smoothness*np.median(np.diff(x[um])))
+                        xtobeplotted = np.linspace( (x[um]-zero_time).min(),(x[um]-zero_time).max(), 1000 )
+                        ytobeplotted = p(xtobeplotted)
+
+                    if len(pages) == 0:
+                        title = 'First cycle to check phase interval and model'
+                    else:
+                        title = '%d. cycle' % (i)
+                    if phase_offsets is not None:
+                        title += ' (phase %g)' % event
+
+                    # The first minimum of each event sets its calculated times
+                    if event not in first_epochs:
+                        first_epochs[event] = t-zero_time-(i-1)*period
+                        calculated = None
+                    else:
+                        calculated = first_epochs[event]+(i-1)*period
+
+                    pages.append({'x'          : x[um]-zero_time,
+                                  'y'          : y[um],
+                                  'err'        : err[um],
+                                  'model_x'    : xtobeplotted,
+                                  'model_y'    : ytobeplotted,
+                                  'label'      : 'Model' if fittype=='model' else fittype,
+                                  'minimum'    : t-zero_time,
+                                  'calculated' : calculated,
+                                  'title'      : title})
+
+                    # Only the first cycle is needed
+                    if not (showplot or saveplot):
+                        break
+
+                if showplot or showfirst:
+                    for page in (pages if showplot else pages[:1]):
+                        fig = plt.figure()
+                        _draw_minimum(fig,page)
+                        plt.show()
+                        plt.close(fig)
+
+                if saveplot:
+                    pdf_name = filename+'_minima_fit.pdf'
+                    if background_plots:
+                        print('Saving minima plots to %s in the background...' % pdf_name)
+                        self.plot_job = run_in_background(_save_minima_pdf, pdf_name, pages)
+                    else:
+                        _save_minima_pdf(pdf_name, pages)
+
+        mintimes = np.array(mintimes).reshape(-1,2)
+        time_of_minimum = mintimes[:,0]
+        err_of_minimum = mintimes[:,1]
+
+        print("Done!")
+
+        self.min_times = time_of_minimum
+        self.min_times_err = err_of_minimum
+        self.min_cycles = np.array([result['i'] for _,result in fitted],dtype=int)
+        self.min_events = np.array([result['event'] for _,result in fitted],dtype=float)
+
+        if phase_offsets is None:
+            return time_of_minimum,err_of_minimum
+
+        # Separate series for each event
+        events = [self.min_events==event for event in self._cycle_fit['phase_offsets']]
+        return [time_of_minimum[um] for um in events],[err_of_minimum[um] for um in events]
+
+    def _setup_cycle_fit(self, fittype, phase_interval, order, smoothness, epoch,
+                         npools, samplings, parallel_cycles, phase_offsets=None, seed=None,
+                         showplot=False, showfirst=False, debug=False):
+        """
+        Estimate the epoch and build the model for fitting the cycles.
+        See `fit_minima` for the parameters.
+
+        Returns
+        -------
+        ncycles : int
+            Number of cycles with expected minimum within the data.
+        """
+        if showplot or showfirst or debug:
+            import matplotlib.pyplot as plt
+        from scipy.optimize import minimize_scalar
+        from scipy.stats import binned_statistic
 
         x = self.x
         y = self.y
         err = self.err
         period = self.period
 
+        if phase_offsets is None:
+            phase_offsets = [0.]
+        phase_offsets = np.atleast_1d(np.asarray(phase_offsets,dtype=float))
+
+        # Half of the smallest phase difference between the events
+        phases = np.sort(phase_offsets%1)
+        gaps = np.diff(np.r_[phases,phases[0]+1])
+        if np.any(np.isclose(gaps,0)):
+            raise ValueError('Phase offsets must differ by a fraction of the period!')
+        shift_bound = period*min(0.5,np.min(gaps)/2)
+
         cadence = np.median(np.diff(x))
 
         zero_time = np.floor(x[0])
 
-        # List to store times of minima
-        mintimes = []
-
         ####################################################
         # Fit phase folded and binned lc to estimate epoch #
         ####################################################
@@ -264,29 +921,18 @@ class OCFitter:
             # Fit the data within this phase interval
             pm = period*max(0.1,phase_interval) #days
 
-            um=np.where((mean_t-pm<x) & (x<=mean_t+pm))[0]
+            um = _window(x, mean_t-pm, mean_t+pm)
 
             pol,phaseoffset = self.get_model(phase=mean_t-zero_time,show_plot=debug,smoothness=smoothness)
 
-            with warnings.catch_warnings(record=True):
-                y0 = np.mean(y[um]) - np.mean(pol(x[um]-zero_time))
-                x0 = 0
-                res = minimize(chi2model, (x0,y0),
-                               args=(x[um]-zero_time, y[um],err[um],pol),
-                               method='Powell',
-                               bounds=((-period*0.1,period*0.1),(-np.inf,np.inf)))
-
-            yoffset = res.x[1]
-            xoffset = res.x[0]
+            xoffset,yoffset = _fit_model_shift(x[um]-zero_time, y[um], err[um], pol, period*0.1)
 
             mean_t = mean_t - xoffset
 
             '''
 
             if fittype=='nonparametric':
-                ksrmv = KernelReg(endog=y[um], exog=x[um]-zero_time, var_type='c',
-                                  reg_type='ll', bw=np.array([np.median(np.diff(x[um]))]) )
-                p = lambda x : ksrmv.fit(np.atleast_1d(x))[0][0] if isinstance(x,float) else ksrmv.fit(np.atleast_1d(x))[0]
+                p = LocalLinearSmoother(x[um]-zero_time, y[um], np.median(np.diff(x[um])))
             else:
                 with warnings.catch_warnings(record=True):
                     z = np.polyfit(x[um]-zero_time, y[um], 5)
@@ -325,283 +971,307 @@ class OCFitter:
         # Fit each cycle to get minimum times #
         #######################################
 
-        # Initialize progress bar
-        _total = np.sum(np.diff(x[y<np.mean(y)]%period/period)<0)
-        pbar = tqdm(total=_total,desc='Fitting cycles')
-
         # Range to be fitted around the expected minimum:
         pm = period*phase_interval #days
 
         if fittype=='model':
             pol,phaseoffset = self.get_model(phase=mean_t-zero_time,smoothness=smoothness,
                                              show_plot=showfirst or showplot)
+        else:
+            pol = phaseoffset = None
+
+        # Keep everything needed to fit further cycles
+        self.template = pol
+        self._cycle_fit = {'fittype'         : fittype,
+                           'pm'              : pm,
+                           'order'           : order,
+                           'smoothness'      : smoothness,
+                           'samplings'       : samplings,
+                           'seed'            : seed,
+                           'npools'          : npools,
+                           'parallel_cycles' : parallel_cycles,
+                           'pol'             : pol,
+                           'phaseoffset'     : phaseoffset,
+                           'phase_offsets'   : phase_offsets,
+                           'shift_bound'     : shift_bound,
+                           'zero_time'       : zero_time,
+                           'cadence'         : cadence,
+                           'first_min'       : mean_t,
+                           'quadratic'       : 0.}
+
+        # Number of expected minima until the data is over
+        return self._last_cycle()
+
+    def _cycle_window(self, mean_t):
+        """
+        Data to be passed for fitting the cycle with expected minimum at `mean_t`.
+        """
+        margin = self.period/2 + 3*self._cycle_fit['pm']
+        return _window(self.x, mean_t-margin, mean_t+margin)
 
-        i=1 #First minimum
-        firstmin = True
-        while True:
-            # If duty cycle is lower than 20% do not fit
-            dutycycle = 0.2
-            um = np.where((mean_t-pm<x) & (x<=mean_t+pm)  )[0]
-            if len(x[um])<(pm/cadence*dutycycle):
-                mean_t = mean_t + period
-                i=i+1
-                if mean_t> np.max(x):
-                    break
-                else:
-                    continue
-
-            ###################################################
-            # First fit the data around expected minimum time #
-            ###################################################
-            if fittype=='nonparametric':
-                ksrmv = KernelReg(endog=y[um], exog=x[um]-zero_time, var_type='c',
-                                  reg_type='ll', bw=smoothness*np.array([np.median(np.diff(x[um]))]) )
-                p = lambda x : ksrmv.fit(np.atleast_1d(x))[0][0] if isinstance(x,float) else ksrmv.fit(np.atleast_1d(x))[0]
-
-                try:
-                    result = minimize_scalar(p, bounds=(mean_t-zero_time-pm, mean_t-zero_time+pm), method='bounded')
-                except np.linalg.LinAlgError as w:
-                    warnings.warn( \
-                        str(w) + "\nSkipping this minimum! Try to use a larger phase interval to avoid problems!")
-
-                    mean_t = mean_t + period
-                    i=i+1
-                    continue
-
-                t_initial = result.x + zero_time
-            elif fittype=='model':
-                with warnings.catch_warnings(record=True):
-                    y0 = np.mean(y[um]) - np.mean(pol(x[um]-zero_time -(i-1)*period))
-                    x0 = 0
-                    res = minimize(chi2model, (x0,y0),
-                                   args=(x[um]-zero_time -(i-1)*period , y[um],err[um],pol),
-                                   method='Powell',
-                                   bounds=((-period/2,period/2),(-np.inf,np.inf)))
-
-                yoffset = res.x[1]
-                xoffset = res.x[0]
-
-                t_initial = zero_time +phaseoffset +(i-1)*period -xoffset
-
-                if debug:
-                    plt.title('First fit')
-                    plt.plot(x[um],y[um],'.')
-                    xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
-                    plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period+x0 ) + y0 ,'r',label='Initial')
-                    plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period + xoffset) + yoffset,'k',label='Final fit')
-                    plt.axvline(t_initial,c='r')
-                    plt.xlim(x[um][0],x[um][-1])
-                    #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
-                    plt.legend()
-                    plt.show()
-                    plt.close('all')
-            else:
-                with warnings.catch_warnings(record=True):
-                    z = np.polyfit(x[um]-zero_time, y[um], order)
-                p = np.poly1d(z)
+    def _expected_times(self, cycles, events=0):
+        """
+        Expected minimum times of the given cycles and events.
+        The 1st cycle starts at the epoch of the fit.
+        """
+        fit = self._cycle_fit
+        cycles = np.asarray(cycles)
+        return fit['first_min'] + (cycles-1+events)*self.period + fit['quadratic']*(cycles-1)**2
 
-                result = minimize_scalar(p, bounds=(mean_t-zero_time-pm, mean_t-zero_time+pm), method='bounded')
-                t_initial = result.x + zero_time
-
-                if debug:
-                    plt.title('First fit')
-                    plt.plot(x[um],y[um],'.')
-                    xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
-                    plt.plot(xtobeplotted,p(xtobeplotted-zero_time ) ,'r',label='Polyfit')
-                    plt.axvline(t_initial,c='r')
-                    plt.xlim(x[um][0],x[um][-1])
-                    #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
-                    plt.legend()
-                    plt.show()
-                    plt.close('all')
-
-
-            # Continue if duty cycle is lower than 20%
-            um = np.where((t_initial-pm<x) & (x<=t_initial+pm)  )
-            um_before = np.where((t_initial-pm<x) & (x<=t_initial)  )
-            um_after  = np.where((t_initial<x) & (x<=t_initial+pm)  )
-            if len(x[um_before])<(pm/cadence*dutycycle) or len(x[um_after])<(pm/cadence*dutycycle):
-                mean_t = mean_t + period
-                i=i+1
-
-                continue
-
-            ########################################################
-            # Second fit the data again around fitted minimum time #
-            ########################################################
-            if fittype=='nonparametric':
-                ksrmv = KernelReg(endog=y[um], exog=x[um]-zero_time, var_type='c',
-                                  reg_type='ll', bw=smoothness*np.array([np.median(np.diff(x[um]))]) )
-                p = lambda x : ksrmv.fit(np.atleast_1d(x))[0][0] if isinstance(x,float) else ksrmv.fit(np.atleast_1d(x))[0]
+    def _last_cycle(self):
+        """
+        The last cycle with expected minimum within the data.
+        """
+        first_min = self._cycle_fit['first_min']
+        last = max(0, int(np.floor((np.max(self.x)-first_min)/self.period)) + 1)
 
-                result = minimize_scalar(p, bounds=(t_initial-zero_time-pm, t_initial-zero_time+pm), method='bounded')
-                t = result.x + zero_time
-            elif fittype=='model':
-                with warnings.catch_warnings(record=True):
-                    y0 = yoffset
-                    x0 = xoffset
-                    res = minimize(chi2model, (x0,y0),
-                                   args=(x[um]-zero_time-(i-1)*period , y[um],err[um],pol),
-                                   method='Powell',
-                                   bounds=((-period*0.1,period*0.1),(-np.inf,np.inf)))
-
-                yoffset = res.x[1]
-                xoffset = res.x[0]
-
-                t = zero_time +phaseoffset +(i-1)*period -xoffset
-
-                if debug:
-                    plt.title('Second fit')
-                    plt.plot(x[um],y[um],'.')
-                    xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
-                    plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period +x0)+y0 ,label='Initial')
-                    plt.plot(xtobeplotted,pol(xtobeplotted-zero_time-(i-1)*period + xoffset) + yoffset ,label='Final fit')
-                    plt.axvline(t,c='r')
-                    plt.legend()
-                    plt.show()
-                    plt.close('all')
-            else:
-                with warnings.catch_warnings(record=True):
-                    z = np.polyfit(x[um]-zero_time, y[um], order)
-                p = np.poly1d(z)
+        # Correct for the quadratic term of the ephemeris
+        while self._expected_times(last+1) <= np.max(self.x):
+            last += 1
+        while last > 0 and self._expected_times(last) > np.max(self.x):
+            last -= 1
+        return last
 
-                result = minimize_scalar(p, bounds=(t_initial-zero_time-pm, t_initial-zero_time+pm), method='bounded')
-                t = result.x + zero_time
-
-
-                if debug:
-                    plt.title('Second fit')
-                    plt.plot(x[um],y[um],'.')
-                    xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
-                    plt.plot(xtobeplotted,p(xtobeplotted-zero_time ) ,'r',label='Polyfit')
-                    plt.axvline(t_initial,c='r')
-                    plt.xlim(x[um][0],x[um][-1])
-                    #plt.ylim(y[um].min() - 0.1*y[um].ptp(), y[um].max() + 0.1*y[um].ptp() )
-                    plt.legend()
-                    plt.show()
-                    plt.close('all')
-
-            #######################
-            # Stopping conditions #
-            #######################
-            # Break if the data is over
-            if mean_t> np.max(x):
-                break
+    def _fit_cycles(self, cycles, debug=False, progress=None, seeds=None):
+        """
+        Fit the minima of the given cycles with the settings of `fit_minima`.
+        The first fitted cycle of `fit_minima` is the 1st one.
+        All events (phase offsets) of a cycle are fitted one after the other.
+        If `seeds` are given, each minimum uses its own random numbers.
 
-            # Continue if the number of points is low (duty cycle is lower than 20%)
-            um_before = np.where((t-pm<x) & (x<=t)  )
-            um_after = np.where((t<x) & (x<=t+pm)  )
-            if len(x[um_before])<(pm/cadence*0.2) or len(x[um_after])<(pm/cadence*0.2) or len(x[um])<(pm/cadence*0.2):
-                mean_t = mean_t + period
-                i=i+1
-
-                continue
-
-            # Continue if there are too few points
-            if len(y[um]) < 3:
-                mean_t = mean_t + period
-                i=i+1
-
-                continue
-
-            # Continue if fit is not a minimum
-            first_point = y[um][0]
-            last_point = y[um][-1]
-            middle_point = np.min(y[um][1:-1])
-            if not (middle_point<=first_point and middle_point<=last_point):
-                mean_t = mean_t + period
-                i=i+1
-
-                continue
-
-            ###########################################################
-            # Calculate error by sampling from y errors and refitting #
-            ###########################################################
-            z_fit_parallel = []
-            if fittype=='model':
-                for _ in range(samplings):
-                    y_resampled = y[um] + np.random.normal(loc=0,scale=err[um],size=err[um].shape[0])
-                    z_fit_parallel.append([x[um]-zero_time-(i-1)*period, y_resampled, err[um], pol, zero_time,
-                                           xoffset, yoffset, phaseoffset, i, period, fittype ])
-            else:
-                for _ in range(samplings):
-                    y_resampled = y[um] + np.random.normal(loc=0,scale=err[um],size=err[um].shape[0])
-                    z_fit_parallel.append([x[um]-zero_time, y_resampled, order, zero_time, t-zero_time-pm, t-zero_time+pm , fittype ])
+        Returns
+        -------
+        mean_ts : array
+            The expected minimum times.
+        results : list
+            The output of `_fit_cycle` for each minimum.
+        """
+        fit = self._cycle_fit
+        x = self.x
+        y = self.y
+        err = self.err
+        period = self.period
+        npools = fit['npools']
+
+        # Every event of every cycle
+        events = fit['phase_offsets']
+        cycles, events = np.repeat(np.asarray(cycles,dtype=int),len(events)), np.tile(events,len(cycles))
+        mean_ts = self._expected_times(cycles, events)
+
+        if fit['parallel_cycles'] and not debug:
+            # Fit cycles in parallel, each with its own random numbers
+            if seeds is None:
+                seeds = np.random.randint(1e09,size=len(mean_ts))
+            cycle_jobs, resampling_jobs = npools, 1
+        else:
+            if seeds is None:
+                seeds = [None]*len(mean_ts)
+            cycle_jobs, resampling_jobs = 1, npools
 
-            t_trace = Parallel(n_jobs=npools)(delayed(mintime_parallel)(par) for par in z_fit_parallel)
-            t_trace = np.array(t_trace)
+        tasks = ( (x[w], y[w], err[w], mean_ts[k], cycles[k], events[k], seeds[k])
+                  for k,w in enumerate(map(self._cycle_window,mean_ts)) )
 
-            try:
-                del z_fit_parallel
-                del y_resampled
-
-                OC_err = np.median(t_trace)-np.percentile(t_trace,15.9)
-            except UnboundLocalError:
-                OC_err = 0
-
-            #Append minimum time
-            mintimes.append([t,OC_err])
-
-            ################
-            # Plot the fit #
-            ################
-            #plt.plot(x-zero_time,y,'o',c='gray')
-            plt.errorbar(x[um]-zero_time,y[um],yerr=err[um],color='k',fmt='.',zorder=0,ecolor='lightgray')
-            #plt.plot(x[um_before]-zero_time,y[um_before],'m.',zorder=5)
-            if fittype=='model':
-                xtobeplotted = np.linspace( x[um].min(),x[um].max(), 1000 )
-                plt.plot(xtobeplotted-zero_time,pol(xtobeplotted-zero_time +xoffset -(i-1)*period)+yoffset ,c='r',zorder=10,label='Model')
-            else:
-                xtobeplotted = np.linspace( (x[um]-zero_time).min(),(x[um]-zero_time).max(), 1000 )
-                plt.plot(xtobeplotted,p(xtobeplotted),c='r',zorder=10,label=fittype)
-            plt.axvline(t-zero_time,zorder=0,label='Observed min')
-            if firstmin:
-                plt.suptitle('First cycle to check phase interval and model')
-                epoch = t-zero_time-(i-1)*period
-            else:
-                plt.suptitle('%d. cycle' % (i))
-                plt.axvline(epoch+(i-1)*period,c='lightgray',zorder=0,label='Calculated')
-            #plt.axvline(t_initial_final-zero_time)
-            plt.xlabel('Time')
-            plt.ylabel('Brightness')
-            plt.legend()
-            if saveplot: plt.savefig(pp,format='pdf',dpi=300)
-            if showplot or (firstmin and showfirst): plt.show()
-            plt.close()
+        results = parallel_map(_fit_cycle, tasks, star=True,
+                               args=(fit['cadence'], fit['pm'], fit['zero_time'], period,
+                                     fit['fittype'], fit['order'], fit['smoothness'],
+                                     fit['pol'], fit['phaseoffset'], fit['shift_bound'],
+                                     fit['samplings'], fit['seed'], resampling_jobs, debug),
+                               n_jobs=cycle_jobs, total=len(mean_ts), desc='Fitting cycles',
+                               progress=progress)
 
-            firstmin = False
+        return mean_ts, results
 
-            ############################
-            # Step to the next minimum #
-            ############################
-            pbar.update()
+    def update(self,new_time,new_flux,new_fluxerror,debug=False):
+        """
+        Add new observations and fit only the cycles they overlap with,
+        using the settings, epoch and model of the last `fit_minima` call.
 
-            mean_t = mean_t + period
-            i=i+1
-            #If the data is over, break
-            if mean_t > np.max(x):
-                break
+        The new minima replace earlier ones of the same cycles and events,
+        others are appended. Call `calculate_OC` to get the updated O-C.
 
-        pbar.close()
+        Parameters
+        ----------
+        new_time : array
+            New light curve time points.
+        new_flux : array
+            Corresponding flux/mag values.
+        new_fluxerror : array
+            Corresponding flux/mag error values.
 
-        if saveplot: pp.close()
+        Returns:
+        -------
+        times_of_minimum : array
+            The minimum times of the refitted cycles, of all events.
+        error_of_minimum : array
+            The error of these minimum times.
+        """
+        if not hasattr(self,'_cycle_fit'):
+            raise ValueError('No minima to be updated! Run `fit_minima` first.')
+
+        new_time = np.asarray(new_time,dtype=float)
+        new_flux = np.asarray(new_flux,dtype=float)
+        new_fluxerror = np.asarray(new_fluxerror,dtype=float)
+
+        goodpts = np.isfinite(new_time)
+        goodpts &= np.isfinite(new_flux)
+        goodpts &= np.isfinite(new_fluxerror)
+
+        order = np.argsort(new_time[goodpts],kind='stable')
+        new_time = new_time[goodpts][order]
+        new_flux = new_flux[goodpts][order]
+        new_fluxerror = new_fluxerror[goodpts][order]
+
+        if len(new_time) == 0:
+            return np.array([]),np.array([])
+
+        # Insert new points keeping the data sorted
+        if new_time[0] >= self.x[-1]:
+            self.x = np.r_[self.x,new_time]
+            self.y = np.r_[self.y,new_flux]
+            self.err = np.r_[self.err,new_fluxerror]
+        else:
+            at = np.searchsorted(self.x,new_time,side='right')
+            self.x = np.insert(self.x,at,new_time)
+            self.y = np.insert(self.y,at,new_flux)
+            self.err = np.insert(self.err,at,new_fluxerror)
 
-        mintimes = np.array(mintimes)
-        time_of_minimum = mintimes[:,0]
-        err_of_minimum = mintimes[:,1]
+        # Cycles with the fitting window of any event overlapping the new data,
+        # searched from the first cycle or the new data, whichever is earlier
+        period = self.period
+        events = self._cycle_fit['phase_offsets']
+        margin = period/2 + 3*self._cycle_fit['pm']
 
-        print("Done!")
+        first = int(np.floor((new_time[0]-margin-self._cycle_fit['first_min'])/period - np.max(events)))
+        cycles = np.arange(min(first,1), self._last_cycle()+1)
+        expected = self._expected_times(cycles[:,None], events[None,:])
+        overlap = (expected >= new_time[0]-margin) & (expected <= new_time[-1]+margin)
+        cycles = cycles[np.any(overlap,axis=1)]
 
-        self.min_times = time_of_minimum
-        self.min_times_err = err_of_minimum
+        _, results = self._fit_cycles(cycles, debug=debug)
+
+        return self._replace_minima(cycles, results)
+
+    def _replace_minima(self, cycles, results):
+        """
+        Replace the minima of the refitted `cycles` with the new `results`
+        of `_fit_cycles`, and return the new minimum times and errors.
+        """
+        fitted = [result for result in results if result is not None]
+        new_cycles = np.array([result['i'] for result in fitted],dtype=int)
+        new_events = np.array([result['event'] for result in fitted],dtype=float)
+        mintimes = np.array([[result['t'],result['err']] for result in fitted]).reshape(-1,2)
+
+        # Replace refitted cycles and keep minima ordered by cycle
+        keep = ~np.isin(self.min_cycles,cycles)
+        min_cycles = np.r_[self.min_cycles[keep],new_cycles]
+        min_events = np.r_[self.min_events[keep],new_events]
+        min_times = np.r_[self.min_times[keep],mintimes[:,0]]
+        min_times_err = np.r_[self.min_times_err[keep],mintimes[:,1]]
+
+        # Events of a cycle in the order of `phase_offsets`
+        rank = np.argmax(min_events[:,None]==self._cycle_fit['phase_offsets'][None,:],axis=1)
+        order = np.lexsort((rank,min_cycles))
+        self.min_cycles = min_cycles[order]
+        self.min_events = min_events[order]
+        self.min_times = min_times[order]
+        self.min_times_err = min_times_err[order]
+
+        return mintimes[:,0],mintimes[:,1]
+
+    def refine_ephemeris(self, quadratic=False, tolerance=None, phase_offset=None,
+                         maxiter=10, debug=False):
+        """
+        Refine the period and epoch by fitting an ephemeris to the minima
+        of the last `fit_minima` call, then refit only those cycles whose
+        expected minimum moved more than `tolerance`, until convergence.
+
+        The ephemeris is ``epoch + period*E + quadratic*E**2``, where `E`
+        counts the cycles from the first one of `fit_minima`.
+        The period, the epoch and the minima are updated in place,
+        `calculate_OC` uses the refined values afterwards.
+
+        Parameters
+        ----------
+        quadratic : bool, default: False
+            Fit a quadratic ephemeris, i.e. a constant period change.
+        tolerance : float, optional
+            Cycles are refitted if their expected minimum moved more than
+            this. By default, the cadence of the light curve is used.
+        phase_offset : float, optional
+            The event of `fit_minima` used to fit the ephemeris.
+            By default, the first of its `phase_offsets` is used.
+        maxiter : int, default: 10
+            Maximum number of refitting iterations.
+
+        Returns:
+        -------
+        epoch : float
+            The refined epoch.
+        period : float
+            The refined period.
+        quadratic : float
+            The quadratic term of the ephemeris. Returned only if `quadratic` is set.
+        """
+        if not hasattr(self,'_cycle_fit'):
+            raise ValueError('No minima to be refined! Run `fit_minima` first.')
+
+        fit = self._cycle_fit
+        if tolerance is None:
+            tolerance = fit['cadence']
+        if phase_offset is None:
+            phase_offset = fit['phase_offsets'][0]
+        events = fit['phase_offsets']
+        degree = 2 if quadratic else 1
+
+        for _ in range(maxiter):
+            um = self.min_events==phase_offset
+            if np.sum(um) <= degree:
+                raise ValueError('Too few minima to fit the ephemeris!')
+
+            # Weighted least squares fit of the ephemeris
+            E = self.min_cycles[um] - 1
+            errors = self.min_times_err[um]
+            weights = 1/errors if np.all(errors>0) else None
+            coeffs = np.polyfit(E, self.min_times[um], degree, w=weights)[::-1]
+
+            old_cycles = np.arange(1,self._last_cycle()+1)
+            old_times = self._expected_times(old_cycles[:,None], events[None,:])
+
+            fit['first_min'] = coeffs[0] - phase_offset*coeffs[1]
+            self.period = coeffs[1]
+            fit['quadratic'] = coeffs[2] if quadratic else 0.
+
+            # Cycles with moved windows, or just within the data
+            cycles = np.arange(1,self._last_cycle()+1)
+            times = self._expected_times(cycles[:,None], events[None,:])
+            moved = np.ones(len(cycles),dtype=bool)
+            common = min(len(cycles),len(old_cycles))
+            moved[:common] = np.any(np.abs(times[:common]-old_times[:common]) > tolerance, axis=1)
+
+            # Drop minima of cycles out of the data
+            if len(cycles) < len(old_cycles):
+                self._replace_minima(old_cycles[len(cycles):], [])
+
+            if not np.any(moved):
+                break
+
+            _, results = self._fit_cycles(cycles[moved], debug=debug)
+            self._replace_minima(cycles[moved], results)
+        else:
+            warnings.warn('Ephemeris did not converge in %d iterations!' % maxiter)
 
-        return time_of_minimum,err_of_minimum
+        self.epoch = fit['first_min']
+
+        if quadratic:
+            return self.epoch, self.period, fit['quadratic']
+        return self.epoch, self.period
 
     def calculate_OC(self,
                     min_times=None,
                     period=None,
                     epoch=None,
                     min_times_err=None,
+                    phase_offset=None,
 
                     showplot=False,
                     saveplot=False,
@@ -622,6 +1292,10 @@ class OCFitter:
             used as epoch.
         min_times_err : array, optional
             Error of observed (O) times of minima.
+        phase_offset : float, optional
+            The event of `fit_minima` to be used if `min_times` is not given,
+            e.g. `0.5` for secondary minima. The epoch is shifted accordingly.
+            By default, the first of its `phase_offsets` is used.
 
         showplot : bool, default: False
             Show results.
@@ -637,28 +1311,43 @@ class OCFitter:
         mid_times : array
             The given minimum times.
         OC : array
-            The calculated O-C values.
+            The calculated O-C values. `NaN` for minima that cannot be
+            assigned to a cycle, e.g. a second minimum within the same cycle.
         OCerr : array
             If `min_times_err` was given, the error of the O-C values.
         """
+        import matplotlib.pyplot as plt
+
         print('Calculating the O-C...')
 
-        if min_times is None:
-            min_times = self.min_times
-            min_times_err = self.min_times_err
+        if period is None:
+            period = self.period
+        period = float(period)
 
         if epoch is None:
             epoch = self.epoch
 
-        if period is None:
-            period = self.period
-        period = float(period)
+        if min_times is None:
+            min_times = self.min_times
+            min_times_err = self.min_times_err
 
-        min_times = min_times[ min_times.argsort() ]
+            # Select the minima of one event
+            if hasattr(self,'min_events'):
+                if phase_offset is None:
+                    phase_offset = self._cycle_fit['phase_offsets'][0]
+                um = self.min_events==phase_offset
+                if not np.any(um):
+                    raise ValueError('No minima with phase offset %g!' % phase_offset)
+                min_times = min_times[um]
+                min_times_err = min_times_err[um]
+
+        if epoch is not None and phase_offset is not None:
+            epoch = epoch + phase_offset*period
+
+        order = np.argsort(min_times)
+        min_times = np.asarray(min_times,dtype=float)[order]
         if min_times_err is not None:
-            min_times_err = min_times_err[ min_times.argsort() ]
-
-        OC_all = [] #List to store OC values
+            min_times_err = np.asarray(min_times_err,dtype=float)[order]
 
         if epoch is None:
             t0 = min_times.min()
@@ -667,25 +1356,10 @@ class OCFitter:
 
         data_length = min_times.max() - min_times.min()
 
-        i=0
-        for t in min_times:
-            #Calculate O-C value
-            OC = (t-t0)-i*period
-            while True:
-                if np.abs(OC)>0.9*period:
-                    i=i+1
-                    OC = (t-t0)-i*period
-                    if np.abs(OC) > data_length:
-                        # if OC value not converged
-                        OC = np.nan
-                        break
-                    continue
-                else:
-                    break
-            i=i+1
-            OC_all.append( np.array([t,OC]) )
+        #Calculate O-C values
+        _,OC = _cycle_numbers(min_times-t0, period, data_length)
 
-        OC_all = np.array(OC_all)
+        OC_all = np.c_[min_times,OC]
         if min_times_err is not None and saveOC:
             np.savetxt(filename+'_OC.txt',np.c_[ OC_all,min_times_err] )
         elif saveOC:
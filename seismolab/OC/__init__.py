@@ -1 +1,3 @@
-from .OC import *
\ No newline at end of file
+from .OC import *
+from .store import *
+from .batch import *
@@ -0,0 +1,226 @@
+import copy
+import warnings
+import numpy as np
+
+from .OC import OCFitter, _window, _cycle_numbers
+from .store import MinimaStore
+from ..parallel import parallel_map, get_config
+
+__all__ = ['fit_minima_batch','read_minima_batch']
+
+def _setup_star(fitter, epoch, settings):
+    """
+    Estimate the epoch and build the model of one star.
+    """
+    try:
+        ncycles = fitter._setup_cycle_fit(epoch=epoch, **settings)
+    except (ValueError, RuntimeError, np.linalg.LinAlgError) as e:
+        return None, None, repr(e)
+    return fitter._cycle_fit, ncycles, None
+
+def _fit_star_cycles(k, fitter, cycles, seed):
+    """
+    Fit a chunk of cycles of one star.
+    """
+    seeds = np.random.RandomState(seed).randint(1e09,size=len(cycles))
+    _, results = fitter._fit_cycles(cycles, progress=False, seeds=seeds)
+    return k, [(result['i'],result['t'],result['err']) for result in results if result is not None]
+
+def fit_minima_batch(stars,
+                     names=None,
+                     fittype='model',
+                     phase_interval=0.1,
+                     order=3,
+                     smoothness=1,
+                     epoch='auto',
+                     samplings=100,
+                     cycles_per_task=50,
+                     seed=None,
+                     n_jobs=None,
+                     progress=None,
+                     filename=None):
+    """
+    Fit minima and calculate O-C of many stars at once.
+
+    First the epoch and the model of each star are determined, then
+    chunks of cycles of all stars are fitted on a shared pool of workers.
+
+    Parameters
+    ----------
+    stars : list of tuples
+        The ``(time, flux, fluxerror, period)`` of each star.
+    names : list, optional
+        Identifiers of the stars. Default is their index.
+    fittype : 'poly', 'nonparametric' or 'model'
+        The type of the fitted function. See `OCFitter.fit_minima`.
+    phase_interval : float
+        The phase interval around an expected minimum to be fitted.
+    order : int
+        Order of the polynomial, if `fittype` is `poly`.
+    smoothness : float
+        The smoothness of the nonparametric function or model.
+    epoch : 'auto' or list of floats
+        The time of the first minimum of each star.
+        If `auto`, they are inferred automatically.
+    samplings : int, default: 100
+        Number of resamplings for error estimation.
+    cycles_per_task : int, default: 50
+        Number of cycles fitted together by a worker.
+    seed : int, optional
+        Seed of the random numbers of the error estimation.
+        The results do not depend on the number of workers.
+    n_jobs : int, default: None
+        Number of workers. If `None`, the global setting of `seismolab.parallel` is used.
+    progress : bool, default: None
+        Show one progress bar of the stars prepared and the chunks of cycles fitted.
+        If `None`, the global setting of `seismolab.parallel` is used.
+    filename : str, optional
+        If given, the minima and the fit settings are saved to this HDF5 file
+        as a `MinimaStore`. Use `read_minima_batch` to load the table.
+
+    Returns
+    -------
+    table : astropy.table.Table
+        One row per minimum with the columns `star`, `time`, `err`,
+        `cycle` and `OC`, sorted by star and time. The cycle numbers and
+        O-C values are calculated as in `OCFitter.calculate_OC`.
+    """
+    from astropy.table import Table
+
+    if fittype not in ['poly','nonparametric','model']:
+        raise NameError('Fittype is not known! Use \'poly\', \'nonparametric\' or \'model\'.')
+
+    fitters = [OCFitter(*star) for star in stars]
+    if names is None:
+        names = np.arange(len(fitters))
+    if len(names) != len(fitters):
+        raise ValueError('The number of names and stars must be the same!')
+    epochs = [epoch]*len(fitters) if isinstance(epoch,str) else list(epoch)
+
+    settings = {'fittype'         : fittype,
+                'phase_interval'  : phase_interval,
+                'order'           : order,
+                'smoothness'      : smoothness,
+                'npools'          : 1,
+                'samplings'       : samplings,
+                'parallel_cycles' : False}
+
+    # Both steps advance the same progress bar
+    if progress is None:
+        progress = get_config()['progress']
+    bar = False
+    if progress:
+        from tqdm.auto import tqdm
+        bar = tqdm(total=len(fitters), desc='Preparing stars')
+
+    ######################################
+    # Epoch and model of each star first #
+    ######################################
+    setups = parallel_map(_setup_star, zip(fitters,epochs), star=True, args=(settings,),
+                          n_jobs=n_jobs, progress=bar, total=len(fitters))
+
+    ##########################################
+    # Then all cycles on the same workers #
+    ##########################################
+    rng = np.random.RandomState(seed)
+
+    tasks = []
+    for k,(fitter,(cycle_fit,ncycles,error)) in enumerate(zip(fitters,setups)):
+        if error is not None:
+            warnings.warn('Skipping star %s: %s' % (names[k],error))
+            continue
+        fitter._cycle_fit = cycle_fit
+        fitter.epoch = None if isinstance(epochs[k],str) else epochs[k]
+
+        margin = fitter.period/2 + 3*cycle_fit['pm']
+        for start in range(1, ncycles+1, cycles_per_task):
+            cycles = np.arange(start, min(start+cycles_per_task,ncycles+1))
+
+            # Pass only the data of these cycles
+            window = _window(fitter.x,
+                             cycle_fit['first_min'] + (cycles[0]-1)*fitter.period - margin,
+                             cycle_fit['first_min'] + (cycles[-1]-1)*fitter.period + margin)
+            chunk = copy.copy(fitter)
+            chunk.x = fitter.x[window]
+            chunk.y = fitter.y[window]
+            chunk.err = fitter.err[window]
+
+            tasks.append((k, chunk, cycles, rng.randint(1e09)))
+
+    if progress:
+        bar.total += len(tasks)
+        bar.set_description('Fitting minima')
+
+    results = parallel_map(_fit_star_cycles, tasks, star=True,
+                           n_jobs=n_jobs, progress=bar)
+
+    if progress:
+        bar.close()
+
+    minima = [[] for _ in fitters]
+    for k,chunk_minima in results:
+        minima[k].extend(chunk_minima)
+
+    #################
+    # O-C diagrams #
+    #################
+    columns = {'star':[], 'time':[], 'err':[], 'cycle':[], 'OC':[]}
+    for k,fitter in enumerate(fitters):
+        if len(minima[k]) == 0:
+            continue
+        _,min_times,min_times_err = np.array(sorted(minima[k])).T
+
+        fitter.min_cycles = np.array(sorted(minima[k]))[:,0].astype(int)
+        fitter.min_times = min_times
+        fitter.min_times_err = min_times_err
+        fitter.min_events = np.zeros(len(min_times))
+
+        t0 = min_times.min() if fitter.epoch is None else fitter.epoch
+        cycles,OC = _cycle_numbers(min_times-t0, fitter.period, min_times.max()-min_times.min())
+
+        columns['star'].append(np.repeat(names[k],len(min_times)))
+        columns['time'].append(min_times)
+        columns['err'].append(min_times_err)
+        columns['cycle'].append(cycles)
+        columns['OC'].append(OC)
+
+    if len(columns['star']) > 0:
+        columns = {name:np.concatenate(column) for name,column in columns.items()}
+    else:
+        columns = {name:np.array([]) for name in columns}
+
+    table = Table(columns, names=['star','time','err','cycle','OC'])
+    table.meta.update({'fittype':fittype, 'phase_interval':phase_interval,
+                       'order':order, 'smoothness':smoothness, 'samplings':samplings})
+
+    if filename is not None:
+        with MinimaStore(filename,'w') as store:
+            for k,fitter in enumerate(fitters):
+                if len(minima[k]) > 0:
+                    store.append(names[k], fitter)
+
+    return table
+
+def read_minima_batch(filename, columns=None):
+    """
+    Load the table saved by `fit_minima_batch`.
+    The names of the stars are read as strings.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the HDF5 file.
+    columns : list of str, optional
+        Columns to be read. Default is the columns of `fit_minima_batch`.
+        The `event` column of `MinimaStore` can be also requested.
+
+    Returns
+    -------
+    table : astropy.table.Table
+        The table of minima.
+    """
+    if columns is None:
+        columns = ['star','time','err','cycle','OC']
+
+    with MinimaStore(filename,'r') as store:
+        return store.read(columns=columns)
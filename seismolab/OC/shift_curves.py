@@ -1,4 +1,3 @@
-from scipy.interpolate import interp1d
 import numpy as np
 
 def regression(X, flux, flux_err, prior_sigma = None, prior_mu = None):
@@ -23,7 +22,21 @@ def regression(X, flux, flux_err, prior_sigma = None, prior_mu = None):
     
     return w, model_flux
 
+def _segment_medians(values, segments, starts, counts):
+    """
+    Median of `values` within each segment.
+    """
+    order = np.lexsort((values, segments))
+    sorted_values = values[order]
+
+    lower = sorted_values[starts + (counts-1)//2]
+    upper = sorted_values[starts + counts//2]
+
+    return (lower+upper)/2
+
 def shift_phase_curves_vertically(time,flux,fluxerr,period):
+    from scipy.interpolate import interp1d
+
     # Create output array
     shifted_flux = flux.copy()
     
@@ -49,24 +62,42 @@ def shift_phase_curves_vertically(time,flux,fluxerr,period):
     
     # Get interpolated baseline flux
     model_interp = interp1d(model_time,model_flux,kind='cubic',fill_value='extrapolate')
-    
-    # Loop over each phase and shift them to the baseline phase
-    for jumpstart,jumpend in zip(jumpat[:-1],jumpat[1:]):
-        
-        time2shift    = phase[jumpstart:jumpend]
-        flux2shift    = flux[jumpstart:jumpend]
-        fluxerr2shift = fluxerr[jumpstart:jumpend]
-
-        # Get baseline flux at current phase points
-        model = model_interp(time2shift)
-
-        # Build model for regression
-        X = np.c_[ np.ones_like(model), model ]
-
-        # Fit current phase curve to interpolated baseline curve
-        w, fitted_model = regression(X, flux2shift, fluxerr2shift)
-
-        # Get current shifted phase curve
-        shifted_flux[jumpstart:jumpend] = flux2shift + np.median(model) - w[0]
-        
-    return shifted_flux
\ No newline at end of file
+
+    # Phase curves to be shifted, between the remaining jumps
+    jumpat = np.minimum(jumpat,len(phase))
+    counts = np.diff(jumpat)
+    starts = jumpat[:-1][counts>0]
+    counts = counts[counts>0]
+    if len(starts) == 0:
+        return shifted_flux
+    first, last = jumpat[0], jumpat[-1]
+    segments = np.repeat(np.arange(len(starts)),counts)
+
+    # Get baseline flux at all points at once
+    model = model_interp(phase[first:last])
+    flux2shift = flux[first:last]
+    weight = 1/fluxerr[first:last]**2
+    starts = starts - first
+
+    # Fit each phase curve to the interpolated baseline curve
+    # by weighted linear regression, summing over all curves at once
+    S  = np.add.reduceat(weight, starts)
+    Sy = np.add.reduceat(weight*flux2shift, starts)
+    model_mean = np.add.reduceat(weight*model, starts) / S
+
+    dmodel = model - model_mean[segments]
+    Sdd = np.add.reduceat(weight*dmodel**2, starts)
+    Sdy = np.add.reduceat(weight*dmodel*flux2shift, starts)
+
+    # Degenerate curves, e.g. single points, are only offset
+    degenerate = (counts < 2) | (Sdd <= 1e-12*S*np.var(model))
+    slope = np.where(degenerate, 1, Sdy/np.where(degenerate,1,Sdd))
+
+    # Fitted flux at the median baseline flux of each curve
+    model_median = _segment_medians(model, segments, starts, counts)
+    fitted_median = Sy/S + slope*(model_median - model_mean)
+
+    # Get shifted phase curves
+    shifted_flux[first:last] = flux2shift + (model_median - fitted_median)[segments]
+
+    return shifted_flux
@@ -0,0 +1,108 @@
+import numpy as np
+
+__all__ = ['LocalLinearSmoother']
+
+class LocalLinearSmoother:
+    """
+    Local linear kernel regression with a Gaussian kernel,
+    equivalent to ``statsmodels.nonparametric.kernel_regression.KernelReg``
+    with ``reg_type='ll'`` and a fixed bandwidth.
+
+    The kernel is truncated at `cutoff` bandwidths, so each point
+    is evaluated from a window of the sorted observations only.
+    Far from the observations, the window is kept around the nearest ones.
+
+    Parameters
+    ----------
+    x : array
+        Independent variable of the observations.
+    y : array
+        Observed values.
+    bandwidth : float
+        Standard deviation of the Gaussian kernel.
+    cutoff : float, default: 6
+        Truncation of the kernel in units of `bandwidth`.
+    """
+    def __init__(self, x, y, bandwidth, cutoff=6):
+        x = np.asarray(x,dtype=float)
+        y = np.asarray(y,dtype=float)
+
+        order = np.argsort(x,kind='stable')
+        self.x = x[order]
+        self.y = y[order]
+        self.bandwidth = float(np.squeeze(bandwidth))
+        self.cutoff = float(cutoff)
+
+    def __call__(self, x):
+        """
+        Evaluate the regression.
+
+        Parameters
+        ----------
+        x : float or array
+            Points to be evaluated.
+
+        Returns
+        -------
+        y : float or array
+            The smoothed values.
+        """
+        scalar = np.ndim(x) == 0
+        x = np.atleast_1d(np.asarray(x,dtype=float))
+
+        result = np.empty(x.shape)
+        flat = result.reshape(-1)
+        x = x.reshape(-1)
+
+        # Limit the size of the temporary windows
+        width = self._max_window()
+        step = max(1, 2**20 // width)
+        for start in range(0,len(x),step):
+            flat[start:start+step] = self._evaluate(x[start:start+step], width)
+
+        if scalar:
+            return result[0]
+        return result
+
+    def _max_window(self):
+        # Most observations within the truncated kernel
+        reach = self.cutoff*self.bandwidth
+        stop = np.searchsorted(self.x, self.x+reach, side='right')
+        start = np.searchsorted(self.x, self.x-reach, side='left')
+        return max(2, int(np.max(stop-start)) + 2)
+
+    def _evaluate(self, x0, width):
+        xs = self.x
+        n = len(xs)
+        h = self.bandwidth
+
+        # Distance to the nearest observation
+        at = np.searchsorted(xs, x0)
+        nearest = np.minimum(np.abs(xs[np.clip(at-1,0,n-1)]-x0), np.abs(xs[np.clip(at,0,n-1)]-x0))
+
+        # Observations with relative kernel weight above the cutoff
+        reach = np.sqrt(nearest**2 + (self.cutoff*h)**2)
+        start = np.searchsorted(xs, x0-reach, side='left')
+        stop = np.searchsorted(xs, x0+reach, side='right')
+        # Far from the data the window grows, but its weights drop quickly
+        stop = np.minimum(stop, start+width)
+
+        index = start[:,None] + np.arange(width)[None,:]
+        inside = index < stop[:,None]
+        index = np.minimum(index, n-1)
+
+        dx = xs[index] - x0[:,None]
+        w = np.where(inside, np.exp(-(dx**2 - nearest[:,None]**2)/(2*h**2)), 0)
+        wy = w*self.y[index]
+
+        s0 = w.sum(axis=1)
+        s1 = (w*dx).sum(axis=1)
+        s2 = (w*dx**2).sum(axis=1)
+        t0 = wy.sum(axis=1)
+        t1 = (wy*dx).sum(axis=1)
+
+        # Weighted linear fit, or weighted mean if the fit is degenerate
+        det = s0*s2 - s1**2
+        good = det > 1e-12*s0*s2
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.where(good, (s2*t0 - s1*t1)/np.where(good,det,1), t0/s0)
@@ -0,0 +1,342 @@
+import numpy as np
+
+from .OC import _cycle_numbers
+
+__all__ = ['MinimaStore']
+
+# Columns of the minima and their types
+_MINIMA_COLUMNS = {'star_id' : np.int64,
+                   'event'   : np.float64,
+                   'cycle'   : np.float64,
+                   'time'    : np.float64,
+                   'err'     : np.float64,
+                   'OC'      : np.float64}
+
+# Fit settings stored for each star
+_STAR_COLUMNS = {'period'         : np.float64,
+                 'epoch'          : np.float64,
+                 'phase_interval' : np.float64,
+                 'order'          : np.int64,
+                 'smoothness'     : np.float64,
+                 'samplings'      : np.int64}
+
+class MinimaStore:
+    """
+    HDF5 file of the minima and O-C values of many stars.
+
+    The minima of all stars are kept in common columns, which are extended
+    chunk by chunk, so minima can be appended star by star,
+    and the whole survey can be read at once.
+    Appended minima are buffered until a chunk is filled,
+    or `flush`, `read` or `close` is called.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the HDF5 file.
+    mode : 'r', 'a' or 'w', default: 'a'
+        Read only, read and append, or overwrite the file.
+    chunk_size : int, default: 10000
+        Number of minima in an HDF5 chunk of a new file,
+        and number of minima buffered before writing them.
+
+    Examples
+    --------
+    >>> with MinimaStore('survey.h5') as store:
+    ...     store.append('T Men', fitter)
+    >>> with MinimaStore('survey.h5','r') as store:
+    ...     table = store.read()
+    """
+    def __init__(self, filename, mode='a', chunk_size=10000):
+        import h5py
+
+        if mode not in ['r','a','w']:
+            raise ValueError('Unknown mode \'%s\'! Use \'r\', \'a\' or \'w\'.' % mode)
+
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        self.chunk_size = chunk_size
+        self._buffer = []
+        self._nbuffered = 0
+
+        if 'minima' not in self.file:
+            if mode == 'r':
+                self.file.close()
+                raise ValueError('%s does not contain minima!' % filename)
+            self._create(chunk_size)
+
+        # The table of stars is kept in memory until flushed
+        stars = self.file['stars']
+        self._stars = {'name'    : list(stars['name'].asstr()[()]),
+                       'fittype' : list(stars['fittype'].asstr()[()])}
+        for name in _STAR_COLUMNS:
+            self._stars[name] = list(stars[name][()])
+        self._stars_changed = False
+        self._ids = {name:k for k,name in enumerate(self._stars['name'])}
+
+    def _create(self, chunk_size):
+        import h5py
+
+        minima = self.file.create_group('minima')
+        for name,dtype in _MINIMA_COLUMNS.items():
+            minima.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(chunk_size,))
+
+        stars = self.file.create_group('stars')
+        stars.create_dataset('name', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+        stars.create_dataset('fittype', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+        for name,dtype in _STAR_COLUMNS.items():
+            stars.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Write the buffered minima and close the file.
+        """
+        if self.file:
+            if self.file.mode != 'r':
+                self.flush()
+            self.file.close()
+
+    def flush(self):
+        """
+        Write the buffered minima and the table of stars to the file.
+        """
+        minima = self.file['minima']
+        if self._nbuffered > 0:
+            start = len(minima['time'])
+            for name in _MINIMA_COLUMNS:
+                minima[name].resize((start+self._nbuffered,))
+                minima[name][start:] = np.concatenate([chunk[name] for chunk in self._buffer])
+            self._buffer = []
+            self._nbuffered = 0
+
+        if self._stars_changed:
+            stars = self.file['stars']
+            for name,values in self._stars.items():
+                stars[name].resize((len(values),))
+                if len(values) > 0:
+                    stars[name][:] = np.array(values, dtype=object if name in ['name','fittype'] else None)
+            self._stars_changed = False
+
+        self.file.flush()
+
+    def __len__(self):
+        """
+        Number of stored minima.
+        """
+        return len(self.file['minima/time']) + self._nbuffered
+
+    @property
+    def star_names(self):
+        """
+        Names of the stored stars.
+        """
+        return list(self._ids)
+
+    def _star_id(self, star, fittype, parameters):
+        """
+        Index of the star in the table of stars, which is added if it is new.
+        """
+        stars = self._stars
+        star = str(star)
+
+        for name in parameters:
+            if name not in _STAR_COLUMNS:
+                raise KeyError('Unknown parameter \'%s\'! Use one of %s.' % (name,', '.join(_STAR_COLUMNS)))
+
+        if star not in self._ids:
+            self._ids[star] = len(stars['name'])
+            stars['name'].append(star)
+            stars['fittype'].append('')
+            for name,dtype in _STAR_COLUMNS.items():
+                stars[name].append(-1 if np.issubdtype(dtype,np.integer) else np.nan)
+
+        # The last settings of the star are kept
+        k = self._ids[star]
+        if fittype is not None:
+            stars['fittype'][k] = fittype
+        for name,value in parameters.items():
+            stars[name][k] = np.nan if value is None else value
+        self._stars_changed = True
+
+        return k
+
+    def append_minima(self, star, time, err, cycle, OC, event=None, fittype=None, **parameters):
+        """
+        Append minima of a star.
+
+        Parameters
+        ----------
+        star : str
+            Name of the star. Minima of a star can be appended in several steps.
+        time : array
+            Times of minima.
+        err : array
+            Errors of the times of minima.
+        cycle : array
+            Cycle numbers of the minima.
+        OC : array
+            O-C values.
+        event : array, optional
+            Phase offsets of the minima, e.g. `0.5` for secondary minima.
+            Default is `0`.
+        fittype : str, optional
+            The type of the function fitted to the minima.
+        period, epoch, phase_interval, order, smoothness, samplings : optional
+            Settings of the fit to be stored for the star.
+        """
+        time = np.atleast_1d(np.asarray(time,dtype=float))
+        n = len(time)
+        if event is None:
+            event = np.zeros(n)
+
+        columns = {'star_id' : np.full(n,self._star_id(star,fittype,parameters)),
+                   'event'   : event,
+                   'cycle'   : cycle,
+                   'time'    : time,
+                   'err'     : err,
+                   'OC'      : OC}
+
+        self._buffer.append({name:np.broadcast_to(np.asarray(values,dtype=_MINIMA_COLUMNS[name]),(n,))
+                             for name,values in columns.items()})
+        self._nbuffered += n
+        if self._nbuffered >= self.chunk_size:
+            self.flush()
+
+    def _remove_minima(self, k):
+        """
+        Remove the stored minima of the `k`th star.
+        """
+        self.flush()
+
+        minima = self.file['minima']
+        keep = minima['star_id'][()] != k
+        if np.all(keep):
+            return
+
+        for name in _MINIMA_COLUMNS:
+            values = minima[name][()][keep]
+            minima[name].resize((len(values),))
+            minima[name][:] = values
+
+    def append(self, star, fitter, overwrite=False):
+        """
+        Append the minima and O-C of an `OCFitter`, which already fitted the minima,
+        together with its fit settings. The O-C is calculated as in `calculate_OC`,
+        for each event separately.
+
+        Parameters
+        ----------
+        star : str
+            Name of the star.
+        fitter : OCFitter
+            The fitter of the star.
+        overwrite : bool, default: False
+            If `True`, the minima already stored for the star are replaced,
+            e.g. after `OCFitter.update`. Otherwise a stored star raises an error.
+        """
+        if not hasattr(fitter,'min_times'):
+            raise ValueError('No minima to be stored! Run `fit_minima` first.')
+
+        if str(star) in self._ids:
+            if not overwrite:
+                raise ValueError('Minima of %s are already stored! Set `overwrite=True` to replace them.' % star)
+            self._remove_minima(self._ids[str(star)])
+
+        min_events = getattr(fitter,'min_events',np.zeros(len(fitter.min_times)))
+        fit = getattr(fitter,'_cycle_fit',{})
+        period = fitter.period
+
+        for event in np.unique(min_events):
+            um = min_events == event
+            order = np.argsort(fitter.min_times[um])
+            min_times = fitter.min_times[um][order]
+            min_times_err = fitter.min_times_err[um][order]
+
+            if fitter.epoch is None:
+                t0 = min_times.min()
+            else:
+                t0 = fitter.epoch + event*period
+            cycle,OC = _cycle_numbers(min_times-t0, period, min_times.max()-min_times.min())
+
+            self.append_minima(star, min_times, min_times_err, cycle, OC, event=event,
+                               fittype=fit.get('fittype'), period=period, epoch=fitter.epoch,
+                               phase_interval=fit['pm']/period if 'pm' in fit else None,
+                               order=fit.get('order',-1), smoothness=fit.get('smoothness'),
+                               samplings=fit.get('samplings',-1))
+
+    def read(self, stars=None, columns=None):
+        """
+        Read the minima of all or some stars at once.
+
+        Parameters
+        ----------
+        stars : list of str, optional
+            Names of the stars to be read. Default is all of them.
+        columns : list of str, optional
+            Columns to be read from `star`, `event`, `cycle`, `time`, `err` and `OC`.
+            Default is all of them.
+
+        Returns
+        -------
+        table : astropy.table.Table
+            One row per minimum, in the order of appending.
+        """
+        from astropy.table import Table
+
+        if self.file.mode != 'r':
+            self.flush()
+
+        if columns is None:
+            columns = ['star'] + [name for name in _MINIMA_COLUMNS if name != 'star_id']
+
+        minima = self.file['minima']
+        star_id = minima['star_id'][()]
+
+        if stars is None:
+            rows = [slice(None)]
+        else:
+            # Runs of consecutive rows of the selected stars
+            ids = [self._ids[str(star)] for star in stars if str(star) in self._ids]
+            index = np.flatnonzero(np.isin(star_id, ids))
+            breaks = np.flatnonzero(np.diff(index) != 1) + 1
+            starts = index[np.r_[0,breaks]] if len(index) > 0 else []
+            stops = index[np.r_[breaks-1,len(index)-1]] + 1 if len(index) > 0 else []
+            rows = [slice(start,stop) for start,stop in zip(starts,stops)]
+            star_id = star_id[index]
+
+        data = {}
+        for name in columns:
+            if name == 'star':
+                names = np.array(self.star_names, dtype=str)
+                data[name] = names[star_id]
+            elif name == 'star_id':
+                data[name] = star_id
+            else:
+                dataset = minima[name]
+                data[name] = np.concatenate([dataset[run] for run in rows] + [np.empty(0,dataset.dtype)])
+
+        return Table(data, names=columns)
+
+    def read_stars(self):
+        """
+        Read the fit settings of the stars.
+
+        Returns
+        -------
+        table : astropy.table.Table
+            One row per star, with its name, fit type, period, epoch and fit settings.
+        """
+        from astropy.table import Table
+
+        data = {'name'    : np.array(self._stars['name'],dtype=str),
+                'fittype' : np.array(self._stars['fittype'],dtype=str)}
+        for name,dtype in _STAR_COLUMNS.items():
+            data[name] = np.array(self._stars[name],dtype=dtype)
+
+        return Table(data, names=list(data))
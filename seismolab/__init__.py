@@ -3,4 +3,4 @@ PACKAGEDIR = os.path.abspath(os.path.dirname(__file__))
 
 from .version import __version__
 
-__all__ = ['fourier', 'gaia', 'template','OC','tfa','inpainting']
\ No newline at end of file
+__all__ = ['fourier', 'gaia', 'template','OC','tfa','inpainting','parallel','profiling']
\ No newline at end of file
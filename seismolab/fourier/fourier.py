@@ -1,33 +1,62 @@
+import os
 import numpy as np
-from astropy.timeseries import LombScargle
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 from warnings import warn
-from uncertainties import ufloat
-import corner
-import multiprocessing
-from joblib import delayed
-import joblib
-from tqdm.auto import tqdm
-from scipy import stats
+from ..parallel import parallel_map
+from ..profiling import profiled, iterate
 
 __all__ = ['Fourier','MultiHarmonicFitter','MultiFrequencyFitter']
 
-class ProgressParallel(joblib.Parallel):
-    def __init__(self, total=None, **kwds):
-        self.total = total
-        super().__init__(**kwds)
-    def __call__(self, *args, **kwargs):
-        with tqdm() as self._pbar:
-            return joblib.Parallel.__call__(self, *args, **kwargs)
-
-    def print_progress(self):
-        if self.total is None:
-            self._pbar.total = self.n_dispatched_tasks
+def _checkpoint_header(fingerprint):
+    return '# seismolab checkpoint %s\n' % fingerprint
+
+def _read_checkpoint(filename, nparams, fingerprint):
+    """
+    Read finished resamplings (seed -> fitted parameters) from a checkpoint file,
+    which must have been written with the same `fingerprint`.
+    """
+    done = {}
+    if filename is None or not os.path.isfile(filename):
+        return done
+
+    with open(filename) as f:
+        header = f.readline()
+        if header == '':
+            return done
+        if header != _checkpoint_header(fingerprint):
+            raise ValueError('Checkpoint %s was written for other data or settings! '
+                             'Remove it or give another checkpoint file.' % filename)
+
+        for line in f:
+            # Skip last line if it was only partially written
+            if not line.endswith('\n'):
+                continue
+            values = line.split()
+            if len(values) != nparams+1:
+                continue
+            try:
+                done[int(values[0])] = np.array(values[1:],dtype=float)
+            except ValueError:
+                continue
+
+    return done
+
+def _append_checkpoint(filename, seeds, results, fingerprint):
+    """
+    Append finished resamplings to a checkpoint file.
+    """
+    with open(filename,'a+') as f:
+        if f.tell() == 0:
+            f.write(_checkpoint_header(fingerprint))
+        # Do not continue a partially written line
         else:
-            self._pbar.total = self.total
-        self._pbar.n = self.n_completed_tasks
-        self._pbar.refresh()
+            f.seek(f.tell()-1)
+            if f.read(1) != '\n':
+                f.write('\n')
+
+        for seed,result in zip(seeds,results):
+            f.write( '%d ' % seed + ' '.join('%.17e' % val for val in result) + '\n' )
+        f.flush()
+        os.fsync(f.fileno())
 
 def is_outlier(points, thresh=3.5):
     if len(points.shape) == 1:
@@ -126,6 +155,61 @@ class BaseFitter():
 
         return sigma_f,sigma_a,sigma_phi
 
+    def _checkpoint_fingerprint(self, seed):
+        """
+        Hash of the data and settings of the error estimation,
+        which the resamplings of a checkpoint file depend on.
+        """
+        import hashlib
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update(np.ascontiguousarray(self.lc,dtype=float).tobytes())
+        fingerprint.update(np.asarray(self.freqs,dtype=float).tobytes())
+        fingerprint.update(repr((self.error_estimation, self.sample_size, seed, self.absolute_sigma,
+                                 self.yerror if self.error is None else None)).encode())
+
+        return fingerprint.hexdigest()
+
+    @profiled('fourier.error_estimation')
+    def _run_error_estimation(self, seeds, nparams, parallel=True, ncores=None,
+                              checkpoint=None, checkpoint_every=100, seed=None):
+        """
+        Refit resampled light curves for each seed.
+
+        If `checkpoint` is given, finished resamplings are read from this file
+        and only the missing seeds are fitted. New results are appended to the
+        file in batches of `checkpoint_every` resamplings. The file must belong
+        to the same data, frequencies, settings and master `seed`.
+        """
+        fingerprint = None
+        if checkpoint is not None:
+            fingerprint = self._checkpoint_fingerprint(seed)
+        done = _read_checkpoint(checkpoint, nparams, fingerprint)
+
+        todo = [seed for seed in dict.fromkeys(seeds) if seed not in done]
+        if checkpoint is not None and len(done) > 0:
+            print('Resuming from checkpoint: %d of %d resamplings are done.' % (len(seeds)-len(todo),len(seeds)),flush=True)
+
+        if checkpoint is None or checkpoint_every < 1:
+            batchsize = max(1,len(todo))
+        else:
+            batchsize = int(checkpoint_every)
+
+        for start in range(0,len(todo),batchsize):
+            batch = todo[start:start+batchsize]
+
+            # do error estimation fit parallal
+            results = parallel_map(self._estimate_errors, batch,
+                                   n_jobs=ncores if parallel else 1)
+            results = np.asarray(results,dtype=float).reshape(len(batch),nparams)
+
+            if checkpoint is not None:
+                _append_checkpoint(checkpoint, batch, results, fingerprint)
+
+            done.update( zip(batch,results) )
+
+        return np.array([done[seed] for seed in seeds]).reshape(len(seeds),nparams)
+
 class Fourier(BaseFitter):
     '''
 
@@ -173,6 +257,8 @@ class Fourier(BaseFitter):
             Spectral window at given frequencies.
         """
 
+        from astropy.timeseries import LombScargle
+
         ls = LombScargle(self.t, self.y)
         lsf = ls.autofrequency( samples_per_peak=samples_per_peak,
                                 nyquist_factor=nyquist_factor,
@@ -185,6 +271,7 @@ class Fourier(BaseFitter):
         sw = np.sqrt(costerm**2 + sinterm**2)/len(self.t)
 
         if plotting:
+            import matplotlib.pyplot as plt
             fig = plt.figure(figsize=(15,3))
             plt.plot(lsf, sw)
             plt.xlabel('Frequency (c/d)')
@@ -194,6 +281,7 @@ class Fourier(BaseFitter):
 
         return lsf,sw
 
+    @profiled('fourier.spectrum')
     def spectrum(self,
                 minimum_frequency=None,
                 maximum_frequency=None,
@@ -250,6 +338,7 @@ class Fourier(BaseFitter):
         FFT = 2*np.abs(Ftnu)
 
         if plotting:
+            import matplotlib.pyplot as plt
             fig = plt.figure(figsize=(15,3))
             plt.plot(nu_grid.reshape(-1), FFT)
             plt.xlabel('Frequency (c/d)')
@@ -306,7 +395,10 @@ class MultiHarmonicFitter(BaseFitter):
         y += const
         return y
 
+    @profiled('fourier.resampling')
     def _estimate_errors(self,seed):
+        from scipy.optimize import curve_fit
+
         np.random.seed(seed)
 
         if self.error_estimation == 'bootstrap':
@@ -350,7 +442,9 @@ class MultiHarmonicFitter(BaseFitter):
                   kind='sin',
                   error_estimation='analytic',ntry=1000,
                   sample_size=0.7,
-                  parallel=True, ncores=-1,
+                  parallel=True, ncores=None,
+                  seed=None,
+                  checkpoint=None, checkpoint_every=100,
                   refit=False,
                   best_freq=None):
         """
@@ -393,9 +487,17 @@ class MultiHarmonicFitter(BaseFitter):
             Applies only if `error_estimation` is set to `bootstrap`.
         parallel: bool, default : True
             If `True`, sampling for error estimation is performed parallel to speed up the process.
-        ncores: int, default: -1
+        ncores: int, default: None
             Number of CPU cores to be used for parallel error estimation. If `-1`, then all available
-            cores will be used.
+            cores will be used. If `None`, the global setting of `seismolab.parallel` is used.
+        seed: int, default: None
+            Master seed of the resamplings. If given, the error estimation is reproducible.
+        checkpoint: str, default: None
+            If given, finished resamplings are appended to this file, and an interrupted
+            error estimation can be resumed from it. Requires `seed` to be set.
+            A checkpoint written for other data or settings raises a `ValueError`.
+        checkpoint_every: int, default: 100
+            Number of resamplings to be saved at once into the `checkpoint` file.
         best_freq : float, default: None
             If given, then this frequency will be used as the basis of the harmonics,
             instead of calculating a Lomb-Scargle spectrum to get a frequency.
@@ -408,6 +510,9 @@ class MultiHarmonicFitter(BaseFitter):
         perr : array-like
             Estimated error of the parameters.
         """
+        from astropy.timeseries import LombScargle
+        from scipy.optimize import curve_fit
+
         self.sample_size = sample_size
         self.kind = kind
         self.absolute_sigma = absolute_sigma
@@ -432,6 +537,9 @@ class MultiHarmonicFitter(BaseFitter):
         if error_estimation not in ['analytic','bootstrap','montecarlo']:
             raise TypeError('%s method is not supported! Please choose \'analytic\', \'bootstrap\' or \'montecarlo\'.' % str(error_estimation))
 
+        if checkpoint is not None and seed is None:
+            warn('Checkpoint is given without a seed! Set \'seed\' to be able to resume error estimation.')
+
         # fit periodic funtions and do prewhitening
         yres = self.y.copy()
 
@@ -444,7 +552,7 @@ class MultiHarmonicFitter(BaseFitter):
         self.phaseserr = []
         self.zeropointerr = []
 
-        for i in range(maxharmonics):
+        for i in iterate('fourier.prewhitening', range(maxharmonics)):
             if i == 0:
                 if best_freq is None:
                     ls = LombScargle(self.t, yres, nterms=1)
@@ -566,6 +674,7 @@ class MultiHarmonicFitter(BaseFitter):
                     pcov = pcov2
 
             if plotting:
+                import matplotlib.pyplot as plt
                 # plot phased light curve and fit
                 if i==0:
                     per = 1/pfit[1]
@@ -666,27 +775,22 @@ class MultiHarmonicFitter(BaseFitter):
                 self.pfit = pfit
                 if self.error is None:
                     #self.yerror = 0.5*np.std(self.get_residual()[1])
-                    self.yerror = stats.median_abs_deviation(self.get_residual()[1])
+                    from scipy.stats import median_abs_deviation
+                    self.yerror = median_abs_deviation(self.get_residual()[1])
 
                 if   error_estimation == 'bootstrap':  print('Bootstrapping...',flush=True)
                 elif error_estimation == 'montecarlo': print('Performing monte carlo...',flush=True)
 
-                error_estimation_fit = np.empty( (ntry,len(pfit)) )
-                seeds = np.random.randint(1e09,size=ntry)
-                if parallel:
-                    # do error estimation fit parallal
-                    available_ncores = multiprocessing.cpu_count()
-                    if ncores <= -1:
-                        ncores = available_ncores
-                    elif available_ncores<ncores:
-                        ncores = available_ncores
-
-                    error_estimation_fit = ProgressParallel(n_jobs=ncores,total=ntry)(delayed(self._estimate_errors)(par) for par in seeds)
-                    error_estimation_fit = np.asarray(error_estimation_fit)
-
+                if seed is None:
+                    seeds = np.random.randint(1e09,size=ntry)
                 else:
-                    for i,seed in tqdm(enumerate(seeds),total=ntry):
-                        error_estimation_fit[i,:] = self._estimate_errors(seed)
+                    seeds = np.random.RandomState(seed).randint(1e09,size=ntry)
+
+                error_estimation_fit = self._run_error_estimation(seeds, len(pfit),
+                                                                  parallel=parallel, ncores=ncores,
+                                                                  checkpoint=checkpoint,
+                                                                  checkpoint_every=checkpoint_every,
+                                                                  seed=seed)
 
                 # Get rid of nan values
                 goodpts = np.all(np.isfinite(error_estimation_fit),axis=1)
@@ -702,6 +806,7 @@ class MultiHarmonicFitter(BaseFitter):
                 perr = np.min(np.c_[bspercentiles[2]-bspercentiles[1],bspercentiles[1]-bspercentiles[0]],axis=1)
 
                 if plotting:
+                    import corner
                     labels = [r'Freq'] + [r'A$_'+str(i+1)+'$' for i in range(len(self.amps))] + \
                              [r'$\Phi_'+str(i+1)+'$' for i in range(len(self.phases))] + [r'Zero point']
 
@@ -738,6 +843,9 @@ class MultiHarmonicFitter(BaseFitter):
                                                     ntry=ntry,
                                                     parallel=parallel, ncores=ncores,
                                                     sample_size=self.sample_size,
+                                                    seed=seed,
+                                                    checkpoint=checkpoint+'.shifted' if checkpoint is not None else None,
+                                                    checkpoint_every=checkpoint_every,
                                                     refit=True)
 
                     try:
@@ -763,24 +871,19 @@ class MultiHarmonicFitter(BaseFitter):
                 self.pfit = pfit
                 if self.error is None:
                     #self.yerror = 0.5*np.std(self.get_residual()[1])
-                    self.yerror = stats.median_abs_deviation(self.get_residual()[1])
-
-                error_estimation_fit = np.empty( (ntry,len(pfit)) )
-                seeds = np.random.randint(1e09,size=ntry)
-                if parallel:
-                    # do error_estimation fit parallal
-                    available_ncores = multiprocessing.cpu_count()
-                    if ncores <= -1:
-                        ncores = available_ncores
-                    elif available_ncores<ncores:
-                        ncores = available_ncores
-
-                    error_estimation_fit = ProgressParallel(n_jobs=ncores,total=ntry)(delayed(self._estimate_errors)(par) for par in seeds)
-                    error_estimation_fit = np.asarray(error_estimation_fit)
+                    from scipy.stats import median_abs_deviation
+                    self.yerror = median_abs_deviation(self.get_residual()[1])
 
+                if seed is None:
+                    seeds = np.random.randint(1e09,size=ntry)
                 else:
-                    for i,seed in tqdm(enumerate(seeds),total=ntry):
-                        error_estimation_fit[i,:] = self._estimate_errors(seed)
+                    seeds = np.random.RandomState(seed).randint(1e09,size=ntry)
+
+                error_estimation_fit = self._run_error_estimation(seeds, len(pfit),
+                                                                  parallel=parallel, ncores=ncores,
+                                                                  checkpoint=checkpoint,
+                                                                  checkpoint_every=checkpoint_every,
+                                                                  seed=seed)
 
                 # Get rid of nan values
                 goodpts = np.all(np.isfinite(error_estimation_fit),axis=1)
@@ -827,6 +930,8 @@ class MultiHarmonicFitter(BaseFitter):
             Phin1 value(s) and its estimated error(s),
             where n is the harmonics order.
         """
+        from uncertainties import ufloat
+
         if not hasattr(self,"pfit"):
             warn("Please run \'fit_harmonics\' first!")
             return None,None,None,None
@@ -943,7 +1048,10 @@ class MultiFrequencyFitter(BaseFitter):
         y += const
         return y
 
+    @profiled('fourier.resampling')
     def _estimate_errors(self,seed):
+        from scipy.optimize import curve_fit
+
         np.random.seed(seed)
 
         if self.error_estimation == 'bootstrap':
@@ -989,7 +1097,9 @@ class MultiFrequencyFitter(BaseFitter):
                   kind='sin',
                   error_estimation='analytic',ntry=1000,
                   sample_size=0.7,
-                  parallel=True, ncores=-1,
+                  parallel=True, ncores=None,
+                  seed=None,
+                  checkpoint=None, checkpoint_every=100,
                   refit=False):
         """
         ``fit_freqs`` performs consecutive Fourier pre-whitening with given number of frequencies.
@@ -1033,9 +1143,17 @@ class MultiFrequencyFitter(BaseFitter):
             Applies only if `error_estimation` is set to `bootstrap`.
         parallel: bool, default : True
             If `True`, sampling for error estimation is performed parallel to speed up the process.
-        ncores: int, default: -1
+        ncores: int, default: None
             Number of CPU cores to be used for parallel error estimation. If `-1`, then all available
-            cores will be used.
+            cores will be used. If `None`, the global setting of `seismolab.parallel` is used.
+        seed: int, default: None
+            Master seed of the resamplings. If given, the error estimation is reproducible.
+        checkpoint: str, default: None
+            If given, finished resamplings are appended to this file, and an interrupted
+            error estimation can be resumed from it. Requires `seed` to be set.
+            A checkpoint written for other data or settings raises a `ValueError`.
+        checkpoint_every: int, default: 100
+            Number of resamplings to be saved at once into the `checkpoint` file.
 
         Returns
         -------
@@ -1045,6 +1163,9 @@ class MultiFrequencyFitter(BaseFitter):
         perr : array-like
             Estimated error of the parameters.
         """
+        from astropy.timeseries import LombScargle
+        from scipy.optimize import curve_fit
+
         self.sample_size = sample_size
         self.kind = kind
         self.absolute_sigma = absolute_sigma
@@ -1064,6 +1185,9 @@ class MultiFrequencyFitter(BaseFitter):
         if error_estimation not in ['analytic','bootstrap','montecarlo']:
             raise TypeError('%s method is not supported! Please choose \'analytic\', \'bootstrap\' or \'montecarlo\'.' % str(error_estimation))
 
+        if checkpoint is not None and seed is None:
+            warn('Checkpoint is given without a seed! Set \'seed\' to be able to resume error estimation.')
+
         # fit periodic funtions and do prewhitening
         yres = self.y.copy()
 
@@ -1076,7 +1200,7 @@ class MultiFrequencyFitter(BaseFitter):
         self.phaseserr = []
         self.zeropointerr = []
 
-        for i in range(maxfreqs):
+        for i in iterate('fourier.prewhitening', range(maxfreqs)):
             ls = LombScargle(self.t, yres, nterms=1)
 
             with np.errstate(divide='ignore',invalid='ignore'):
@@ -1191,6 +1315,7 @@ class MultiFrequencyFitter(BaseFitter):
                 break
 
             if plotting:
+                import matplotlib.pyplot as plt
                 # plot phased light curve and fit
                 per = 1/pfit[1]
 
@@ -1344,27 +1469,22 @@ class MultiFrequencyFitter(BaseFitter):
                 self.pfit = pfit
                 if self.error is None:
                     #self.yerror = 0.5*np.std(self.get_residual()[1])
-                    self.yerror = stats.median_abs_deviation(self.get_residual()[1])
+                    from scipy.stats import median_abs_deviation
+                    self.yerror = median_abs_deviation(self.get_residual()[1])
 
                 if   error_estimation == 'bootstrap':  print('Bootstrapping...',flush=True)
                 elif error_estimation == 'montecarlo': print('Performing monte carlo...',flush=True)
 
-                error_estimation_fit = np.empty( (ntry,len(pfit)) )
-                seeds = np.random.randint(1e09,size=ntry)
-                if parallel:
-                    # do error estimation fit parallal
-                    available_ncores = multiprocessing.cpu_count()
-                    if ncores <= -1:
-                        ncores = available_ncores
-                    elif available_ncores<ncores:
-                        ncores = available_ncores
-
-                    error_estimation_fit = ProgressParallel(n_jobs=ncores,total=ntry)(delayed(self._estimate_errors)(par) for par in seeds)
-                    error_estimation_fit = np.asarray(error_estimation_fit)
-
+                if seed is None:
+                    seeds = np.random.randint(1e09,size=ntry)
                 else:
-                    for i,seed in tqdm(enumerate(seeds),total=ntry):
-                        error_estimation_fit[i,:] = self._estimate_errors(seed)
+                    seeds = np.random.RandomState(seed).randint(1e09,size=ntry)
+
+                error_estimation_fit = self._run_error_estimation(seeds, len(pfit),
+                                                                  parallel=parallel, ncores=ncores,
+                                                                  checkpoint=checkpoint,
+                                                                  checkpoint_every=checkpoint_every,
+                                                                  seed=seed)
 
                 # Get rid of nan values
                 goodpts = np.all(np.isfinite(error_estimation_fit),axis=1)
@@ -1380,6 +1500,7 @@ class MultiFrequencyFitter(BaseFitter):
                 perr = np.min(np.c_[bspercentiles[2]-bspercentiles[1],bspercentiles[1]-bspercentiles[0]],axis=1)
 
                 if plotting:
+                    import corner
                     labels = [r'f$_'+str(i+1)+'$' for i in range(len(self.freqs))] + \
                              [r'A$_'+str(i+1)+'$' for i in range(len(self.amps))] + \
                              [r'$\Phi_'+str(i+1)+'$' for i in range(len(self.phases))] + [r'Zero point']
@@ -1417,6 +1538,9 @@ class MultiFrequencyFitter(BaseFitter):
                                                 ntry=ntry,
                                                 parallel=parallel, ncores=ncores,
                                                 sample_size=self.sample_size,
+                                                seed=seed,
+                                                checkpoint=checkpoint+'.shifted' if checkpoint is not None else None,
+                                                checkpoint_every=checkpoint_every,
                                                 refit=True)
 
                     try:
@@ -1444,24 +1568,19 @@ class MultiFrequencyFitter(BaseFitter):
                 self.pfit = pfit
                 if self.error is None:
                     #self.yerror = 0.5*np.std(self.get_residual()[1])
-                    self.yerror = stats.median_abs_deviation(self.get_residual()[1])
-
-                error_estimation_fit = np.empty( (ntry,len(pfit)) )
-                seeds = np.random.randint(1e09,size=ntry)
-                if parallel:
-                    # do error_estimation fit parallal
-                    available_ncores = multiprocessing.cpu_count()
-                    if ncores <= -1:
-                        ncores = available_ncores
-                    elif available_ncores<ncores:
-                        ncores = available_ncores
-
-                    error_estimation_fit = ProgressParallel(n_jobs=ncores,total=ntry)(delayed(self._estimate_errors)(par) for par in seeds)
-                    error_estimation_fit = np.asarray(error_estimation_fit)
+                    from scipy.stats import median_abs_deviation
+                    self.yerror = median_abs_deviation(self.get_residual()[1])
 
+                if seed is None:
+                    seeds = np.random.randint(1e09,size=ntry)
                 else:
-                    for i,seed in tqdm(enumerate(seeds),total=ntry):
-                        error_estimation_fit[i,:] = self._estimate_errors(seed)
+                    seeds = np.random.RandomState(seed).randint(1e09,size=ntry)
+
+                error_estimation_fit = self._run_error_estimation(seeds, len(pfit),
+                                                                  parallel=parallel, ncores=ncores,
+                                                                  checkpoint=checkpoint,
+                                                                  checkpoint_every=checkpoint_every,
+                                                                  seed=seed)
 
                 # Get rid of nan values
                 goodpts = np.all(np.isfinite(error_estimation_fit),axis=1)
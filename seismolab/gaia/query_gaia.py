@@ -1,13 +1,6 @@
 # -*- coding: utf-8 -*-
 
-try:
-    import mwdust
-except ModuleNotFoundError:
-    msg = 'No module named \'mwdust\'\nFollow the installation details here: https://github.com/jobovy/mwdust'
-    raise ModuleNotFoundError(msg)
-
 import numpy as np
-from astropy.io import ascii
 from astropy.table import join,Table,unique
 import requests
 from time import sleep
@@ -15,50 +8,51 @@ import regex
 
 from .querytools import perform_query,get_dist_absmag,get_dist_absmag_edr3
 
-import joblib
-from joblib import delayed
-from tqdm.auto import tqdm
-from multiprocessing import cpu_count
+from ..parallel import parallel_map, get_n_jobs
+from ..profiling import profiled, stage
 
 import argparse
 from argparse import RawTextHelpFormatter
 
 __all__ = ['query_gaia','query_from_commandline']
 
-class ProgressParallel(joblib.Parallel):
-    def __init__(self, total=None, **kwds):
-        self.total = total
-        super().__init__(**kwds)
-    def __call__(self, *args, **kwargs):
-        with tqdm() as self._pbar:
-            return joblib.Parallel.__call__(self, *args, **kwargs)
-
-    def print_progress(self):
-        if self.total is None:
-            self._pbar.total = self.n_dispatched_tasks
-        else:
-            self._pbar.total = self.total
-        self._pbar.n = self.n_completed_tasks
-        self._pbar.refresh()
-
 import warnings
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
-# Update returned Simbad fields
-from astroquery.simbad import Simbad
-Simbad.add_votable_fields('ids',
-                          'flux(B)','flux_error(B)',
-                          'flux(V)','flux_error(V)',
-                          'flux(J)','flux_error(J)',
-                          'flux(H)','flux_error(H)',
-                          'flux(K)','flux_error(K)')
+def _import_mwdust():
+    try:
+        import mwdust
+    except ModuleNotFoundError:
+        msg = 'No module named \'mwdust\'\nFollow the installation details here: https://github.com/jobovy/mwdust'
+        raise ModuleNotFoundError(msg)
+
+    return mwdust
+
+_Simbad = None
 
+def _get_simbad():
+    global _Simbad
+
+    if _Simbad is None:
+        # Update returned Simbad fields
+        from astroquery.simbad import Simbad
+        Simbad.add_votable_fields('ids',
+                                  'flux(B)','flux_error(B)',
+                                  'flux(V)','flux_error(V)',
+                                  'flux(J)','flux_error(J)',
+                                  'flux(H)','flux_error(H)',
+                                  'flux(K)','flux_error(K)')
+        _Simbad = Simbad
+
+    return _Simbad
+
+@profiled('gaia.simbad_query')
 def _query_simbad(targs):
     simbadcols = ['IDS','FLUX_B','FLUX_ERROR_B','FLUX_V','FLUX_ERROR_V',\
                   'FLUX_J','FLUX_ERROR_J','FLUX_H','FLUX_ERROR_H','FLUX_K','FLUX_ERROR_K']
 
     with warnings.catch_warnings(record=True):
-        simbadqueryresult = Simbad.query_objects(targs)
+        simbadqueryresult = _get_simbad().query_objects(targs)
 
     if simbadqueryresult is None:
         warnings.warn(
@@ -71,7 +65,7 @@ def _query_simbad(targs):
 
     return simbadqueryresult
 
-def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_offset=None):
+def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_offset=None,ncores=None):
     '''
     ``query_gaia`` performs Gaia database query and
     calculates distance, reddening corrected apparent
@@ -97,6 +91,10 @@ def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_o
             "Riess",   which is +0.046  mas (Riess et al. 2018)
             "BJ",      which is +0.029  mas (Bailer-Jones et al. 2018)
             "Zinn",    which is +0.0528 mas (Zinn et al 2019)
+    ncores : int, default: None
+        Number of CPU cores to be used for distance and extinction calculation.
+        If `-1`, then all available cores will be used. If `None`, the global
+        setting of `seismolab.parallel` is used.
 
     Returns
     -------
@@ -104,6 +102,8 @@ def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_o
         Calculated distance, brightness and absorption values.
     '''
 
+    mwdust = _import_mwdust()
+
     # --- Convert target list to Astropy Table ---
     targets = np.atleast_1d(targets).ravel().astype(int)
     targets = Table( {'Source':targets} )
@@ -135,7 +135,8 @@ def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_o
 
     # ------ Set MW dust model -----------
     print("Using %s map from mwdust" % str(dustmodel))
-    dustmodel = getattr(mwdust, dustmodel)()
+    with stage('gaia.dust_map'):
+        dustmodel = getattr(mwdust, dustmodel)()
 
     # --- Query Gaia -----------
     try:
@@ -229,22 +230,22 @@ def query_gaia(targets,gaiaDR=3,use_photodist=False,dustmodel='Combined19',plx_o
 
     # ------ Start calculations -----------
     print('Calculating distances, absolute magnitudes...')
-    outdata = []
 
     max_ = len(targets)
 
+    # Run parallel only if there are enough targets to worth it
+    ncores = get_n_jobs(ncores)
+    if max_ < 10*ncores:
+        ncores = 1
+
     if not useEDR3:
-        ncores = cpu_count()
-        if max_ >= 10*ncores:
-            outdata = ProgressParallel(n_jobs=ncores,total=max_)(delayed(get_dist_absmag)(i,targets,dustmodel,plx_offset) for i in np.arange(max_))
-        else:
-            for i in tqdm(np.arange(max_)):
-                result = get_dist_absmag(i,targets,dustmodel,plx_offset)
-                outdata.append(result)
+        outdata = parallel_map(get_dist_absmag, np.arange(max_),
+                               args=(targets,dustmodel,plx_offset),
+                               n_jobs=ncores)
     else:
-        for i in tqdm(np.arange(max_)):
-            result = get_dist_absmag_edr3(i,targets,dustmodel,plx_offset,use_photodist)
-            outdata.append(result)
+        outdata = parallel_map(get_dist_absmag_edr3, np.arange(max_),
+                               args=(targets,dustmodel,plx_offset,use_photodist),
+                               n_jobs=ncores)
 
     outdataTable = Table(names=['Source',
                           'dist','distep','distem',
@@ -362,4 +363,5 @@ def query_from_commandline():
     result = query_gaia(targets,gaiaDR=gaiaDR,use_photodist=use_photodist,dustmodel=dustmodel,plx_offset=plx_offset)
 
     # --- Save results ---
+    from astropy.io import ascii
     ascii.write(result, outfilename, format='basic', fast_writer=False, overwrite=True)
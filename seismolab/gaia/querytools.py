@@ -1,8 +1,10 @@
 import numpy as np
 import ephem
 import warnings
-from astroquery.gaia import Gaia
 
+from ..profiling import profiled
+
+@profiled('gaia.extinction')
 def get_dist_absmag(i,data,dustmodel,plx_offset):
     # Check if it makes sense to run the calculations
     if ((data['plx'][i] + plx_offset) <= 0.) or ((data['sig_plx'][i]/ (data['plx'][i] + plx_offset)) > 1. ):
@@ -193,6 +195,7 @@ def get_dist_absmag(i,data,dustmodel,plx_offset):
                     appK,appKep,appKem]
     return outdata
 
+@profiled('gaia.extinction')
 def get_dist_absmag_edr3(i,data,dustmodel,plx_offset,use_photodist):
 
     # ------ Gaia mag -----------
@@ -350,7 +353,10 @@ def get_dist_absmag_edr3(i,data,dustmodel,plx_offset,use_photodist):
                     appK,appKep,appKem]
     return outdata
 
+@profiled('gaia.gaia_query')
 def perform_query(data,useEDR3):
+    from astroquery.gaia import Gaia
+
     # Prepare target list by number of targets
     if len(data['Source']) >1:
         targetlist = str(tuple(data['Source']))
@@ -0,0 +1,312 @@
+import os
+import math
+from contextlib import contextmanager, nullcontext
+
+from . import profiling
+
+__all__ = ['set_config','get_config','config_context',
+           'cpu_count','get_n_jobs','parallel_map','run_in_background']
+
+# Executors and the joblib backends behind them
+_BACKENDS = {'processes'       : 'loky',
+             'threads'         : 'threading',
+             'serial'          : None,
+             'loky'            : 'loky',
+             'multiprocessing' : 'multiprocessing',
+             'threading'       : 'threading'}
+
+_config = {'backend'      : os.environ.get('SEISMOLAB_BACKEND','processes'),
+           'n_jobs'       : int(os.environ.get('SEISMOLAB_N_JOBS',-1)),
+           'batch_size'   : 'auto',
+           'progress'     : True,
+           'blas_threads' : None}
+
+# Single worker process for tasks running in the background
+_background_executor = None
+
+def _check_config(options):
+    for key,value in options.items():
+        if key not in _config:
+            raise KeyError('Unknown option \'%s\'! Use one of %s.' % (key,', '.join(_config)))
+        if key == 'backend' and value not in _BACKENDS:
+            raise ValueError('Unknown backend \'%s\'! Use one of %s.' % (value,', '.join(_BACKENDS)))
+        if key == 'n_jobs' and int(value) == 0:
+            raise ValueError('n_jobs must not be 0!')
+
+def set_config(**options):
+    """
+    Set the global defaults of parallel execution.
+
+    Parameters
+    ----------
+    backend : 'processes', 'threads' or 'serial', default: 'processes'
+        The executor to be used. The joblib backend names
+        'loky', 'multiprocessing' and 'threading' are also accepted.
+    n_jobs : int, default: -1
+        Number of workers. If `-1`, then all available cores are used,
+        if `-2` all but one, etc. It can be also set by the `SEISMOLAB_N_JOBS`
+        environment variable.
+    batch_size : int or 'auto', default: 'auto'
+        Number of tasks dispatched to a worker at once.
+    progress : bool, default: True
+        Show progress bar.
+    blas_threads : int, default: None
+        Maximum number of BLAS/OpenMP threads in each worker. If `None`,
+        joblib limits the threads to avoid oversubscription in processes.
+    """
+    _check_config(options)
+    _config.update(options)
+
+def get_config():
+    """
+    Get the global defaults of parallel execution.
+
+    Returns
+    -------
+    config : dict
+        Copy of the current settings. See `set_config`.
+    """
+    return dict(_config)
+
+@contextmanager
+def config_context(**options):
+    """
+    Temporarily change the defaults of parallel execution.
+    Accepts the same options as `set_config`.
+    """
+    _check_config(options)
+    old_config = get_config()
+    _config.update(options)
+    try:
+        yield
+    finally:
+        _config.clear()
+        _config.update(old_config)
+
+def _cgroup_cpu_quota():
+    """
+    CPU quota of the container (number of cores), if there is any.
+    """
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota)/int(period)
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota/period
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+def cpu_count():
+    """
+    Number of CPU cores available to this process.
+    CPU affinity and cgroup CPU quotas are taken into account.
+
+    Returns
+    -------
+    ncores : int
+        Number of usable CPU cores.
+    """
+    try:
+        ncores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncores = os.cpu_count() or 1
+
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        ncores = min(ncores, math.ceil(quota))
+
+    return max(1,ncores)
+
+def get_n_jobs(n_jobs=None):
+    """
+    Number of workers to be used.
+
+    Parameters
+    ----------
+    n_jobs : int, default: None
+        Requested number of workers. If `None`, the global setting is used.
+        Negative values count backwards from the number of available cores,
+        i.e. `-1` means all cores.
+
+    Returns
+    -------
+    n_jobs : int
+        Number of workers, limited by the available cores.
+    """
+    if n_jobs is None:
+        n_jobs = _config['n_jobs']
+    n_jobs = int(n_jobs)
+
+    available_ncores = cpu_count()
+    if n_jobs < 0:
+        n_jobs = available_ncores + 1 + n_jobs
+    elif n_jobs == 0:
+        raise ValueError('n_jobs must not be 0!')
+
+    return max(1,min(n_jobs,available_ncores))
+
+def _limit_blas_threads(blas_threads):
+    if blas_threads is None:
+        return nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ModuleNotFoundError:
+        return nullcontext()
+    return threadpool_limits(limits=int(blas_threads))
+
+def _progress(iterable, total, desc, progress):
+    if hasattr(progress,'update'):
+        return _update_progress(iterable, progress)
+    if not progress:
+        return iterable
+    from tqdm.auto import tqdm
+    return tqdm(iterable, total=total, desc=desc)
+
+def _update_progress(iterable, bar):
+    # Advance an existing progress bar
+    for item in iterable:
+        yield item
+        bar.update(1)
+
+def parallel_map(function, iterable, args=(), star=False,
+                 n_jobs=None, backend=None, batch_size=None,
+                 progress=None, total=None, desc=None,
+                 blas_threads=None):
+    """
+    Apply a function to every item of an iterable, in parallel if possible.
+
+    Parameters
+    ----------
+    function : callable
+        Function to be called as ``function(item, *args)``.
+    iterable : iterable
+        Items to be processed.
+    args : tuple, optional
+        Further arguments passed to each call. Large arrays are shared
+        between processes instead of being copied for each task.
+    star : bool, default: False
+        If `True`, items are unpacked, i.e. ``function(*item, *args)`` is called.
+    n_jobs : int, default: None
+        Number of workers. See `get_n_jobs`.
+    backend : str, default: None
+        The executor. See `set_config`.
+    batch_size : int or 'auto', default: None
+        Number of tasks dispatched to a worker at once.
+    progress : bool or tqdm.tqdm, default: None
+        Show progress bar. If a progress bar is given,
+        it is advanced instead of showing a new one.
+    total : int, optional
+        Number of items for the progress bar, if `iterable` has no length.
+    desc : str, optional
+        Label of the progress bar.
+    blas_threads : int, default: None
+        Maximum number of BLAS/OpenMP threads in each worker.
+
+    If an option is `None`, its global setting is used.
+
+    Returns
+    -------
+    results : list
+        The return values in the order of the items.
+    """
+    if backend is None:
+        backend = _config['backend']
+    if batch_size is None:
+        batch_size = _config['batch_size']
+    if progress is None:
+        progress = _config['progress']
+    if blas_threads is None:
+        blas_threads = _config['blas_threads']
+    _check_config({'backend':backend})
+
+    if total is None and hasattr(iterable,'__len__'):
+        total = len(iterable)
+
+    n_jobs = get_n_jobs(n_jobs)
+    if total is not None:
+        n_jobs = max(1,min(n_jobs,total))
+
+    if backend == 'serial' or n_jobs == 1:
+        with _limit_blas_threads(blas_threads):
+            if star:
+                return [function(*item, *args) for item in _progress(iterable, total, desc, progress)]
+            else:
+                return [function(item, *args) for item in _progress(iterable, total, desc, progress)]
+
+    from joblib import Parallel, delayed, parallel_config
+
+    joblib_backend = _BACKENDS[backend]
+
+    # Collect the stages profiled in the worker processes
+    traced = profiling.is_enabled() and joblib_backend != 'threading'
+    if traced:
+        function = profiling._TracedCall(function, profiling._profiler.memory)
+
+    if star:
+        tasks = (delayed(function)(*item, *args) for item in iterable)
+    else:
+        tasks = (delayed(function)(item, *args) for item in iterable)
+
+    if joblib_backend == 'loky':
+        backend_context = parallel_config(backend=joblib_backend, inner_max_num_threads=blas_threads)
+        thread_context  = nullcontext()
+    else:
+        backend_context = parallel_config(backend=joblib_backend)
+        thread_context  = _limit_blas_threads(blas_threads) if joblib_backend == 'threading' else nullcontext()
+
+    with backend_context, thread_context:
+        results = Parallel(n_jobs=n_jobs, batch_size=batch_size, return_as='generator')(tasks)
+        results = list(_progress(results, total, desc, progress))
+
+    if traced:
+        results, events = zip(*results) if results else ([],[])
+        profiling._merge(events)
+        results = list(results)
+
+    return results
+
+def _warn_on_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        from warnings import warn
+        warn('Background task failed: %r' % future.exception())
+
+def run_in_background(function, *args, **kwargs):
+    """
+    Run a function in a separate worker process without waiting for it,
+    e.g. to write plots while the calculations go on.
+    Tasks are executed one after the other in the order of submission.
+    Unfinished tasks are completed before the interpreter exits.
+
+    Parameters
+    ----------
+    function : callable
+        Function to be called as ``function(*args, **kwargs)``.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Use ``future.result()`` to wait for the task and get its return value.
+    """
+    global _background_executor
+    from joblib.externals.loky import ProcessPoolExecutor
+
+    if _background_executor is None:
+        _background_executor = ProcessPoolExecutor(max_workers=1)
+
+    future = _background_executor.submit(function, *args, **kwargs)
+    future.add_done_callback(_warn_on_failure)
+    return future
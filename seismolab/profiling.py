@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+__all__ = ['Profiler','profile','enable','disable','is_enabled',
+           'stage','profiled','iterate']
+
+# Currently active profiler, `None` if profiling is disabled
+_profiler = None
+
+# Shared no-op context returned by `stage` if profiling is disabled
+_NULL_STAGE = nullcontext()
+
+class Profiler:
+    """
+    Collects wall time, number of calls and peak memory of the named
+    stages of seismolab pipelines.
+
+    Use `profile` or `enable`/`disable` to create one.
+
+    Attributes
+    ----------
+    events : list of dict
+        One entry per finished stage with keys `name`, `start`, `duration`
+        (in seconds), `memory` (peak traced memory in bytes, or `None`),
+        `pid` and `tid`.
+    """
+    def __init__(self, memory=True):
+        self.memory = bool(memory)
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+
+    def _start(self):
+        if self.memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    def _stop(self):
+        if self._started_tracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _enter(self, name):
+        stack = self._stack()
+
+        entry = {'name':name, 'memory':None}
+        if self.memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            # Hand over the peak so far to the enclosing stage
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            entry['current'] = entry['peak'] = current
+
+        stack.append(entry)
+        entry['start'] = time.perf_counter()
+
+    def _exit(self):
+        end = time.perf_counter()
+        stack = self._stack()
+        entry = stack.pop()
+
+        if self.memory:
+            import tracemalloc
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(entry['peak'], peak)
+            entry['memory'] = peak - entry['current']
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+
+        self._add({'name'     : entry['name'],
+                   'start'    : entry['start'],
+                   'duration' : end - entry['start'],
+                   'memory'   : entry['memory'],
+                   'pid'      : os.getpid(),
+                   'tid'      : threading.get_ident()})
+
+    def _add(self, *events):
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self):
+        """
+        Aggregate the recorded stages.
+
+        Returns
+        -------
+        summary : dict
+            For each stage name the number of `calls`, the `total_time`,
+            `mean_time` and `max_time` in seconds and the `peak_memory` in bytes.
+        """
+        summary = {}
+        for event in self.events:
+            stats = summary.setdefault(event['name'],
+                                       {'calls':0,'total_time':0.,'mean_time':0.,
+                                        'max_time':0.,'peak_memory':None})
+            stats['calls'] += 1
+            stats['total_time'] += event['duration']
+            stats['max_time'] = max(stats['max_time'], event['duration'])
+            if event['memory'] is not None:
+                stats['peak_memory'] = max(stats['peak_memory'] or 0, event['memory'])
+
+        for stats in summary.values():
+            stats['mean_time'] = stats['total_time']/stats['calls']
+
+        return summary
+
+    def print_summary(self):
+        """
+        Print the aggregated stages, the most time consuming first.
+        """
+        summary = self.summary()
+
+        print('%-40s %8s %12s %12s %12s' % ('Stage','Calls','Total (s)','Mean (s)','Peak (MB)'))
+        for name,stats in sorted(summary.items(), key=lambda item: -item[1]['total_time']):
+            memory = '-' if stats['peak_memory'] is None else '%.2f' % (stats['peak_memory']/1024**2)
+            print('%-40s %8d %12.4f %12.4f %12s' % (name,stats['calls'],stats['total_time'],
+                                                     stats['mean_time'],memory))
+
+    def to_json(self, filename=None):
+        """
+        Export the summary and all recorded stages as JSON.
+
+        Parameters
+        ----------
+        filename : str, optional
+            If given, the result is written to this file.
+
+        Returns
+        -------
+        result : str
+            The JSON string.
+        """
+        result = json.dumps({'summary':self.summary(), 'events':self.events}, indent=1)
+        if filename is not None:
+            with open(filename,'w') as f:
+                f.write(result)
+        return result
+
+    def to_chrome_trace(self, filename=None):
+        """
+        Export the recorded stages in the Chrome trace event format,
+        which can be opened by ``chrome://tracing`` or https://ui.perfetto.dev.
+
+        Parameters
+        ----------
+        filename : str, optional
+            If given, the result is written to this file.
+
+        Returns
+        -------
+        result : str
+            The JSON string.
+        """
+        t0 = min((event['start'] for event in self.events), default=0.)
+
+        trace = []
+        for event in self.events:
+            trace_event = {'name' : event['name'],
+                           'cat'  : event['name'].split('.')[0],
+                           'ph'   : 'X',
+                           'ts'   : (event['start']-t0)*1e6,
+                           'dur'  : event['duration']*1e6,
+                           'pid'  : event['pid'],
+                           'tid'  : event['tid']}
+            if event['memory'] is not None:
+                trace_event['args'] = {'peak_memory':event['memory']}
+            trace.append(trace_event)
+
+        result = json.dumps({'traceEvents':trace, 'displayTimeUnit':'ms'})
+        if filename is not None:
+            with open(filename,'w') as f:
+                f.write(result)
+        return result
+
+def enable(memory=True):
+    """
+    Start recording the stages of seismolab pipelines.
+
+    Parameters
+    ----------
+    memory : bool, default: True
+        Record peak memory of the stages using `tracemalloc`.
+        This slows down the calculations.
+
+    Returns
+    -------
+    profiler : Profiler
+        The profiler collecting the stages.
+    """
+    global _profiler
+    if _profiler is not None:
+        disable()
+    _profiler = Profiler(memory=memory)
+    _profiler._start()
+    return _profiler
+
+def disable():
+    """
+    Stop recording the stages of seismolab pipelines.
+
+    Returns
+    -------
+    profiler : Profiler or None
+        The profiler containing the recorded stages.
+    """
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    if profiler is not None:
+        profiler._stop()
+    return profiler
+
+def is_enabled():
+    """
+    `True` if stages are being recorded.
+    """
+    return _profiler is not None
+
+@contextmanager
+def profile(memory=True):
+    """
+    Record the stages of seismolab pipelines within a ``with`` block.
+
+    Parameters
+    ----------
+    memory : bool, default: True
+        Record peak memory of the stages using `tracemalloc`.
+
+    Examples
+    --------
+    >>> from seismolab import profiling
+    >>> with profiling.profile() as prof:
+    ...     fitter.fit_freqs()
+    >>> prof.print_summary()
+    >>> prof.to_chrome_trace('trace.json')
+    """
+    profiler = enable(memory=memory)
+    try:
+        yield profiler
+    finally:
+        if _profiler is profiler:
+            disable()
+
+class _Stage:
+    __slots__ = ('profiler','name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit()
+        return False
+
+def stage(name):
+    """
+    Context manager recording a named stage if profiling is enabled.
+    Otherwise it does nothing.
+    """
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(_profiler, name)
+
+def profiled(name):
+    """
+    Decorator recording each call of a function as a named stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _Stage(_profiler, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def iterate(name, iterable):
+    """
+    Record each iteration of a loop as a named stage.
+    """
+    if _profiler is None:
+        return iterable
+    return _iterate(_profiler, name, iterable)
+
+def _iterate(profiler, name, iterable):
+    for item in iterable:
+        with _Stage(profiler, name):
+            yield item
+
+class _TracedCall:
+    """
+    Run a function in a worker process with profiling enabled,
+    and return the recorded stages along with the result.
+    """
+    def __init__(self, function, memory):
+        self.function = function
+        self.memory = memory
+
+    def __call__(self, *args):
+        if _profiler is not None:
+            # Already profiled, e.g. in the same process
+            return self.function(*args), []
+
+        with profile(memory=self.memory) as profiler:
+            result = self.function(*args)
+        return result, profiler.events
+
+def _merge(events):
+    """
+    Add stages recorded in worker processes to the active profiler.
+    """
+    if _profiler is not None:
+        for worker_events in events:
+            _profiler._add(*worker_events)
@@ -1,40 +1,15 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy import optimize
-from astropy.convolution import Gaussian1DKernel, convolve
-from psutil import cpu_count
-from joblib import parallel_backend
-import arviz as az
 
 import warnings
 warnings.filterwarnings("ignore")
 
 from seismolab.fourier import MultiHarmonicFitter
 
-from matplotlib.collections import LineCollection
-
-import joblib
-from joblib import delayed
-from tqdm.auto import tqdm
+from ..parallel import parallel_map
+from ..profiling import profiled
 
 __all__ = ['TemplateFitter']
 
-class ProgressParallel(joblib.Parallel):
-    def __init__(self, total=None, **kwds):
-        self.total = total
-        super().__init__(**kwds)
-    def __call__(self, *args, **kwargs):
-        with tqdm() as self._pbar:
-            return joblib.Parallel.__call__(self, *args, **kwargs)
-
-    def print_progress(self):
-        if self.total is None:
-            self._pbar.total = self.n_dispatched_tasks
-        else:
-            self._pbar.total = self.total
-        self._pbar.n = self.n_completed_tasks
-        self._pbar.refresh()
-
 def make_segments(x, y):
     '''
     Create list of line segments from x and y coordinates, in the correct format for LineCollection:
@@ -44,12 +19,20 @@ def make_segments(x, y):
     segments = np.concatenate([points[:-1], points[1:]], axis=1)
     return segments
 
-def colorline(x, y, z=None, cmap=plt.get_cmap('copper'), norm=plt.Normalize(0.0, 1.0), linewidth=3, alpha=1.0, ax=None):
+def colorline(x, y, z=None, cmap=None, norm=None, linewidth=3, alpha=1.0, ax=None):
     '''
     Plot a colored line with coordinates x and y
     Optionally specify colors in the array z
     Optionally specify a colormap, a norm function and a line width
     '''
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    if cmap is None:
+        cmap = plt.get_cmap('copper')
+    if norm is None:
+        norm = plt.Normalize(0.0, 1.0)
+
     # Default colors equally spaced on [0,1]:
     if z is None:
         z = np.linspace(0.0, 1.0, len(x))
@@ -64,21 +47,14 @@ def colorline(x, y, z=None, cmap=plt.get_cmap('copper'), norm=plt.Normalize(0.0,
     return lc
 
 
-def splitthem(inputBJD, inputflux,fluxerror,span,step,n):
+def _chunk_windows(inputBJD,span,step,n):
     """
-    Split light curve into chunks
+    Start and stop indices of the `n`th light curve chunks,
+    i.e. the points within ``[start time, start time + span)``.
+    `inputBJD` must be sorted.
     """
-    um = (inputBJD>=inputBJD[0]+step*n) & (inputBJD<inputBJD[0]+step*n+span)
-    dfbitlistBJD   = inputBJD[um]
-    dfbitlistflux  = inputflux[um]
-    if fluxerror is None:
-        dfbitlistfluxerror = None
-    else:
-        dfbitlistfluxerror = fluxerror[um]
-
-    midBJD = inputBJD[0]+step*n + span/2
-
-    return midBJD, dfbitlistBJD, dfbitlistflux, dfbitlistfluxerror
+    edges = inputBJD[0]+step*np.asarray(n)
+    return np.searchsorted(inputBJD,edges,side='left'), np.searchsorted(inputBJD,edges+span,side='left')
 
 def modulated_lc_model(time, a0, a, dPhi, pfit, kind):
     """
@@ -134,6 +110,8 @@ def unpack_az_statistics(az_stat):
     return a0, a0ep, a0em, a, aep, aem, psi, psiep, psiem
 
 def smooth_data(a0values,avalues,psivalues,gapat,smoothness_factor,step):
+    from astropy.convolution import Gaussian1DKernel, convolve
+
     gapat = np.concatenate((np.array([0]),gapat,np.array([ len(a0values) ])))
 
     a0values_out  = np.empty_like(a0values)
@@ -164,79 +142,225 @@ def smooth_data(a0values,avalues,psivalues,gapat,smoothness_factor,step):
 
     return a0values_out, avalues_out, psivalues_out
 
-def fit_lightcurve_chunk(midBJD,bitBJD,bitflux,bitfluxerror,
-                        LSPfreq,span,pfit,
-                        duty_cycle,error_estimation,kind,
-                        debug=False):
-
+def _chunk_is_good(bitBJD, LSPfreq, span, duty_cycle, debug=False):
+    """
+    Check if a light curve chunk has enough points and coverage to be fitted.
+    """
     # ---- Skip chunk if number of pts is low ----
     if debug: print('N points:',len(bitBJD))
     if len(bitBJD)<4:
-        return [np.nan]*7
+        return False
 
     # ---- Skip chunk if duty cycle is low ----
     if debug: print('Duty cycle:', np.ptp(bitBJD) / (span*1/LSPfreq) )
     if np.ptp(bitBJD) < duty_cycle * span*1/LSPfreq:
-        return [np.nan]*7
+        return False
 
     # ---- Skip chunk if there is a large gap ----
     if ~np.all(np.diff(bitBJD) < duty_cycle * span*1/LSPfreq):
         if debug: print('Skipping due to large gap...')
-        return [np.nan]*7
+        return False
+
+    return True
 
-    # ---- Fit zp, amp, phase ----
-    try:
-        _pfit, _pcov = optimize.curve_fit(lambda x, a0, a, psi: modulated_lc_model(x, a0, a, psi, pfit, kind),
-                                      bitBJD,bitflux,
-                                      p0=[0.9,0.9,0.1],
-                                      sigma=bitfluxerror,absolute_sigma=True,method='trf')
-    except RuntimeError:
-        return [np.nan]*7
+def _harmonic_basis(time, pfit, kind):
+    """
+    Harmonic terms of the template at each time point, which are
+    rotated by the phase variation. The `k`th harmonic of `modulated_lc_model`
+    with phase variation `psi` and ``a=1`` is ``P*cos(k*psi) + Q*sin(k*psi)``.
+
+    Returns
+    -------
+    P, Q : array
+        The terms with shape ``(len(time), number of harmonics)``.
+    """
+    best_freq = pfit[0]
+    nparams = (len(pfit)-2)//2
+    amps = np.asarray(pfit[1:1+nparams])
+    phases = np.asarray(pfit[1+nparams:-1])
 
-    perr_curvefit = np.sqrt(np.diag(_pcov))
+    arg = 2*np.pi*best_freq*np.outer(time,np.arange(1,nparams+1)) + phases
+    if kind == 'sin':
+        return amps*np.sin(arg), amps*np.cos(arg)
+    else:
+        return amps*np.cos(arg), -amps*np.sin(arg)
 
-    # Extract fitted parameters and errors
-    a0_val, a_val, psi_val = _pfit[0], _pfit[1], _pfit[2]
-    a0_err, a_err, psi_err = perr_curvefit[0], perr_curvefit[1], perr_curvefit[2]
+@profiled('template.chunk_fit')
+def fit_lightcurve_chunks(time, flux, fluxerror, chunk, nchunks, pfit, kind,
+                          basis=None, p0=(0.9,0.9,0.1), maxiter=200, tol=1e-8):
+    """
+    Fit the zero point, amplitude and phase variation (a0, a, psi)
+    of all light curve chunks at once.
+
+    The chunks are stacked, `chunk` gives the index of the chunk of each point.
+    All chunks are iterated together by the Levenberg-Marquardt method
+    using the analytic derivatives of `modulated_lc_model`.
+    If the `basis` of `_harmonic_basis` is given for the stacked points,
+    the harmonics are not evaluated again, only rotated by the phase variations.
+
+    Returns
+    -------
+    values : array
+        The fitted a0, a and psi of each chunk.
+    errors : array
+        Their errors from the covariance matrix, like `scipy.optimize.curve_fit`
+        with ``absolute_sigma=True``. `NaN` if the fit of the chunk did not converge.
+    """
+    const = pfit[-1]
+    weight = np.ones_like(flux) if fluxerror is None else 1/fluxerror**2
+
+    P, Q = _harmonic_basis(time, pfit, kind) if basis is None else basis
+    harmonics = np.arange(1,P.shape[1]+1)
+
+    def residuals(params):
+        # Rotate the harmonics of each chunk by its phase variation
+        rotation = np.outer(params[:,2],harmonics)
+        cos_k, sin_k = np.cos(rotation)[chunk], np.sin(rotation)[chunk]
+        S = (P*cos_k + Q*sin_k).sum(axis=1)
+        dS = ((Q*cos_k - P*sin_k)*harmonics).sum(axis=1)
+
+        a0, a = params[chunk,0], params[chunk,1]
+        r = flux - a*S - a0*const
+        chi2 = np.bincount(chunk, weights=weight*r**2, minlength=nchunks)
+        return r, chi2, (np.full_like(S,const), S, a*dS)
+
+    def normal_equations(r, jacobian):
+        JTJ = np.empty((nchunks,3,3))
+        JTr = np.empty((nchunks,3))
+        for i in range(3):
+            JTr[:,i] = np.bincount(chunk, weights=weight*jacobian[i]*r, minlength=nchunks)
+            for j in range(i,3):
+                JTJ[:,i,j] = JTJ[:,j,i] = np.bincount(chunk, weights=weight*jacobian[i]*jacobian[j],
+                                                       minlength=nchunks)
+        return JTJ, JTr
+
+    params = np.tile(np.asarray(p0,dtype=float),(nchunks,1))
+    damping = np.full(nchunks,1e-3)
+    active = np.ones(nchunks,dtype=bool)
+
+    r, chi2, jacobian = residuals(params)
+    for _ in range(maxiter):
+        JTJ, JTr = normal_equations(r, jacobian)
+
+        # Damped Gauss-Newton steps of the chunks still iterated
+        diagonal = np.diagonal(JTJ,axis1=1,axis2=2)
+        A = JTJ + damping[:,None,None]*np.eye(3)*diagonal[:,:,None]
+        step = np.einsum('nij,nj->ni', np.linalg.pinv(A), JTr)
+        step[~active] = 0
+
+        trial = params + step
+        r_trial, chi2_trial, jacobian_trial = residuals(trial)
+
+        better = active & (chi2_trial <= chi2)
+        params[better] = trial[better]
+        damping = np.where(better, damping/10, damping*10)
+
+        # Converged if the fit or the parameters do not change anymore
+        converged = better & ((chi2-chi2_trial <= tol*chi2) |
+                              (np.linalg.norm(step,axis=1) <= tol*(tol+np.linalg.norm(params,axis=1))))
+        converged |= active & (damping > 1e16)
+        active &= ~converged
+
+        if np.any(better):
+            keep = better[chunk]
+            r = np.where(keep, r_trial, r)
+            jacobian = tuple(np.where(keep, new, old) for new,old in zip(jacobian_trial,jacobian))
+            chi2 = np.where(better, chi2_trial, chi2)
+
+        if not np.any(active):
+            break
+
+    # Covariance matrix at the solution
+    JTJ, _ = normal_equations(r, jacobian)
+    errors = np.sqrt(np.abs(np.diagonal(np.linalg.pinv(JTJ),axis1=1,axis2=2)))
+
+    params[active] = np.nan
+    errors[active] = np.nan
+
+    return params, errors
+
+# PyMC models of the template and their samplers, kept for the lifetime of the process
+_mcmc_models = {}
+
+def _mcmc_model(pfit, kind):
+    """
+    PyMC model of a light curve chunk with the given template and its NUTS sampler.
 
-    if error_estimation == 'montecarlo':
-        if debug: print('Running MCMC...')
+    The model and the sampler are built and compiled once per process and template,
+    and the chunks are swapped in with ``pm.set_data``.
+    The likelihood follows the shape of the data, so chunks can have different lengths.
+    """
+    key = (tuple(np.asarray(pfit,dtype=float)), kind)
+    if key in _mcmc_models:
+        return _mcmc_models[key]
 
-        import pymc as pm
+    import pymc as pm
 
-        with pm.Model() as model:
-            ## define Uniform priors
-            a0 = pm.Uniform("a0", 0, 2, initval=a0_val)
-            a = pm.Uniform("a", 0, 2, initval=a_val)
-            psi = pm.Uniform("psi", -1, 1, initval=psi_val)
+    # Only the model of the current template is kept
+    _mcmc_models.clear()
 
-            ## define model
-            yest = modulated_lc_model(bitBJD, a0, a, psi, pfit, kind)
+    with pm.Model() as model:
+        ## data of the chunk, replaced before sampling
+        time = pm.Data("time", np.zeros(1))
+        flux = pm.Data("flux", np.ones(1))
+        sigma = pm.Data("sigma", np.ones(1))
 
-            ## define Normal likelihood with HalfCauchy noise (fat tails, equiv to HalfT 1DoF)
-            likelihood = pm.Normal("likelihood", mu=yest,
-                                    sigma=bitfluxerror if bitfluxerror is not None else np.sqrt(bitflux),
-                                    observed=bitflux)
+        ## define Uniform priors
+        a0 = pm.Uniform("a0", 0, 2)
+        a = pm.Uniform("a", 0, 2)
+        psi = pm.Uniform("psi", -1, 1)
 
-            #Populate MCMC sampler
-            traces = pm.sample(1000,chains=1,cores=1)
+        ## define model
+        yest = modulated_lc_model(time, a0, a, psi, pfit, kind)
 
-        _, a0ep, a0em, _, aep, aem, _, psiep, psiem = unpack_az_statistics(az.summary(traces, kind="stats"))
+        ## define Normal likelihood
+        pm.Normal("likelihood", mu=yest, sigma=sigma, observed=flux, shape=time.shape)
 
-        if debug:
-            az.plot_pair(traces,
-                         var_names=['a0', 'a', 'psi'],
-                         kind='kde',
-                         divergences=True,
-                         marginals=True,
-                         textsize=18)
+    # NUTS with adapted diagonal mass matrix, its tuning is reset for each chunk
+    _, step = pm.init_nuts(init='adapt_diag', model=model, progressbar=False)
+
+    _mcmc_models[key] = model, step
+    return model, step
 
-        # Update errors with MCMC confidence intervals
-        a0_err = max(a0ep, a0em)
-        a_err = max(aep, aem)
-        psi_err = max(psiep, psiem)
 
-    return midBJD, a0_val, a0_err, a_val, a_err, psi_val, psi_err
+@profiled('template.mcmc')
+def mcmc_chunk_errors(start, stop, a0_val, a_val, psi_val,
+                      time, flux, fluxerror, pfit, kind, debug=False):
+    """
+    Errors of the fitted parameters of the light curve chunk
+    between the indices `start` and `stop` by MCMC sampling.
+    """
+    if debug: print('Running MCMC...')
+
+    bitBJD = time[start:stop]
+    bitflux = flux[start:stop]
+    bitfluxerror = fluxerror[start:stop] if fluxerror is not None else np.sqrt(bitflux)
+
+    import pymc as pm
+    import arviz as az
+
+    model, step = _mcmc_model(pfit, kind)
+
+    with model:
+        pm.set_data({"time": bitBJD, "flux": bitflux, "sigma": bitfluxerror})
+        step.reset_tuning()
+
+        #Populate MCMC sampler, started from the least-squares fit
+        traces = pm.sample(1000, chains=1, cores=1, step=step,
+                           initvals={"a0": a0_val, "a": a_val, "psi": psi_val})
+
+    _, a0ep, a0em, _, aep, aem, _, psiep, psiem = unpack_az_statistics(az.summary(traces, kind="stats"))
+
+    if debug:
+        az.plot_pair(traces,
+                     var_names=['a0', 'a', 'psi'],
+                     kind='kde',
+                     divergences=True,
+                     marginals=True,
+                     textsize=18)
+
+    # Update errors with MCMC confidence intervals
+    return max(a0ep, a0em), max(aep, aem), max(psiep, psiem)
 
 
 class TemplateFitter:
@@ -259,6 +383,10 @@ class TemplateFitter:
         if fluxerror is not None:
             goodpts &= np.isfinite(fluxerror)
 
+        # Keep the points sorted by time to split the light curve quickly
+        goodpts = np.where(goodpts)[0]
+        goodpts = goodpts[np.argsort(time[goodpts],kind='stable')]
+
         self.time = time[goodpts]
         self.flux = flux[goodpts]
         if fluxerror is not None:
@@ -289,7 +417,8 @@ class TemplateFitter:
         duty_cycle = 0.6,
 
         debug=False,
-        best_freq=None
+        best_freq=None,
+        ncores=None
         ):
         """
         Compute amplitude/phase/zero point variation based on template fitting.
@@ -345,6 +474,10 @@ class TemplateFitter:
 
         debug : bool, default False
             Verbose output.
+        ncores : int, default: None
+            Number of CPU cores to be used for the MCMC error estimation of the chunks.
+            If `-1`, then all available cores will be used.
+            If `None`, the global setting of `seismolab.parallel` is used.
 
 
         Returns:
@@ -389,88 +522,68 @@ class TemplateFitter:
         LSPfreq = pfit[0]
 
         if debug:
+            import matplotlib.pyplot as plt
             plt.title('Template')
             plt.scatter(self.time, self.flux)
             plt.plot(self.time,fitter.lc_model(self.time,*pfit),c='C1')
             plt.xlim(self.time.max()-3/pfit[0],self.time.max())
             plt.show()
 
-        BJDmidP=[]
-        a0values=[]
-        a0errorvalues=[]
-        avalues=[]
-        aerrorvalues=[]
-        psivalues=[]
-        psierrorvalues=[]
-
         if debug: print('Splitting them...')
 
-        params = []
-        for counter in range( int(np.ceil( self.time.ptp() / (step*1/LSPfreq))) ):
-
-            # ---- Get chunk ----
-            midBJD,bitBJD,bitflux,bitfluxerror=splitthem(
-                                                    self.time,self.flux,self.fluxerror,
-                                                    span=span*1/LSPfreq,
-                                                    step=step*1/LSPfreq,
-                                                    n=counter)
-
-            if debug:
-                result = fit_lightcurve_chunk(midBJD,bitBJD,bitflux,bitfluxerror,
-                                            LSPfreq,span,pfit,
-                                            duty_cycle,error_estimation,kind,
-                                            debug)
-
-                BJDmidP.append( result[0] )
-
-                a0values.append(result[1])
-                a0errorvalues.append(result[2])
-
-                avalues.append(result[3])
-                aerrorvalues.append(result[4])
-
-                psivalues.append(result[5])
-                psierrorvalues.append(result[6])
-
-                if ~np.all(np.isnan(bitBJD)):
-                    plt.figure()
-                    plt.title('Fit to subsample %d' % (counter+1))
-                    plt.scatter(bitBJD,bitflux)
-
-                    xxxx = np.linspace(min(bitBJD),max(bitBJD),1000)
-
-                    plt.plot(xxxx,modulated_lc_model(xxxx, a0values[-1], avalues[-1], psivalues[-1], pfit, kind))
-                    plt.plot(xxxx,modulated_lc_model(xxxx, a0values[-1], avalues[-1], 0, pfit, kind))
-
-                    plt.show()
-            else:
-                params.append( [midBJD,bitBJD,bitflux,bitfluxerror,
-                                LSPfreq,span,pfit,
-                                duty_cycle,error_estimation,kind,
-                                debug] )
-
-        if not debug:
-            ncores = cpu_count(logical=False)
-
-            with parallel_backend('multiprocessing'):
-                result = ProgressParallel(n_jobs=ncores,total=len(params))(delayed(fit_lightcurve_chunk)(*par) for par in params)
-            result = np.asarray(result)
-
-            BJDmidP        = result[:,0]
-            a0values       = result[:,1]
-            a0errorvalues  = result[:,2]
-            avalues        = result[:,3]
-            aerrorvalues   = result[:,4]
-            psivalues      = result[:,5]
-            psierrorvalues = result[:,6]
-
-        BJDmidP        = np.asarray(BJDmidP)
-        a0values       = np.asarray(a0values)
-        a0errorvalues  = np.asarray(a0errorvalues)
-        avalues        = np.asarray(avalues)
-        aerrorvalues   = np.asarray(aerrorvalues)
-        psivalues      = np.asarray(psivalues)
-        psierrorvalues = np.asarray(psierrorvalues)
+        nchunks = int(np.ceil( self.time.ptp() / (step*1/LSPfreq)))
+        starts, stops = _chunk_windows(self.time, span=span*1/LSPfreq, step=step*1/LSPfreq, n=np.arange(nchunks))
+        BJDmidP = self.time[0] + step*1/LSPfreq*np.arange(nchunks) + span*1/LSPfreq/2
+
+        good = [_chunk_is_good(self.time[start:stop], LSPfreq, span, duty_cycle, debug)
+                for start,stop in zip(starts,stops)]
+        starts, stops, BJDmidP = starts[good], stops[good], BJDmidP[good]
+        nchunks = len(starts)
+
+        # ---- Fit zp, amp, phase of all chunks at once ----
+        if nchunks > 0:
+            # Indices of the points of the chunks one after the other
+            lengths = stops-starts
+            points = np.arange(lengths.sum()) + np.repeat(starts-np.cumsum(lengths)+lengths, lengths)
+
+            P, Q = self._harmonic_basis(pfit, kind)
+            values, errors = fit_lightcurve_chunks(
+                                self.time[points], self.flux[points],
+                                None if self.fluxerror is None else self.fluxerror[points],
+                                np.repeat(np.arange(nchunks), lengths),
+                                nchunks, pfit, kind, basis=(P[points],Q[points]))
+        else:
+            values = errors = np.empty((0,3))
+
+        BJDmidP[np.isnan(values[:,0])] = np.nan
+
+        if error_estimation == 'montecarlo':
+            # Workers get the chunks by their indices
+            fitted = np.where(np.isfinite(BJDmidP))[0]
+            mcmc_errors = parallel_map(mcmc_chunk_errors,
+                                       [(starts[k],stops[k]) + tuple(values[k]) for k in fitted],
+                                       star=True, args=(self.time,self.flux,self.fluxerror,pfit,kind,debug),
+                                       n_jobs=1 if debug else ncores)
+            if len(fitted) > 0:
+                errors[fitted] = mcmc_errors
+
+        if debug:
+            import matplotlib.pyplot as plt
+            for counter,(start,stop) in enumerate(zip(starts,stops)):
+                bitBJD = self.time[start:stop]
+                plt.figure()
+                plt.title('Fit to subsample %d' % (counter+1))
+                plt.scatter(bitBJD,self.flux[start:stop])
+
+                xxxx = np.linspace(min(bitBJD),max(bitBJD),1000)
+
+                plt.plot(xxxx,modulated_lc_model(xxxx, values[counter,0], values[counter,1], values[counter,2], pfit, kind))
+                plt.plot(xxxx,modulated_lc_model(xxxx, values[counter,0], values[counter,1], 0, pfit, kind))
+
+                plt.show()
+
+        a0values, avalues, psivalues = values.T
+        a0errorvalues, aerrorvalues, psierrorvalues = errors.T
 
         goodpts = np.isfinite(BJDmidP)
         BJDmidP        = BJDmidP[goodpts]
@@ -515,6 +628,8 @@ class TemplateFitter:
 
         # ----- Plot results -----
         if plotting or saveplot:
+            import matplotlib.pyplot as plt
+
             period=1/LSPfreq
             BJDmodP_extended = self.time%period/period
             BJDmodP_extended = np.concatenate((BJDmodP_extended,1+BJDmodP_extended))
@@ -599,6 +714,17 @@ class TemplateFitter:
 
         return np.array(BJDmidP), avalues,aerrorvalues, psivalues,psierrorvalues, a0values,a0errorvalues
 
+    def _harmonic_basis(self, pfit, kind):
+        """
+        Harmonic terms of the template at the time points of the light curve,
+        which are kept until the template changes.
+        """
+        key = (tuple(pfit), kind)
+        if getattr(self,'_basis_key',None) != key:
+            self._basis = _harmonic_basis(self.time, pfit, kind)
+            self._basis_key = key
+        return self._basis
+
     def get_lc_model(self, time=None, amp=None, phase=None, zp=None):
         """
         Get modulated model light curve.
@@ -2,11 +2,10 @@ import numpy as np
 from numpy.lib.stride_tricks import sliding_window_view
 
 from tqdm.auto import tqdm
-from joblib import delayed, parallel_backend
 
 from .tools import proper_round
-from .tools import ProgressParallel
-from multiprocessing import cpu_count
+from ..profiling import profiled, iterate
+from ..parallel import parallel_map, get_n_jobs, cpu_count
 
 __all__ = ['choi_williams']
 
@@ -19,7 +18,7 @@ def choi_williams(time, brightness,
                     sigma = 1.,
                     M = 128,
                     max_gap_size = 0.5,
-                    ncores=-1
+                    ncores=None
                 ):
     """
     Calculates the Choi-Williams transform.
@@ -52,9 +51,10 @@ def choi_williams(time, brightness,
         More or less this controls the resolution in frequency.
     max_gap_size : float, default: 0.5
         Maximal size of gaps which is used to split the time series into chunks.
-    ncores: int, default: -1
-        Number of CPU cores to be used for parallel error estimation.
+    ncores: int, default: None
+        Number of CPU cores to be used for parallel computation.
         If `-1`, then all available cores will be used.
+        If `None`, the global setting of `seismolab.parallel` is used.
 
     Returns
     -------
@@ -70,9 +70,7 @@ def choi_williams(time, brightness,
         raise ValueError("Temporal window length is too large!\n" + \
             "Lower the value of M!" )
 
-    ncores = int(ncores)
-    if ncores < 1:
-        ncores = cpu_count()
+    ncores = get_n_jobs(ncores)
 
     if ncores == 1:
         t_grid,nu_grid,Ctnu = choi_williams_single(time,brightness,
@@ -99,6 +97,7 @@ def choi_williams(time, brightness,
 
     return t_grid,nu_grid,Ctnu
 
+@profiled('tfa.choi_williams_kernel')
 def _choi_kernel(t,nu,time,magconj,taustep,sigma):
     dtausum =  sliding_window_view(magconj,len(time))[:len(taustep)] * sliding_window_view(magconj[::-1],len(time))[:len(taustep),::-1]
     dtausum *= np.exp(-sigma*( (time-t)+1e-8 )**2/taustep**2)
@@ -174,16 +173,13 @@ def choi_williams_parallel(time,mag,
     taustep = np.linspace(1e-10,temporal_window_length,M//2)
     taustep = taustep[:,np.newaxis]
 
-    ncores = int(ncores)
-    if ncores < 1:
-        ncores = cpu_count()//2
-        threads = 2
-    else:
-        maxcores = cpu_count()
-        threads = maxcores//ncores
+    ncores = get_n_jobs(ncores)
+    threads = max(1,cpu_count()//ncores)
 
-    with parallel_backend("loky", inner_max_num_threads=threads):
-        Ctnu = ProgressParallel(n_jobs=ncores,total=len(t_grid)*len(nu_grid))(delayed(_choi_kernel)(t,nu,time,magconj,taustep,sigma) for t in t_grid for nu in nu_grid)
+    Ctnu = parallel_map(_choi_kernel, ((t,nu) for t in t_grid for nu in nu_grid),
+                        args=(time,magconj,taustep,sigma), star=True,
+                        n_jobs=ncores, total=len(t_grid)*len(nu_grid),
+                        blas_threads=threads)
 
     Ctnu = np.asarray(Ctnu).reshape(len(t_grid),len(nu_grid))
 
@@ -253,7 +249,7 @@ def choi_williams_single(time,mag,
     Ctnu = np.empty((Ntimes,Nfreqs))
 
     for ii,t in tqdm(enumerate(t_grid),total=len(t_grid)):
-        for jj,nu in enumerate(nu_grid):
+        for jj,nu in iterate('tfa.choi_williams_kernel', enumerate(nu_grid)):
 
             dtausum = sliding_window_view(magconj,len(time))[:len(taustep)] * sliding_window_view(magconj[::-1],len(time))[:len(taustep),::-1]
             dtausum *=  np.exp(-sigma*( (time-t)+1e-8 )**2/(4*taustep**2) )
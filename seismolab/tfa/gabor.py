@@ -1,10 +1,9 @@
 import numpy as np
 
 from tqdm.auto import tqdm
-from joblib import delayed
 
-from .tools import ProgressParallel
-from multiprocessing import cpu_count
+from ..profiling import profiled, iterate
+from ..parallel import parallel_map, get_n_jobs
 
 __all__ = ['gabor']
 
@@ -15,7 +14,7 @@ def gabor(time, brightness,
             samples_per_peak=10,
             Ntimes=100,
             sigma=0.5,
-            ncores=-1
+            ncores=None
         ):
     """
     Calculates the Gabor transform.
@@ -41,9 +40,10 @@ def gabor(time, brightness,
         The number of times points to generate a uniformly sampled time grid.
     sigma: float, default: 0.5
         The width of the Gaussian analyzing window.
-    ncores: int, default: -1
-        Number of CPU cores to be used for parallel error estimation.
+    ncores: int, default: None
+        Number of CPU cores to be used for parallel computation.
         If `-1`, then all available cores will be used.
+        If `None`, the global setting of `seismolab.parallel` is used.
 
     Returns
     -------
@@ -55,9 +55,7 @@ def gabor(time, brightness,
         Gabor transform at the time-frequency grid points.
     """
 
-    ncores = int(ncores)
-    if ncores < 1:
-        ncores = cpu_count()
+    ncores = get_n_jobs(ncores)
 
     if ncores == 1:
         t_grid,nu_grid,stFT = gabor_single(time,brightness,
@@ -83,6 +81,7 @@ def gabor(time, brightness,
 def _h(t,sigma):
     return np.exp(-t**2 /(2*sigma**2) )
 
+@profiled('tfa.gabor_kernel')
 def _gabor_kernel(t,magcorr,time,nu_grid,sigma):
     Ftnu = magcorr * np.conj(_h(time-t,sigma)) * np.exp(-1j * 2*np.pi * time * nu_grid)
     Ftnu = np.nansum(Ftnu,axis=1)
@@ -117,7 +116,7 @@ def gabor_parallel(time,mag,
 
     magcorr = mag-np.nanmean(mag)
 
-    stFT = ProgressParallel(n_jobs=ncores,total=len(t_grid))(delayed(_gabor_kernel)(t,magcorr,time,nu_grid,sigma) for t in t_grid)
+    stFT = parallel_map(_gabor_kernel, t_grid, args=(magcorr,time,nu_grid,sigma), n_jobs=ncores)
 
     stFT = np.asarray(stFT)
 
@@ -157,7 +156,7 @@ def gabor_single(time,mag,
 
     stFT = np.empty((Ntimes,Nfreqs))
 
-    for ii,t in tqdm(enumerate(t_grid),total=len(t_grid)):
+    for ii,t in iterate('tfa.gabor_kernel', tqdm(enumerate(t_grid),total=len(t_grid))):
 
         Ftnu = magcorr * np.conj(h(time-t)) * np.exp(-1j * 2*np.pi * time * nu_grid)
         Ftnu = np.nansum(Ftnu,axis=1)
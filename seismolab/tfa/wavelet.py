@@ -1,9 +1,8 @@
 import numpy as np
 
 from tqdm.auto import tqdm
-from joblib import delayed
-from .tools import ProgressParallel
-from multiprocessing import cpu_count
+from ..profiling import profiled, iterate
+from ..parallel import parallel_map, get_n_jobs
 
 __all__ = ['wavelet']
 
@@ -15,7 +14,7 @@ def wavelet(time, brightness,
 
             Ntimes=100,
             c=2*np.pi,
-            ncores=-1
+            ncores=None
         ):
     """
     Calculates the wavelet transform wit Morlet kernel.
@@ -42,9 +41,10 @@ def wavelet(time, brightness,
     c: float, default: 2*pi
         The scale parameter.
         The ratio of the time and frequency resolution.
-    ncores: int, default: -1
-        Number of CPU cores to be used for parallel error estimation.
+    ncores: int, default: None
+        Number of CPU cores to be used for parallel computation.
         If `-1`, then all available cores will be used.
+        If `None`, the global setting of `seismolab.parallel` is used.
 
     Returns
     -------
@@ -56,9 +56,7 @@ def wavelet(time, brightness,
         Morlet wavelet transform at the time-frequency grid points.
     """
 
-    ncores = int(ncores)
-    if ncores < 1:
-        ncores = cpu_count()
+    ncores = get_n_jobs(ncores)
 
     if ncores == 1:
         t_grid,nu_grid,morlet = wavelet_single(time,brightness,
@@ -83,6 +81,7 @@ def wavelet(time, brightness,
 def _g(x,c):
     return np.exp( -x**2/2 + 1j*c*x )
 
+@profiled('tfa.wavelet_kernel')
 def _wavelet_kernel(t,time,magcorr,c,nu_grid):
     a = c/(2*np.pi*nu_grid)
 
@@ -120,7 +119,7 @@ def wavelet_parallel(time,mag,
 
     magcorr = mag-np.nanmean(mag)
 
-    morlet = ProgressParallel(n_jobs=ncores,total=len(t_grid))(delayed(_wavelet_kernel)(t,time,magcorr,c,nu_grid) for t in t_grid)
+    morlet = parallel_map(_wavelet_kernel, t_grid, args=(time,magcorr,c,nu_grid), n_jobs=ncores)
 
     morlet = np.asarray(morlet)
 
@@ -159,7 +158,7 @@ def wavelet_single(time,mag,
 
     morlet = np.empty((Ntimes,Nfreqs))
 
-    for ii,t in tqdm(enumerate(t_grid),total=len(t_grid)):
+    for ii,t in iterate('tfa.wavelet_kernel', tqdm(enumerate(t_grid),total=len(t_grid))):
 
         a = c/(2*np.pi*nu_grid)
 
@@ -1,8 +1,8 @@
 import numpy as np
-from astropy.timeseries import LombScargle
-from astropy.modeling import models
 import warnings
 
+from ..profiling import iterate
+
 __all__ = ['windowed_lomb_scargle']
 
 def windowed_lomb_scargle(time,brightness,
@@ -49,12 +49,15 @@ def windowed_lomb_scargle(time,brightness,
         at the time-frequency grid points.
     """
 
+    from astropy.timeseries import LombScargle
+    from astropy.modeling import models
+
     magcorr = brightness-brightness.mean()
 
     powers = []
     t_grid = np.linspace(time.min(),time.max(), Ntimes )
 
-    for midtime in t_grid:
+    for midtime in iterate('tfa.windowed_lomb_scargle_kernel', t_grid):
         g = models.Gaussian1D(amplitude=1, mean=midtime, stddev=sigma)
         ls = LombScargle(time,magcorr*g(time))
         freq, power = ls.autopower(maximum_frequency=maximum_frequency,
@@ -96,3 +96,376 @@ def test_OCFitter_nonparametric(light_curve,
 
     assert_array_almost_equal(midtimes,midtimes_in)
     assert_array_almost_equal(OC,OC_in)
+
+@pytest.mark.parametrize("fittype", ['model','poly'])
+def test_OCFitter_parallel_cycles(light_curve,load_mintimes_model,load_mintimes_poly,get_period,fittype):
+    time,brightness,brightness_error = light_curve
+
+    period = get_period
+    fitter = OCFitter(time, brightness, brightness_error, period)
+    mintimes,mintimes_err = fitter.fit_minima(fittype=fittype,samplings=10,parallel_cycles=True)
+
+    if fittype == 'model':
+        mintimes_in = load_mintimes_model
+    else:
+        mintimes_in = load_mintimes_poly
+
+    assert_array_almost_equal(mintimes,mintimes_in)
+    assert np.all(mintimes_err > 0)
+
+def test_OCFitter_saveplot(light_curve,get_period,tmp_path):
+    time,brightness,brightness_error = light_curve
+
+    fitter = OCFitter(time, brightness, brightness_error, get_period)
+    mintimes,_ = fitter.fit_minima(fittype='poly', samplings=10,
+                                   saveplot=True, filename=str(tmp_path/'tmen'))
+
+    assert fitter.plot_job.result() == str(tmp_path/'tmen_minima_fit.pdf')
+    assert (tmp_path/'tmen_minima_fit.pdf').stat().st_size > 0
+
+def test_get_model_periodic(light_curve,get_period):
+    time,brightness,brightness_error = light_curve
+
+    fitter = OCFitter(time, brightness, brightness_error, get_period)
+    pol,phase = fitter.get_model(phase=0.1)
+
+    # The model repeats itself beyond the tabulated period
+    x = np.linspace(phase-get_period/2, phase+get_period/2, 50)
+    for shift in [-2,1,3]:
+        assert_array_almost_equal(pol(x+shift*get_period), pol(x))
+    assert np.ptp(pol(x)) < 2*np.ptp(brightness)
+
+def test_poly_minima():
+    from scipy.optimize import minimize_scalar
+    from seismolab.OC.OC import _poly_minima
+
+    rng = np.random.RandomState(1)
+    x = np.linspace(-0.15,0.15,80)
+    y = 50*x**2 + 30*x**3 + rng.normal(0,0.01,(20,80))
+
+    for order in [2,3,4]:
+        t = _poly_minima(x, y, order, -0.1, 0.1)
+        for ti,yi in zip(t,y):
+            p = np.poly1d(np.polyfit(x,yi,order))
+            result = minimize_scalar(p, bounds=(-0.1,0.1), method='bounded')
+            assert abs(ti-result.x) < 1e-4
+
+def test_resampled_minima():
+    from seismolab.OC.OC import _resampled_minima, _RESAMPLING_BLOCK
+
+    x = np.linspace(-1,1,50)
+    y = x**2
+    err = np.full_like(x,0.01)
+    samplings = _RESAMPLING_BLOCK + 10
+
+    t = [_resampled_minima(block, x, y, err, 7, samplings, 'poly', 2, -0.5, 0.5, None, None)
+         for block in range(2)]
+
+    assert len(t[0]) == _RESAMPLING_BLOCK
+    assert len(t[1]) == 10
+    assert abs(np.median(np.concatenate(t))) < 0.01
+    assert np.array_equal(t[1], _resampled_minima(1, x, y, err, 7, samplings, 'poly', 2, -0.5, 0.5, None, None))
+    # Blocks fitted together give the same minima
+    assert np.array_equal(np.concatenate(t),
+                          _resampled_minima(range(2), x, y, err, 7, samplings, 'poly', 2, -0.5, 0.5, None, None))
+
+def test_fit_model_shift():
+    from scipy.interpolate import CubicSpline
+    from seismolab.OC.OC import _fit_model_shift
+
+    grid = np.linspace(-1,1,2001)
+    pol = CubicSpline(grid, 1-np.exp(-grid**2/0.02))
+
+    x = np.linspace(-0.2,0.2,100)
+    err = np.full_like(x,0.01)
+    y = pol(x+0.013) + 0.5 + np.random.RandomState(1).normal(0,0.01,(50,100))
+
+    xoffset,yoffset = _fit_model_shift(x, y, err, pol, 0.1)
+    assert xoffset.shape == (50,)
+    assert abs(np.median(xoffset)-0.013) < 1e-3
+    assert abs(np.median(yoffset)-0.5) < 1e-2
+
+    xoffset,yoffset = _fit_model_shift(x, y[0], err, pol, 0.1)
+    assert np.ndim(xoffset) == 0
+
+def test_shift_phase_curves_single_point_cycle(light_curve,get_period):
+    from seismolab.OC.shift_curves import shift_phase_curves_vertically
+
+    time,brightness,brightness_error = light_curve
+
+    # Cycle with a single point before the others
+    time = np.r_[time[0]-0.9*get_period, time]
+    brightness = np.r_[brightness[0], brightness]
+    brightness_error = np.r_[brightness_error[0], brightness_error]
+
+    shifted = shift_phase_curves_vertically(time,brightness,brightness_error,get_period)
+    assert shifted.shape == brightness.shape
+    assert np.all(np.isfinite(shifted))
+
+def test_shift_phase_curves_longest_last():
+    from scipy.interpolate import interp1d
+    from seismolab.OC.shift_curves import shift_phase_curves_vertically, regression
+
+    # Six cycles with different offsets and scales, the last one covered best
+    period = 1.
+    rng = np.random.RandomState(1)
+    npoints = [30, 25, 40, 35, 30, 80]
+    time = np.concatenate([k*period + np.sort(rng.uniform(0.02,0.98,n)) for k,n in enumerate(npoints)])
+    cycle = np.floor(time/period)
+    flux = (1+0.1*cycle)*np.sin(2*np.pi*time/period) + 0.2*cycle + rng.normal(0,0.01,len(time))
+    fluxerr = np.full_like(time,0.01)
+
+    shifted = shift_phase_curves_vertically(time,flux,fluxerr,period)
+
+    # Previous loop over the cycles
+    expected = flux.copy()
+    phase = time%period/period
+    jumpat = np.where(np.diff(phase)<0)[0] + 1
+    jumpat = np.r_[0,jumpat,len(phase)+1]
+    largest = np.argmax(np.diff(jumpat))
+    start, end = jumpat[largest], jumpat[largest+1]
+    jumpat = np.delete(jumpat, jumpat == start)
+    jumpat = np.delete(jumpat, jumpat == end)
+    model_interp = interp1d(phase[start:end],flux[start:end],kind='cubic',fill_value='extrapolate')
+    for jumpstart,jumpend in zip(jumpat[:-1],jumpat[1:]):
+        model = model_interp(phase[jumpstart:jumpend])
+        X = np.c_[ np.ones_like(model), model ]
+        w, _ = regression(X, flux[jumpstart:jumpend], fluxerr[jumpstart:jumpend])
+        expected[jumpstart:jumpend] = flux[jumpstart:jumpend] + np.median(model) - w[0]
+
+    assert_array_almost_equal(shifted, expected)
+    # The baseline is not shifted
+    assert_array_almost_equal(shifted[start:], flux[start:])
+
+def test_cycle_numbers(get_period):
+    from seismolab.OC.OC import _cycle_numbers
+
+    period = get_period
+    cycles_in = np.r_[0,1,2,5,6,40,41,42]
+    OC_in = np.r_[0,0.01,-0.02,0.05,0.1,0.3,0.25,0.2]*period
+    elapsed = cycles_in*period + OC_in
+
+    # Second minimum within the same cycle
+    elapsed = np.sort(np.r_[elapsed, elapsed[3]+0.01])
+
+    cycles,OC = _cycle_numbers(elapsed, period, elapsed[-1]-elapsed[0])
+
+    good = np.isfinite(cycles)
+    assert np.sum(~good) == 1
+    assert_array_almost_equal(cycles[good], cycles_in)
+    assert_array_almost_equal(OC[good], OC_in)
+
+def test_OCFitter_update(light_curve,load_mintimes_poly,get_period):
+    time,brightness,brightness_error = light_curve
+    epoch = load_mintimes_poly[0]
+
+    full = OCFitter(time, brightness, brightness_error, get_period)
+    full.fit_minima(fittype='poly', samplings=10, epoch=epoch)
+
+    old = time < 1327.6
+    fitter = OCFitter(time[old], brightness[old], brightness_error[old], get_period)
+    fitter.fit_minima(fittype='poly', samplings=10, epoch=epoch)
+    ncycles = len(fitter.min_cycles)
+
+    new_times,_ = fitter.update(time[~old], brightness[~old], brightness_error[~old])
+
+    assert len(new_times) > 0
+    assert len(fitter.x) == len(time)
+    assert len(fitter.min_cycles) > ncycles
+    assert np.array_equal(fitter.min_cycles, full.min_cycles)
+    assert_array_almost_equal(fitter.min_times, full.min_times)
+
+def test_OCFitter_update_secondary_minimum():
+    period, epoch = 1.3, 0.4
+    time = np.arange(0,15,0.005)
+    phase = ((time-epoch)/period+0.25)%1-0.25
+    brightness = 1 - 0.5*np.exp(-phase**2/(2*0.03**2)) - 0.2*np.exp(-(phase-0.5)**2/(2*0.03**2))
+    brightness += np.random.RandomState(1).normal(0,1e-3,len(time))
+    brightness_error = np.full_like(time,1e-3)
+
+    full = OCFitter(time, brightness, brightness_error, period)
+    full.fit_minima(fittype='poly', order=4, samplings=10, epoch=epoch, phase_offsets=[0,0.5], seed=3)
+
+    # New data covers only a secondary minimum
+    secondary = epoch + 5.5*period
+    new = np.abs(time-secondary) < 0.15*period
+    fitter = OCFitter(time[~new], brightness[~new], brightness_error[~new], period)
+    fitter.fit_minima(fittype='poly', order=4, samplings=10, epoch=epoch, phase_offsets=[0,0.5], seed=3)
+    assert len(fitter.min_times) == len(full.min_times) - 1
+
+    new_times,_ = fitter.update(time[new], brightness[new], brightness_error[new])
+
+    assert np.any(np.abs(new_times-secondary) < 1e-3)
+    assert np.array_equal(fitter.min_cycles, full.min_cycles)
+    assert np.array_equal(fitter.min_events, full.min_events)
+    assert_array_almost_equal(fitter.min_times, full.min_times)
+    assert_array_almost_equal(fitter.min_times_err, full.min_times_err)
+
+def test_OCFitter_seed(light_curve,load_mintimes_poly,get_period):
+    time,brightness,brightness_error = light_curve
+
+    fitter = OCFitter(time, brightness, brightness_error, get_period)
+    np.random.seed(1)
+    _,errors = fitter.fit_minima(fittype='poly', samplings=10, epoch=load_mintimes_poly[0], seed=5)
+    np.random.seed(2)
+    _,errors_parallel = fitter.fit_minima(fittype='poly', samplings=10, epoch=load_mintimes_poly[0],
+                                          seed=5, parallel_cycles=True)
+
+    assert np.all(errors > 0)
+    assert np.array_equal(errors, errors_parallel)
+
+def test_OCFitter_resampling_workers(light_curve,load_mintimes_poly,get_period,monkeypatch):
+    import seismolab.parallel
+    from seismolab.OC.OC import _RESAMPLING_BLOCK
+
+    time,brightness,brightness_error = light_curve
+    monkeypatch.setattr(seismolab.parallel, 'cpu_count', lambda: 2)
+
+    # The default resamplings are split into several blocks
+    assert 100 > _RESAMPLING_BLOCK
+
+    fitter = OCFitter(time[:3000], brightness[:3000], brightness_error[:3000], get_period)
+    results = []
+    for npools in [1,2]:
+        results.append(fitter.fit_minima(fittype='poly', epoch=load_mintimes_poly[0],
+                                         npools=npools, seed=5))
+
+    assert np.array_equal(results[0][0], results[1][0])
+    assert np.array_equal(results[0][1], results[1][1])
+
+def test_OCFitter_secondary_minima():
+    # Eclipsing binary with primary and secondary minima
+    period, epoch = 1.3, 0.4
+    time = np.arange(0,15,0.005)
+    phase = ((time-epoch)/period+0.25)%1-0.25
+    brightness = 1 - 0.5*np.exp(-phase**2/(2*0.03**2)) - 0.2*np.exp(-(phase-0.5)**2/(2*0.03**2))
+    brightness += np.random.RandomState(1).normal(0,1e-3,len(time))
+    brightness_error = np.full_like(time,1e-3)
+
+    fitter = OCFitter(time, brightness, brightness_error, period)
+    (primary,secondary),_ = fitter.fit_minima(fittype='poly', order=4, samplings=10,
+                                              phase_offsets=[0,0.5])
+
+    assert_array_almost_equal(primary, epoch+np.arange(12)*period, decimal=3)
+    assert_array_almost_equal(secondary, epoch+(np.arange(11)+0.5)*period, decimal=3)
+
+    _,OC,_ = fitter.calculate_OC(phase_offset=0.5)
+    assert len(OC) == len(secondary)
+    assert np.all(np.abs(OC) < 1e-3)
+
+def test_OCFitter_refine_ephemeris():
+    period, epoch = 1.3, 0.4
+    time = np.arange(0,30,0.005)
+    phase = ((time-epoch)/period+0.5)%1-0.5
+    brightness = 1 - 0.5*np.exp(-phase**2/(2*0.03**2))
+    brightness += np.random.RandomState(1).normal(0,1e-3,len(time))
+    brightness_error = np.full_like(time,1e-3)
+
+    # Start from a wrong period
+    fitter = OCFitter(time, brightness, brightness_error, 1.302)
+    fitter.fit_minima(fittype='poly', order=4, samplings=10, epoch=0.41)
+    refined_epoch, refined_period = fitter.refine_ephemeris()
+
+    assert abs(refined_period-period) < 1e-4
+    assert abs(refined_epoch-epoch) < 1e-3
+    assert fitter.period == refined_period
+
+    _,OC,_ = fitter.calculate_OC()
+    assert np.all(np.abs(OC) < 1e-3)
+
+def test_fit_minima_batch(light_curve,load_mintimes_poly,get_period,tmp_path):
+    from seismolab.OC import fit_minima_batch, read_minima_batch
+
+    time,brightness,brightness_error = light_curve
+    stars = [(time,brightness,brightness_error,get_period),
+             (time,brightness+0.1,brightness_error,get_period)]
+
+    table = fit_minima_batch(stars, names=['A','B'], fittype='poly', samplings=10,
+                             cycles_per_task=2, seed=1, filename=str(tmp_path/'minima.h5'))
+
+    for name in ['A','B']:
+        assert_array_almost_equal(table['time'][table['star']==name], load_mintimes_poly)
+    assert np.all(table['err'] > 0)
+    assert table['OC'][0] == 0
+
+    saved = read_minima_batch(str(tmp_path/'minima.h5'))
+    assert list(saved['star']) == list(table['star'])
+    assert np.array_equal(saved['OC'], table['OC'])
+
+def test_fit_minima_batch_errors(light_curve,get_period,monkeypatch):
+    from seismolab.OC import fit_minima_batch
+
+    time,brightness,brightness_error = light_curve
+    stars = [(time,brightness,brightness_error,get_period)]
+
+    # Stars that cannot be fitted are skipped
+    def fail(self, **kwargs):
+        raise RuntimeError('No minimum found!')
+    monkeypatch.setattr(OCFitter, '_setup_cycle_fit', fail)
+    with pytest.warns(UserWarning, match='Skipping star 0'):
+        table = fit_minima_batch(stars, fittype='poly', samplings=10, progress=False)
+    assert len(table) == 0
+
+    # Other errors are raised
+    def bug(self, **kwargs):
+        raise TypeError('Unexpected argument!')
+    monkeypatch.setattr(OCFitter, '_setup_cycle_fit', bug)
+    with pytest.raises(TypeError):
+        fit_minima_batch(stars, fittype='poly', samplings=10, progress=False)
+
+def test_minima_store(light_curve,load_mintimes_poly,get_period,tmp_path):
+    from seismolab.OC import MinimaStore
+
+    time,brightness,brightness_error = light_curve
+    fitter = OCFitter(time, brightness, brightness_error, get_period)
+    fitter.fit_minima(fittype='poly', samplings=10, epoch=load_mintimes_poly[0])
+    _,OC,_ = fitter.calculate_OC()
+
+    filename = str(tmp_path/'survey.h5')
+    with MinimaStore(filename, chunk_size=2) as store:
+        store.append('A', fitter)
+        store.append_minima('B', [1.,2.], [0.1,0.1], [0,1], [0.,0.], period=1.)
+        store.append_minima('A', [1330.], [0.1], [10], [0.], fittype='poly')
+
+    with MinimaStore(filename,'r') as store:
+        assert len(store) == len(load_mintimes_poly) + 3
+        assert store.star_names == ['A','B']
+
+        table = store.read(stars=['A'])
+        assert_array_almost_equal(table['time'][:-1], load_mintimes_poly)
+        assert_array_almost_equal(table['OC'][:-1], OC)
+        assert table['time'][-1] == 1330.
+
+        assert list(store.read(columns=['star'])['star']) == ['A']*len(load_mintimes_poly) + ['B']*2 + ['A']
+
+        stars = store.read_stars()
+        assert list(stars['fittype']) == ['poly','']
+        assert stars['period'][0] == get_period
+        assert stars['epoch'][0] == load_mintimes_poly[0]
+        assert np.isnan(stars['epoch'][1])
+
+    # Minima of a stored star are replaced only on request
+    with MinimaStore(filename) as store:
+        with pytest.raises(ValueError):
+            store.append('A', fitter)
+        store.append('A', fitter, overwrite=True)
+
+        assert len(store) == len(load_mintimes_poly) + 2
+        assert_array_almost_equal(store.read(stars=['A'])['time'], load_mintimes_poly)
+        assert list(store.read(stars=['B'])['time']) == [1.,2.]
+
+def test_local_linear_smoother():
+    kernel_regression = pytest.importorskip('statsmodels.nonparametric.kernel_regression')
+    from seismolab.OC.smoothing import LocalLinearSmoother
+
+    rng = np.random.RandomState(0)
+    x = np.sort(rng.uniform(0,1,200))
+    y = np.sin(8*x) + rng.normal(0,0.1,200)
+    bw = 2*np.median(np.diff(x))
+
+    ksrmv = kernel_regression.KernelReg(endog=y, exog=x, var_type='c', reg_type='ll', bw=np.array([bw]))
+    smoother = LocalLinearSmoother(x, y, bw)
+
+    x_eval = np.linspace(-0.01,1.01,300)
+    assert_array_almost_equal(smoother(x_eval), ksrmv.fit(x_eval)[0])
+    assert np.ndim(smoother(0.5)) == 0
@@ -1,6 +1,11 @@
 import pytest
 from numpy.testing import assert_array_almost_equal
 import numpy as np
+import os
+import subprocess
+import sys
+
+import seismolab
 
 from seismolab.fourier import Fourier, MultiHarmonicFitter, MultiFrequencyFitter
 
@@ -93,3 +98,50 @@ def test_MultiFrequencyFitter(light_curve,pfit_perr_all):
     # Check phases
     assert_array_almost_equal(pfit[2*ncomponents:-1],pfit_in[2*ncomponents:-1],decimal=3)
 
+
+def test_MultiHarmonicFitter_checkpoint(light_curve,tmp_path):
+    time,brightness = light_curve
+
+    fitter = MultiHarmonicFitter(time,brightness)
+    _,perr = fitter.fit_harmonics(error_estimation='bootstrap',ntry=20,seed=42,parallel=False)
+
+    # Simulate an interrupted run by keeping only the first few resamplings
+    checkpoint = tmp_path / 'bootstrap.txt'
+    fitter.fit_harmonics(error_estimation='bootstrap',ntry=20,seed=42,parallel=False,
+                         checkpoint=str(checkpoint),checkpoint_every=5)
+    lines = checkpoint.read_text().splitlines(keepends=True)
+    assert len(lines) == 21
+    checkpoint.write_text(''.join(lines[:7]) + lines[7][:10])
+
+    _,perr_resumed = fitter.fit_harmonics(error_estimation='bootstrap',ntry=20,seed=42,parallel=False,
+                                          checkpoint=str(checkpoint),checkpoint_every=5)
+
+    assert_array_almost_equal(perr_resumed,perr)
+
+def test_MultiHarmonicFitter_checkpoint_other_data(light_curve,tmp_path):
+    time,brightness = light_curve
+
+    checkpoint = tmp_path / 'bootstrap.txt'
+    fitter = MultiHarmonicFitter(time,brightness)
+    fitter.fit_harmonics(error_estimation='bootstrap',ntry=10,seed=42,parallel=False,
+                         checkpoint=str(checkpoint))
+
+    # The same checkpoint must not be reused for different data
+    fitter = MultiHarmonicFitter(time,brightness+0.01*np.sin(time))
+    with pytest.raises(ValueError):
+        fitter.fit_harmonics(error_estimation='bootstrap',ntry=10,seed=42,parallel=False,
+                             checkpoint=str(checkpoint))
+
+def loaded_modules_after_import(module,modules):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(seismolab.PACKAGEDIR))
+    code = "import sys, %s; print(' '.join(m for m in %r if m in sys.modules))" % (module,modules)
+    result = subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,env=env,check=True)
+    return result.stdout.split()
+
+def test_lazy_import():
+    heavy_modules = ['matplotlib.pyplot','corner','uncertainties','astropy.timeseries',
+                     'scipy.stats','scipy.optimize','arviz','statsmodels']
+
+    assert loaded_modules_after_import('seismolab.fourier',heavy_modules) == []
+    assert loaded_modules_after_import('seismolab.template',heavy_modules) == []
+    assert loaded_modules_after_import('seismolab.OC',heavy_modules) == []
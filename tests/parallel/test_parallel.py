@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+
+from seismolab import parallel
+from seismolab.parallel import parallel_map, get_n_jobs, config_context
+
+def _power(x, p=2):
+    return x**p
+
+def _sum(a, b, c=0):
+    return a+b+c
+
+@pytest.mark.parametrize("backend", ['serial','threads','processes'])
+def test_parallel_map(backend):
+    x = np.arange(20)
+
+    result = parallel_map(_power, x, args=(3,), n_jobs=2, backend=backend, progress=False)
+    assert np.array_equal(result, x**3)
+
+    result = parallel_map(_sum, zip(x,x), star=True, n_jobs=2, backend=backend,
+                          progress=False, total=len(x))
+    assert np.array_equal(result, 2*x)
+
+@pytest.mark.parametrize("backend", ['serial','threads'])
+def test_parallel_map_progress_bar(backend):
+    import io
+    from tqdm import tqdm
+
+    # Several calls advance the same progress bar
+    with tqdm(total=5, file=io.StringIO()) as bar:
+        parallel_map(_power, range(2), n_jobs=2, backend=backend, progress=bar)
+        parallel_map(_power, range(3), n_jobs=2, backend=backend, progress=bar)
+        assert bar.n == 5
+
+def test_get_n_jobs():
+    ncores = parallel.cpu_count()
+    assert ncores >= 1
+
+    assert get_n_jobs(-1) == ncores
+    assert get_n_jobs(1) == 1
+    assert get_n_jobs(10*ncores) == ncores
+    with pytest.raises(ValueError):
+        get_n_jobs(0)
+
+def test_config():
+    default = parallel.get_config()
+
+    with config_context(n_jobs=1, backend='serial', progress=False):
+        assert get_n_jobs() == 1
+        assert parallel.get_config()['backend'] == 'serial'
+        assert parallel_map(_power, [1,2,3]) == [1,4,9]
+
+    assert parallel.get_config() == default
+
+    with pytest.raises(ValueError):
+        parallel.set_config(backend='dask')
+    with pytest.raises(KeyError):
+        parallel.set_config(ncores=2)
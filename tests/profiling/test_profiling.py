@@ -0,0 +1,59 @@
+import json
+import pytest
+import numpy as np
+
+from seismolab import profiling
+from seismolab.fourier import MultiFrequencyFitter
+
+@pytest.fixture
+def light_curve():
+    np.random.seed(12345)
+
+    time = np.linspace(0,10,500)
+    mag = 0.1 * np.sin(2*np.pi*time/0.14) + 0.03 * np.sin(2*np.pi*time/0.23)
+    mag += np.random.normal(0,0.005,time.shape[0])
+
+    return time,mag
+
+def test_disabled():
+    assert not profiling.is_enabled()
+    assert profiling.stage('test') is profiling.stage('other')
+
+    data = [1,2,3]
+    assert profiling.iterate('test',data) is data
+
+def test_stages():
+    with profiling.profile() as prof:
+        for _ in profiling.iterate('loop', range(3)):
+            with profiling.stage('inner'):
+                x = np.ones(100_000)
+        profiling.profiled('decorated')(np.sum)(x)
+
+    assert not profiling.is_enabled()
+
+    summary = prof.summary()
+    assert summary['loop']['calls'] == 3
+    assert summary['inner']['calls'] == 3
+    assert summary['decorated']['calls'] == 1
+    assert summary['inner']['peak_memory'] >= 800_000
+    assert summary['loop']['peak_memory'] >= summary['inner']['peak_memory']
+
+def test_export(light_curve,tmp_path):
+    time,mag = light_curve
+
+    with profiling.profile(memory=False) as prof:
+        fitter = MultiFrequencyFitter(time,mag)
+        fitter.fit_freqs(maxfreqs=2,error_estimation='bootstrap',ntry=5,seed=1,parallel=False)
+
+    summary = prof.summary()
+    assert summary['fourier.prewhitening']['calls'] >= 2
+    assert summary['fourier.error_estimation']['calls'] == 1
+    assert summary['fourier.resampling']['calls'] == 5
+    assert summary['fourier.resampling']['peak_memory'] is None
+
+    result = json.loads(prof.to_json(tmp_path / 'profile.json'))
+    assert result['summary']['fourier.resampling']['calls'] == 5
+
+    trace = json.loads(prof.to_chrome_trace(tmp_path / 'trace.json'))
+    assert len(trace['traceEvents']) == len(prof.events)
+    assert all(event['ph'] == 'X' for event in trace['traceEvents'])
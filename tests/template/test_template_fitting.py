@@ -46,4 +46,99 @@ def test_TemplateFitter(light_curve,template_OC,template_lc,template_lc_interp):
     assert_array_almost_equal(zperr,zperr_in)
 
     assert_array_almost_equal(template,template_in)
-    assert_array_almost_equal(template_interp,template_interp_in)
\ No newline at end of file
+    assert_array_almost_equal(template_interp,template_interp_in)
+
+
+def test_fit_lightcurve_chunks():
+    from scipy.optimize import curve_fit
+    from seismolab.template.template import fit_lightcurve_chunks, modulated_lc_model
+
+    pfit = [2., 0.3, 0.1, 0.5, 1.5, 1.]
+    time = np.linspace(0,3,300)
+    error = np.full_like(time,0.01)
+    rng = np.random.RandomState(0)
+
+    # Two chunks with different modulation
+    params = [(1.02,0.95,0.05),(0.98,1.1,-0.08)]
+    flux = np.concatenate([modulated_lc_model(time,*p,pfit,'sin') for p in params])
+    flux += rng.normal(0,0.01,len(flux))
+    chunk = np.repeat([0,1],len(time))
+
+    values, errors = fit_lightcurve_chunks(np.tile(time,2), flux, np.tile(error,2), chunk, 2, pfit, 'sin')
+
+    for k in range(2):
+        expected, pcov = curve_fit(lambda x, a0, a, psi: modulated_lc_model(x, a0, a, psi, pfit, 'sin'),
+                                   time, flux[chunk==k], p0=[0.9,0.9,0.1],
+                                   sigma=error, absolute_sigma=True)
+        assert_array_almost_equal(values[k], expected, decimal=6)
+        assert_array_almost_equal(errors[k], np.sqrt(np.diag(pcov)), decimal=6)
+
+
+def test_chunk_windows(light_curve):
+    from seismolab.template.template import _chunk_windows
+
+    time,brightness,brightness_error = light_curve
+    span, step = 1.2, 0.4
+    n = np.array([0, 3, 10])
+
+    starts, stops = _chunk_windows(time, span, step, n)
+
+    for k in range(len(n)):
+        um = (time>=time[0]+step*n[k]) & (time<time[0]+step*n[k]+span)
+        assert np.array_equal(np.arange(starts[k],stops[k]), np.flatnonzero(um))
+
+
+def test_mcmc_model_reuse():
+    pm = pytest.importorskip('pymc')
+    from seismolab.template.template import _mcmc_model, modulated_lc_model
+
+    pfit = [2., 0.3, 0.1, 0.5, 1.5, 1.]
+    rng = np.random.RandomState(0)
+    point = {'a0_interval__': 0.1, 'a_interval__': -0.2, 'psi_interval__': 0.3}
+
+    # Two windows of different lengths
+    for n in [120, 75]:
+        time = np.sort(rng.uniform(0,2,n))
+        flux = modulated_lc_model(time,1.02,0.95,0.05,pfit,'sin') + rng.normal(0,0.01,n)
+        error = np.full(n,0.01)
+
+        model, _ = _mcmc_model(pfit, 'sin')
+        with model:
+            pm.set_data({"time": time, "flux": flux, "sigma": error})
+
+        # The same model built for this window only
+        with pm.Model() as fresh:
+            a0 = pm.Uniform("a0", 0, 2)
+            a = pm.Uniform("a", 0, 2)
+            psi = pm.Uniform("psi", -1, 1)
+            pm.Normal("likelihood", mu=modulated_lc_model(time, a0, a, psi, pfit, 'sin'),
+                      sigma=error, observed=flux)
+
+        assert _mcmc_model(pfit, 'sin')[0] is model
+        assert np.isclose(model.compile_logp()(point), fresh.compile_logp()(point))
+
+
+def test_mcmc_sampler_reuse(monkeypatch):
+    pm = pytest.importorskip('pymc')
+    from seismolab.template.template import _mcmc_model, mcmc_chunk_errors, modulated_lc_model
+
+    pfit = [2., 0.3, 0.1, 0.5, 1.5, 1.]
+    rng = np.random.RandomState(0)
+    time = np.sort(rng.uniform(0,4,300))
+    flux = modulated_lc_model(time,1.02,0.95,0.05,pfit,'sin') + rng.normal(0,0.01,len(time))
+    error = np.full_like(time,0.01)
+
+    errors = mcmc_chunk_errors(0, 180, 1., 1., 0., time, flux, error, pfit, 'sin')
+    model, step = _mcmc_model(pfit, 'sin')
+    logp_dlogp = step._logp_dlogp_func
+
+    # The next window is sampled without compiling the model again
+    def compile_again(*args, **kwargs):
+        raise AssertionError('The model is compiled again!')
+    monkeypatch.setattr(pm.Model, 'logp_dlogp_function', compile_again)
+
+    errors += mcmc_chunk_errors(180, 300, 1., 1., 0., time, flux, error, pfit, 'sin')
+
+    assert _mcmc_model(pfit, 'sin') == (model, step)
+    assert step._logp_dlogp_func is logp_dlogp
+    assert np.all(np.isfinite(errors)) and np.all(np.array(errors) > 0)